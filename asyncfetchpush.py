@@ -2,15 +2,443 @@ import progressbar
 import time
 import sys
 import os
-import grequests
-import cStringIO
+import random
+import email.utils
+import threading
+import functools
+import itertools
+import hashlib
+import base64
+import heapq
+import array
+import math
+import tarfile
+import zlib
+import mimetypes
+import urlparse
+from collections import deque
+from collections import defaultdict
+from collections import OrderedDict
 #REMOVE ME
 import json
 #
 #DISABLE ALL WARNINGS (Lazy)
 import warnings
 warnings.filterwarnings("ignore")
-global pbar
+
+def size_to_string(num, suffix="B"):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+#The engines HttpGrabberPusher can make its requests with
+ENGINES = ('gevent', 'asyncio')
+
+#Statuses worth another attempt, any other failed response (eg. a 404) is
+#final. Requests which got no response at all are always retried
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+#Seconds a request waits for a free connection of a full blocking
+#ConnectionPool, only a pool whose connections leaked should wait this long
+POOL_TIMEOUT = 600.0
+
+#Seconds, the delay before retry n is a random amount up to
+#min(BACKOFF_CAP, BACKOFF_BASE * 2**n)
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+#Seconds, the longest a Pipeline waits on a server's Retry-After before the
+#retry, one asking for hours (eg. maintenance) doesn't park the request
+RETRY_AFTER_CAP = 300.0
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    #Full jitter, spreads out retries of requests which failed together
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+#Seconds the server asked us to wait in a Retry-After header, if it did
+def retry_after(headers):
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+#Size of the blocks read from/written to disk while a body is in flight
+CHUNK_SIZE = 65536
+
+#Status a resumable upload server answers a piece with until it has it all
+RESUME_INCOMPLETE = 308
+
+#(first, last, total) from a Content-Range header, None if there isn't one
+def content_range(headers):
+    value = headers.get('content-range', '')
+    try:
+        unit, spec = value.split(' ', 1)
+        span, total = spec.split('/')
+        first, last = span.split('-')
+        return int(first), int(last), None if total == '*' else int(total)
+    except ValueError:
+        return None
+
+#Smallest segment a GET is split into when segmenting downloads
+SEGMENT_SIZE = 16777216
+
+#Segments a download of size bytes is split into, at most segments of at
+#least segment_size bytes each
+def segment_count(size, segments, segment_size=SEGMENT_SIZE):
+    return max(1, min(segments, size // max(segment_size, 1)))
+
+#(hashlib algorithm, hex digest) of a file, from the checksum headers artifact
+#servers send, None if there are none
+def expected_digest(headers):
+    for header, algorithm in (('x-checksum-sha256', 'sha256'),
+            ('x-checksum-sha1', 'sha1'), ('x-checksum-md5', 'md5')):
+        if headers.get(header):
+            return algorithm, headers[header].strip().lower()
+    if headers.get('content-md5'):
+        try:
+            return 'md5', base64.b64decode(headers['content-md5']).encode('hex')
+        except TypeError:
+            pass
+    return None
+
+def file_digest(filepath, algorithm, blocksize=1048576):
+    h = hashlib.new(algorithm)
+    fh = open(filepath, 'rb')
+    try:
+        block = fh.read(blocksize)
+        while block:
+            h.update(block)
+            block = fh.read(blocksize)
+    finally:
+        fh.close()
+    return h.hexdigest()
+
+#Bytes a resumable upload server has, from the Range of a 308 response
+def uploaded_bytes(headers):
+    value = headers.get('range', '')
+    try:
+        return int(value.split('=', 1)[1].split('-')[1]) + 1
+    except (IndexError, ValueError):
+        return 0
+
+#Bytes per second from eg. "512K", "20M" or "1G" (binary units), or a number
+def parse_rate(value):
+    value = str(value).strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1024, 'M': 1048576, 'G': 1073741824}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value or 0))
+
+#Content-Encodings a PUT body can be compressed with, zstd needs zstandard
+ENCODINGS = ('gzip', 'zstd')
+
+#Files no smaller than this many bytes are worth compressing
+COMPRESS_MIN = 1024
+
+#Already compressed (or compressed inside, eg. jars) so not worth compressing
+COMPRESSED_EXTENSIONS = frozenset(('jar', 'war', 'ear', 'aar', 'apk', 'zip',
+    'gz', 'tgz', 'bz2', 'tbz2', 'xz', 'txz', 'lz', 'lzma', 'zst', '7z', 'rar',
+    'whl', 'egg', 'nupkg', 'rpm', 'deb', 'dmg', 'png', 'jpg', 'jpeg', 'gif',
+    'webp', 'mp3', 'mp4', 'mkv', 'avi', 'mov', 'pdf', 'woff', 'woff2'))
+
+#Types compressed even though they're not text/*
+COMPRESSIBLE_TYPES = frozenset(('application/json', 'application/xml',
+    'application/javascript', 'application/x-javascript', 'application/x-sh',
+    'application/x-tar', 'application/x-yaml'))
+
+'''
+Whether a file of size bytes is worth compressing: at least minsize bytes,
+not a format which is compressed already and text, or a type which
+compresses well, going by its name. Files with no known type (eg. poms,
+logs) are compressed
+'''
+def compressible(filepath, size, minsize=COMPRESS_MIN):
+    if size < minsize:
+        return False
+    name = os.path.basename(filepath).lower()
+    if name.rsplit('.', 1)[-1] in COMPRESSED_EXTENSIONS:
+        return False
+    mimetype, encoding = mimetypes.guess_type(name)
+    if encoding is not None:
+        return False
+    return (mimetype is None or mimetype.startswith('text/')
+            or mimetype.endswith('+xml') or mimetype in COMPRESSIBLE_TYPES)
+
+#A compressor object (compress() and flush()) for a Content-Encoding
+def make_compressor(encoding, level=None):
+    if encoding == 'gzip':
+        #wbits 16 + 15 writes a gzip header and trailer rather than zlib's
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    elif encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ValueError("Unknown encoding {}, use one of {}".format(encoding, ', '.join(ENCODINGS)))
+
+#The Accept-Encoding of a GET, every encoding the installed urllib3 can decode
+def accept_encoding():
+    from urllib3.response import HTTPResponse
+    return ', '.join(HTTPResponse.CONTENT_DECODERS)
+
+'''
+A token bucket of bytes, refilled at rate bytes per second up to burst
+
+reserve takes the bytes straight away, running into debt if there aren't
+enough, and returns how long the caller has to wait for the debt to be paid
+off. Callers sleep outside the lock so greenlets never block each other, and
+as every reservation waits behind the ones before it the bytes are handed
+out first come, first served.
+'''
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.stamp = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = float(rate)
+            #A quarter of a second's worth smooths out the chunk sizes
+            self.burst = burst if burst is not None else self.rate / 4
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, n):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+'''
+Limits the bytes per second sent and received, in total and per host
+
+Every transfer takes its bytes from the buckets quantum bytes at a time, so
+with many transfers in flight they take turns and each gets a fair share
+instead of one huge file starving the rest. The limits can be changed while
+transfers are running with configure, or by writing a control file which is
+reread when it changes (checked once a second) or on SIGUSR1:
+
+    {"rate": "50M", "hosts": {"foo.com": "10M"}}
+
+Args:
+    rate - Total bytes per second, 0 for no limit
+    hosts - A dictionary of host : bytes per second
+    quantum - Bytes taken from the buckets at a time
+    control - Path of a control file, optional
+    share - The number of processes the limits are split between, each
+            Throttle allows 1/share of them
+
+Example:
+
+    throttle = Throttle(parse_rate('20M'), {'foo.com': parse_rate('5M')})
+    throttle.take('foo.com', len(chunk))
+'''
+class Throttle(object):
+
+    def __init__(self, rate=0, hosts=None, quantum=16384, control=None, share=1):
+        self.quantum = quantum
+        self.control = control
+        self.share = share
+        self.bucket = None
+        self.hosts = {}
+        self._mtime = None
+        self._checked = 0
+        self._reload = False
+        self.configure(rate, hosts)
+        if control:
+            self._poll()
+            try:
+                import signal
+                signal.signal(signal.SIGUSR1, self._signalled)
+            except (ImportError, AttributeError, ValueError):
+                #No SIGUSR1 (windows) or not the main thread
+                pass
+
+    def configure(self, rate=0, hosts=None):
+        rate = rate / float(self.share)
+        hosts = dict((host, hostrate / float(self.share))
+                for host, hostrate in (hosts or {}).iteritems())
+        if rate > 0 and self.bucket is not None:
+            self.bucket.set_rate(rate)
+        else:
+            self.bucket = TokenBucket(rate) if rate > 0 else None
+        buckets = {}
+        for host, hostrate in hosts.iteritems():
+            if hostrate <= 0:
+                continue
+            buckets[host] = self.hosts.get(host) or TokenBucket(hostrate)
+            buckets[host].set_rate(hostrate)
+        self.hosts = buckets
+
+    def _signalled(self, signum, frame):
+        self._reload = True
+
+    #Reread the control file if it has changed, at most once a second
+    def _poll(self):
+        now = time.time()
+        if not self._reload and now - self._checked < 1:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.control).st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime and not self._reload:
+            return
+        self._reload = False
+        self._mtime = mtime
+        try:
+            fh = open(self.control, 'r')
+            try:
+                settings = json.load(fh)
+            finally:
+                fh.close()
+            self.configure(parse_rate(settings.get('rate', 0)),
+                    dict((host, parse_rate(rate)) for host, rate
+                        in settings.get('hosts', {}).iteritems()))
+            print "Rate limits from {0}: {1}".format(self.control, settings)
+        except (IOError, ValueError, AttributeError) as e:
+            print "Error: can't read rate limits from {0}: {1}".format(self.control, e)
+
+    #Wait until n bytes to or from host are allowed
+    def take(self, host, n):
+        if self.control:
+            self._poll()
+        while n > 0:
+            quantum = min(n, self.quantum)
+            n -= quantum
+            wait = 0.0
+            bucket = self.bucket
+            if bucket is not None:
+                wait = bucket.reserve(quantum)
+            hostbucket = self.hosts.get(host)
+            if hostbucket is not None:
+                wait = max(wait, hostbucket.reserve(quantum))
+            if wait:
+                time.sleep(wait)
+
+'''
+A PUT body which streams a file from disk
+
+The file isn't opened until requests starts sending the body, and is read
+chunk_size bytes at a time, so only the requests currently on the wire hold
+any file data in memory. __len__ lets requests set a Content-Length instead
+of falling back to a chunked transfer.
+
+Args:
+    filepath - the full path of the file to upload
+    chunk_size - bytes read from disk per iteration
+    offset - where in the file the body starts
+    length - bytes of the file to send, the rest of the file by default
+'''
+class LazyFileBody(object):
+
+    def __init__(self, filepath, chunk_size=CHUNK_SIZE, offset=0, length=None):
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.offset = offset
+        self.length = length
+        self.remaining = None
+        self.filehandle = None
+        #Called with the size of every chunk read, eg. to throttle
+        self.on_read = None
+
+    def __len__(self):
+        if self.length is not None:
+            return self.length
+        return os.stat(self.filepath).st_size - self.offset
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        if self.filehandle is None:
+            self.filehandle = open(self.filepath, 'rb')
+            self.filehandle.seek(self.offset)
+            self.remaining = self.length
+        if self.remaining is not None:
+            size = self.remaining if size < 0 else min(size, self.remaining)
+        chunk = self.filehandle.read(size) if size != 0 else ''
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        if not chunk:
+            self.close()
+        elif self.on_read is not None:
+            self.on_read(len(chunk))
+        return chunk
+
+    def close(self):
+        if self.filehandle is not None:
+            self.filehandle.close()
+            self.filehandle = None
+
+'''
+A file compressed as it is sent, for a PUT with a Content-Encoding
+
+chunk_size bytes are read and compressed at a time. The compressed length
+isn't known up front so it has no len() and requests sends it with chunked
+Transfer-Encoding. on_read is called with the size of every chunk read from
+the file, sent is the number of compressed bytes so far.
+
+Args:
+    filepath - The file to send
+    encoding - One of ENCODINGS
+    chunk_size - bytes read from disk per iteration
+'''
+class CompressedBody(object):
+
+    def __init__(self, filepath, encoding, chunk_size=CHUNK_SIZE, level=None):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.level = level
+        self.sent = 0
+        self.filehandle = None
+        self.on_read = None
+
+    def __iter__(self):
+        compressor = make_compressor(self.encoding, self.level)
+        self.sent = 0
+        self.filehandle = open(self.filepath, 'rb')
+        try:
+            while True:
+                chunk = self.filehandle.read(self.chunk_size)
+                if not chunk:
+                    break
+                if self.on_read is not None:
+                    self.on_read(len(chunk))
+                #An empty chunk would end the chunked body
+                compressed = compressor.compress(chunk)
+                if compressed:
+                    self.sent += len(compressed)
+                    yield compressed
+            compressed = compressor.flush()
+            if compressed:
+                self.sent += len(compressed)
+                yield compressed
+        finally:
+            self.close()
+
+    def close(self):
+        if self.filehandle is not None:
+            self.filehandle.close()
+            self.filehandle = None
+
 '''
 Fast implementation of HTTP GET/POST/PUT
 
@@ -21,12 +449,52 @@ Args:
     kwargs - Arguments passed to the requests lib
     (http://docs.python-requests.org/en/latest/)
 
+GETs without a filehandle are written to filepath.part, which is kept if the
+download fails. The next attempt (or the next run) asks for the rest of it
+with a Range header, with If-Range so a file which has changed on the server
+since is downloaded from the start again.
+
+PUTs of files bigger than piece_size (kwarg, 0 never) use a Content-Range
+resumable upload when the server supports one: a PUT with an empty body
+and "Content-Range: bytes */total" asks how much it already has, it answers
+308 with "Range: bytes=0-n", and the rest is sent piece_size bytes per PUT,
+308 after each until the last. Servers which don't answer 308 get a plain PUT.
+
+GETs with segments (kwarg) greater than 1 start with a HEAD. If the server
+accepts byte ranges and the file is at least two segment_size (kwarg)
+pieces, the download is split into segment_count SegmentGets which are
+queued like any other request and written at their offsets into
+filepath.seg, preallocated to the full size. Once every segment is in the
+size (and the checksum, if the HEAD had a X-Checksum-* or Content-MD5
+header) is verified and filepath.seg renamed to filepath. Otherwise it
+carries on as one GET.
+
+GETs accept every Content-Encoding urllib3 can decode and are decoded into
+the file as they arrive, except byte ranges (a resumed download or a
+segment) which ask for the identity encoding so the offsets are of the file
+itself. PUTs with compress (kwarg, one of ENCODINGS) send files compressible
+decides are worth it with that Content-Encoding, compressed as they are
+sent, unless they are going as a resumable upload. A 415 answer to one
+retries it uncompressed. encoding and encoded are the Content-Encoding and
+the bytes on the wire of a compressed body, encoded is None if it wasn't.
+
 Example:
 
 AsyncGetPush('GET', 'http://foo.com/bar.tgz', '/tmp/bar.tgz', timeout=1)
               ^method  ^url                    ^filepath       ^kwargs
 '''
-class AsyncGetPush(grequests.AsyncRequest):
+class AsyncGetPush(object):
+    #No __dict__, there's one of these per request in flight or kept
+    __slots__ = ('method', 'url', 'filepath', 'response', 'filehandle', 'data',
+            'headers', 'rcode', 'exception', 'attempts', 'retry_after',
+            'latency', 'status', 'bytes', 'dispatched', 'started', 'finished',
+            'headers_at', 'last_byte', 'connection', 'chunk_size', 'piece_size',
+            'segments', 'segment_size', 'timeout', 'auth', 'offset', 'parts',
+            'parent', '_spawned', 'throttle', 'reporter', 'host', 'stream',
+            'probing', 'kwargs', 'size', '_pending', 'compress',
+            'compress_min', 'encoding', 'encoded')
+    #Statuses of a response which did what was asked
+    OK_STATUSES = (200, 201)
 
     def __init__(self, method, url, filepath, **kwargs):
         self.method = method
@@ -34,68 +502,2137 @@ class AsyncGetPush(grequests.AsyncRequest):
         self.filepath = filepath
         self.response = False
         self.filehandle = None
-        self.data = cStringIO.StringIO
+        self.data = None
         self.headers = {}
         self.rcode = 0
+        self.exception = None
+        self.attempts = 0
+        self.retry_after = None
+        self.latency = None
+        #What the last attempt did, see Metrics
+        self.status = 0
+        self.bytes = 0
+        self.dispatched = None
+        self.started = None
+        self.finished = None
+        self.headers_at = None
+        self.last_byte = None
+        self.connection = None
+        self.chunk_size = kwargs.get('chunk_size', CHUNK_SIZE)
+        self.piece_size = kwargs.get('piece_size', 0)
+        self.segments = kwargs.get('segments', 0)
+        self.segment_size = kwargs.get('segment_size', SEGMENT_SIZE)
+        self.timeout = kwargs.get('timeout')
+        self.auth = kwargs.get('auth')
+        self.compress = kwargs.get('compress')
+        self.compress_min = kwargs.get('compress_min', COMPRESS_MIN)
+        self.encoding = None
+        self.encoded = None
+        #Bytes of a partial download already on disk
+        self.offset = 0
+        #The SegmentGets of a segmented download, the one a SegmentGet is of
+        self.parts = []
+        self.parent = None
+        self._spawned = []
+        #A Throttle shared with the other transfers and the Reporter of
+        #the Pipeline making the request, set by the Pipeline
+        self.throttle = None
+        self.reporter = None
+        self.host = urlparse.urlparse(url).hostname
 
-        if 'timeout' in kwargs:
-            self.timeout = kwargs['timeout']
+        #Only GET responses are streamed, HEAD/PUT responses have no body
+        #worth keeping
+        self.stream = self.method == 'GET'
 
-        if 'auth' in kwargs:
-            self.auth = kwargs['auth']
+        #Use a filehandle instead of a filepath, GETs without one are
+        #written to filepath.part and renamed once the download completes
+        self.filehandle = kwargs.pop('filehandle', None)
+
+        #HEAD first to decide whether to split the download
+        self.probing = (self.method == 'GET' and self.segments > 1
+                and self.filehandle is None)
 
         self.construct_request()
 
-        #Use a filehandle instead of a filepath
+    def construct_request(self):
+        self.kwargs = dict(timeout=self.timeout, auth=self.auth,
+                stream=self.stream, hooks=dict(response=self.handle_response))
+        self.offset = 0
+        if self.probing:
+            self.kwargs['stream'] = False
+        elif self.method == 'GET':
+            headers = {'Accept-Encoding': accept_encoding()}
+            if self.filehandle is None:
+                #Carry on from a partial download
+                try:
+                    self.offset = os.stat(self.filepath + '.part').st_size
+                except OSError:
+                    pass
+            if self.offset:
+                headers = {'Range': 'bytes={0}-'.format(self.offset),
+                        'Accept-Encoding': 'identity'}
+                validator = self._validator()
+                if validator:
+                    headers['If-Range'] = validator
+            self.kwargs['headers'] = headers
+        elif self.method == 'HEAD':
+            #The size of the file, not of a compressed copy
+            self.kwargs['headers'] = {'Accept-Encoding': 'identity'}
+        if self.method == 'PUT':
+            #Stream the file, it is opened once the body starts being sent
+            if self.data is not None:
+                self.data.close()
+            self.encoding = None
+            if self._compressing():
+                self.encoding = self.compress
+                self.data = CompressedBody(self.filepath, self.compress, self.chunk_size)
+                self.kwargs['headers'] = {'Content-Encoding': self.compress}
+            else:
+                self.data = LazyFileBody(self.filepath, self.chunk_size)
+            self.data.on_read = self._take
+            self.kwargs['data'] = self.data
 
-        if self.filehandle is None:
-            self.filehandle = kwargs.pop('filehandle', None)
-            if self.filehandle is None and self.method == 'GET':
-                self.filehandle = open(self.filepath, 'wb')
+    #Whether to compress the PUT body, never for a resumable upload
+    def _compressing(self):
+        if not self.compress:
+            return False
+        try:
+            size = os.stat(self.filepath).st_size
+        except OSError:
+            #Fails when it's sent
+            return False
+        if self.piece_size and size > self.piece_size:
+            return False
+        return compressible(self.filepath, size, self.compress_min)
+
+    #Make the request, blocks until the response has been handled so the
+    #engines run this in a greenlet or a worker thread
+    def send(self, session=None):
+        import requests
+        self.attempts += 1
+        self.exception = None
+        self.retry_after = None
+        self.rcode = 0
+        self.latency = None
+        self.status = 0
+        self.bytes = 0
+        self.headers_at = None
+        self.last_byte = None
+        self.connection = None
+        self.encoded = None
+        started = self.started = time.time()
+        close = session is None
+        if close:
+            session = requests.Session()
+            #Hack to turn off ssl certs
+            session.verify = False
+        try:
+            if (self.method == 'PUT' and self.piece_size and self.encoding is None
+                    and len(self.data) > self.piece_size):
+                self._send_pieces(session)
+            else:
+                method, url = self._target()
+                session.request(method, url, **self.kwargs)
+        except Exception as e:
+            self.response = False
+            self.exception = e
+            if self.data is not None:
+                self.data.close()
+        finally:
+            if close:
+                session.close()
+            self.finished = time.time()
+            if self.latency is None:
+                self.latency = self.finished - started
+        return self
+
+    #The method and url of the request on the wire
+    def _target(self):
+        return 'HEAD' if self.probing else self.method, self.url
+
+    '''
+    Resumable upload, ask the server how much of the file it has then send
+    the rest piece_size bytes at a time. The final response (or the first
+    one which isn't a 308) goes through handle_response like any other
+    '''
+    def _send_pieces(self, session):
+        total = len(self.data)
+        r = session.request('PUT', self.url, data='', timeout=self.timeout,
+                auth=self.auth, headers={'Content-Range': 'bytes */{0}'.format(total)})
+        if r.status_code != RESUME_INCOMPLETE:
+            #Not supported, a 2xx here can't be trusted to mean we're done
+            return session.request(self.method, self.url, **self.kwargs)
+
+        offset = uploaded_bytes(r.headers)
+        while offset < total:
+            length = min(self.piece_size, total - offset)
+            self.data = LazyFileBody(self.filepath, self.chunk_size, offset, length)
+            self.data.on_read = self._take
+            r = session.request('PUT', self.url, data=self.data,
+                    timeout=self.timeout, auth=self.auth, headers={'Content-Range':
+                        'bytes {0}-{1}/{2}'.format(offset, offset + length - 1, total)})
+            if r.status_code != RESUME_INCOMPLETE:
+                break
+            received = uploaded_bytes(r.headers)
+            if received <= offset:
+                #No progress, a 308 left over is handled as a failure
+                break
+            offset = received
+        self.handle_response(r)
+
+    #The ETag or Last-Modified of the file a partial download came from
+    def _validator(self):
+        try:
+            fh = open(self.filepath + '.part.validator', 'r')
+            try:
+                return fh.read().strip()
+            finally:
+                fh.close()
+        except IOError:
+            return None
+
+    def _discard_partial(self):
+        for path in (self.filepath + '.part', self.filepath + '.part.validator'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    #Count n more bytes sent or received, waiting for the throttle to allow them
+    def _take(self, n):
+        self.bytes += n
+        self.last_byte = time.time()
+        if self.reporter is not None:
+            self.reporter.transferred(n)
+        if self.throttle is not None:
+            self.throttle.take(self.host, n)
+
+    #Requests to queue because of the last response, before this one is done
+    def spawn(self):
+        spawned, self._spawned = self._spawned, []
+        return spawned
+
+    '''
+    The HEAD of a GET with segments, split the download into SegmentGets
+    if the server allows ranges and the file is big enough, or carry on
+    with a plain GET
+    '''
+    def _probed(self, r):
+        self.probing = False
+        self.response = True
+        size = int(r.headers.get('content-length', 0)) if r.status_code == 200 else 0
+        count = segment_count(size, self.segments, self.segment_size)
+        if r.headers.get('accept-ranges', '').lower() != 'bytes' or count < 2:
+            self.construct_request()
+            #The GET gets as many attempts as if there had been no HEAD
+            self.attempts = 0
+            self._spawned = [self]
+            return
+
+        self.headers = r.headers
+        self.size = size
+        #Preallocate, sparse where the filesystem can
+        fh = open(self.filepath + '.seg', 'wb')
+        fh.truncate(size)
+        fh.close()
+        step = size // count
+        self.parts = []
+        for i in xrange(count):
+            last = size - 1 if i == count - 1 else (i + 1) * step - 1
+            self.parts.append(SegmentGet(self, i * step, last))
+        self._pending = len(self.parts)
+        self._spawned = list(self.parts)
+
+    '''
+    Called as each SegmentGet finishes for good, returns self once the last
+    one has with the response set from the assembled file, otherwise None
+    '''
+    def segment_completed(self, part):
+        self._pending -= 1
+        if not part.response and self.response:
+            self.response = False
+            self.rcode = part.rcode
+            self.exception = part.exception
+        if self._pending:
+            return None
+
+        segpath = self.filepath + '.seg'
+        if self.response:
+            digest = expected_digest(self.headers)
+            if os.stat(segpath).st_size != self.size:
+                self.response = False
+                self.exception = IOError("{0} is {1} bytes, expected {2}".format(
+                    segpath, os.stat(segpath).st_size, self.size))
+            elif digest and file_digest(segpath, digest[0]) != digest[1]:
+                self.response = False
+                self.exception = IOError("{0} of {1} doesn't match the server's".format(
+                    digest[0], self.url))
+        if self.response:
+            os.rename(segpath, self.filepath)
+        elif os.path.exists(segpath):
+            os.unlink(segpath)
+        return self
 
-    def construct_request(self):
-        if self.method == 'GET':
-            self.request = grequests.AsyncRequest(self.method, self.url,
-                    hooks=dict(response=self.handle_response),
-                    timeout=self.timeout, auth=self.auth)
-        elif self.method == 'PUT':
-            self.filehandle = open (self.filepath, 'rb')
-            self.data = self.filehandle.read()
-            self.request = grequests.AsyncRequest(self.method, self.url,
-                    data=self.data, hooks=dict(response=self.handle_response),
-                    timeout=self.timeout, auth=self.auth)
-            self.filehandle.close()
-        else:
-            self.request = grequests.AsyncRequest(self.method, self.url, timeout=self.timeout,
-                    auth=self.auth, hooks=dict(response=self.handle_response))
     #Borked request, requires rerequesting
     def rerequest(self):
         self.construct_request()
 
+    #Drop what was only needed to send the request once it's done for good,
+    #the hooks in kwargs refer back to self so it would wait for the gc
+    def release(self):
+        self.kwargs = None
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.parts = []
+        self._spawned = []
+
+    #Whether the failure is one which could succeed if the request is resent
+    def retryable(self):
+        import requests
+        if self.rcode == 416 and self.offset:
+            #The partial download is no use, it's gone and the next try
+            #starts from the beginning
+            return True
+        if self.rcode == 415 and self.encoding:
+            #Not compressed next time
+            return True
+        if self.rcode:
+            return self.rcode in RETRY_STATUSES
+        return isinstance(self.exception, requests.RequestException)
+
+    #Whether the failure means the server (or the network) is overloaded
+    def congested(self):
+        import requests
+        return (self.rcode in (429, 503)
+                or isinstance(self.exception, requests.Timeout))
+
     #Handle the HTTP response
     def handle_response(self, r, **kwargs):
-        global pbar
-        if r.status_code == 200 or r.status_code == 201:
+        #Time to the response headers, for a GET this excludes the body
+        self.latency = r.elapsed.total_seconds()
+        self.headers_at = time.time()
+        self.status = r.status_code
+        self.connection = connection_timings(r)
+        if self.probing:
+            return self._probed(r)
+        if (r.status_code in self.OK_STATUSES
+                or (r.status_code == 206 and 'Range' in self.kwargs.get('headers', {}))):
             self.headers = r.headers
             self.response = True
         else:
             self.response = False
 
         if self.method == 'GET' and self.response:
-            self.filehandle.write(r.content)
-            self.filehandle.close()
-            pbar.update(pbar.currval+1)
-        #Requests has already read the file contents, close the fh
+            try:
+                self.download(r)
+            except Exception:
+                #The body won't be read now, give the connection back to its
+                #pool (closed) or a blocking pool runs dry
+                r.close()
+                raise
+        #Requests has already streamed the file contents, close the fh
         elif self.method == 'PUT' and self.response:
-            self.data = None
-            self.filehandle.close()
-            pbar.update(pbar.currval+1)
+            if self.encoding is not None:
+                self.encoded = self.data.sent
+            if self.data is not None:
+                self.data.close()
+                self.data = None
         elif not self.response:
             self.rcode = r.status_code
+            self.retry_after = retry_after(r.headers)
+            if self.rcode == 416 and self.offset:
+                self._discard_partial()
+            if self.rcode == 415 and self.encoding:
+                self.compress = None
+            #Read the (streamed) error body so the connection can be reused
+            r.content
+            #Start the body from the beginning if this request is resent
+            if self.data is not None:
+                self.data.close()
             raise Exception("HTTP Request failed with :" + str(r.status_code))
+
+    #Write the streamed response body to disk chunk_size bytes at a time
+    def download(self, r):
+        if self.filehandle is not None:
+            for chunk in r.iter_content(self.chunk_size):
+                self.filehandle.write(chunk)
+                self._take(len(chunk))
+            self.filehandle.close()
+            return
+
+        import requests
+        partpath = self.filepath + '.part'
+        written = 0
+        if r.status_code == 206:
+            span = content_range(r.headers)
+            if span is None or span[0] != self.offset:
+                self._discard_partial()
+                raise requests.ConnectionError("Unexpected Content-Range: " +
+                        str(r.headers.get('content-range')))
+            fh = open(partpath, 'ab')
+            written = self.offset
+            expected = span[2]
         else:
-            pbar.update(pbar.currval+1)
+            #The whole file, the server ignored the Range or it has changed
+            fh = open(partpath, 'wb')
+            validator = r.headers.get('etag') or r.headers.get('last-modified')
+            if validator:
+                vfh = open(partpath + '.validator', 'w')
+                vfh.write(validator)
+                vfh.close()
+            elif os.path.exists(partpath + '.validator'):
+                os.unlink(partpath + '.validator')
+            expected = r.headers.get('content-length')
+            expected = int(expected) if expected else None
+        encoding = r.headers.get('content-encoding', 'identity')
+        try:
+            for chunk in r.iter_content(self.chunk_size):
+                fh.write(chunk)
+                written += len(chunk)
+                self._take(len(chunk))
+        finally:
+            #Whatever arrived is kept, the next attempt carries on from it
+            fh.close()
+        if encoding != 'identity':
+            #The length is of the encoded body, iter_content decodes it
+            self.encoding = encoding
+            self.encoded = r.raw.tell()
+            if expected is not None and self.encoded != expected:
+                raise requests.ConnectionError("Connection closed after {0} of {1} bytes".format(
+                    self.encoded, expected))
+        elif expected is not None and written != expected:
+            raise requests.ConnectionError("Connection closed after {0} of {1} bytes".format(
+                written, expected))
+        #rename is atomic so filepath is either absent/old or complete
+        os.rename(partpath, self.filepath)
+        if os.path.exists(partpath + '.validator'):
+            os.unlink(partpath + '.validator')
+
+'''
+One byte range of a segmented download, see AsyncGetPush
+
+Written straight into the parent's preallocated filepath.seg at its offset,
+each segment through its own filehandle. If-Match stops a file which changes
+on the server mid-download being assembled from two versions.
+
+Args:
+    parent - The AsyncGetPush being downloaded
+    first, last - The (inclusive) byte range
+'''
+class SegmentGet(AsyncGetPush):
+    __slots__ = ('first', 'last', 'etag')
+
+    def __init__(self, parent, first, last):
+        self.first = first
+        self.last = last
+        self.etag = parent.headers.get('etag')
+        AsyncGetPush.__init__(self, 'GET', parent.url, parent.filepath + '.seg',
+                timeout=parent.timeout, auth=parent.auth,
+                chunk_size=parent.chunk_size)
+        self.parent = parent
+        self.throttle = parent.throttle
+        self.reporter = parent.reporter
+
+    def construct_request(self):
+        headers = {'Range': 'bytes={0}-{1}'.format(self.first, self.last),
+                'Accept-Encoding': 'identity'}
+        if self.etag:
+            headers['If-Match'] = self.etag
+        self.kwargs = dict(timeout=self.timeout, auth=self.auth, stream=True,
+                headers=headers, hooks=dict(response=self.handle_response))
+
+    def download(self, r):
+        import requests
+        span = content_range(r.headers)
+        if r.status_code != 206 or span is None or span[:2] != (self.first, self.last):
+            r.close()
+            raise requests.ConnectionError("Expected bytes {0}-{1} of {2}, got {3} {4}".format(
+                self.first, self.last, self.url, r.status_code, r.headers.get('content-range')))
+        written = 0
+        fh = open(self.filepath, 'r+b')
+        try:
+            fh.seek(self.first)
+            for chunk in r.iter_content(self.chunk_size):
+                fh.write(chunk)
+                written += len(chunk)
+                self._take(len(chunk))
+        finally:
+            fh.close()
+        if written != self.last - self.first + 1:
+            raise requests.ConnectionError("Connection closed after {0} of {1} bytes".format(
+                written, self.last - self.first + 1))
+
+
+'''
+A tar archive of files, built as it is read so a PUT can stream it
+
+Only the tar headers are made up front, so the length of the archive is
+known for the Content-Length, the files themselves are read chunk_size bytes
+at a time as the body is sent. A file which shrinks before it's read fails
+the upload rather than corrupting the archive.
+
+Args:
+    members - A list of (name in the archive, filepath)
+    chunk_size - bytes read from disk per iteration
+'''
+class TarBody(object):
+
+    def __init__(self, members, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.members = []
+        length = 0
+        for name, filepath in members:
+            st = os.stat(filepath)
+            info = tarfile.TarInfo(name)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0644
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            self.members.append((header, filepath, st.st_size))
+            length += len(header) + st.st_size + self._padding(st.st_size)
+        #Two empty blocks end the archive, then it's padded to a whole record
+        length += 2 * tarfile.BLOCKSIZE
+        self.trailer = '\0' * (2 * tarfile.BLOCKSIZE
+                + (-length) % tarfile.RECORDSIZE)
+        self.length = length + (-length) % tarfile.RECORDSIZE
+        self._chunks = None
+        self._buffer = ''
+        #Called with the size of every chunk read, eg. to throttle
+        self.on_read = None
+
+    @staticmethod
+    def _padding(size):
+        return (-size) % tarfile.BLOCKSIZE
+
+    def __len__(self):
+        return self.length
 
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def _generate(self):
+        for header, filepath, size in self.members:
+            yield header
+            fh = open(filepath, 'rb')
+            try:
+                remaining = size
+                while remaining:
+                    chunk = fh.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        raise IOError("{0} shrank while being archived".format(filepath))
+                    remaining -= len(chunk)
+                    yield chunk
+            finally:
+                fh.close()
+            yield '\0' * self._padding(size)
+        yield self.trailer
+
+    def read(self, size=-1):
+        if self._chunks is None:
+            self._chunks = self._generate()
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        if chunk and self.on_read is not None:
+            self.on_read(len(chunk))
+        return chunk
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+        self._buffer = ''
+
+'''
+A PUT of many small files as one tar archive which the server unpacks, eg.
+Artifactory's "X-Explode-Archive: true" deploy
+
+The archive is streamed (see TarBody) to url, which should be a file in the
+directory the members are unpacked into, each member named by its path
+relative to there.
+
+Args:
+    url - Where the archive is PUT
+    members - A list of (name in the archive, filepath)
+    headers - Headers telling the server to unpack it
+    kwargs - As AsyncGetPush
+
+Example:
+
+BundlePut('https://foo.com/repo/bundle-1.tar', [('org/foo/1.0/foo-1.0.pom', '/tmp/foo-1.0.pom')],
+          {'X-Explode-Archive': 'true'}, timeout=90)
+'''
+class BundlePut(AsyncGetPush):
+    __slots__ = ('members', 'extract_headers')
+
+    def __init__(self, url, members, headers, **kwargs):
+        self.members = members
+        self.extract_headers = headers
+        AsyncGetPush.__init__(self, 'PUT', url, None, **kwargs)
+
+    def construct_request(self):
+        if self.data is not None:
+            self.data.close()
+        self.data = TarBody(self.members, self.chunk_size)
+        self.data.on_read = self._take
+        self.kwargs = dict(timeout=self.timeout, auth=self.auth, stream=False,
+                data=self.data, headers=dict(self.extract_headers),
+                hooks=dict(response=self.handle_response))
+
+#How LinkedPut has the server make a file from content it already has
+LINK_METHODS = ('copy', 'checksum')
+
+'''
+A PUT of a file whose content the server already has, made on the server
+from that content instead of sending the file again
+
+With how='copy' it is a WebDAV COPY of source (a url the server has the same
+content at) with a Destination of url. With how='checksum' it is a checksum
+deploy (eg. Artifactory's), a PUT to url with no body and the file's sha256
+in X-Checksum-Sha256, which the server answers with a 201 if it has content
+with that digest. No file data is sent either way. A server which can't do
+it answers with an error (eg. 404, 405 or 501) and the file should be
+uploaded as usual.
+
+Args:
+    url - Where the file goes
+    filepath - The local copy of the file
+    how - One of LINK_METHODS
+    source - A url of the same content on the server, for copy
+    checksum - The sha256 of the file, for checksum
+    kwargs - As AsyncGetPush, without piece_size or compress
+
+Example:
+
+LinkedPut('https://foo.com/repo/b/foo.jar', '/tmp/foo.jar', 'copy',
+          source='https://foo.com/repo/a/foo.jar', timeout=90)
+'''
+class LinkedPut(AsyncGetPush):
+    __slots__ = ('how', 'source', 'checksum')
+    #A COPY over an existing file answers 204
+    OK_STATUSES = (200, 201, 204)
+
+    def __init__(self, url, filepath, how, source=None, checksum=None, **kwargs):
+        self.how = how
+        self.source = source
+        self.checksum = checksum
+        kwargs.update(piece_size=0, compress=None)
+        AsyncGetPush.__init__(self, 'PUT', url, filepath, **kwargs)
+
+    def construct_request(self):
+        if self.how == 'copy':
+            headers = {'Destination': self.url, 'Overwrite': 'T'}
+        else:
+            headers = {'X-Checksum-Deploy': 'true', 'X-Checksum-Sha256': self.checksum}
+        self.kwargs = dict(timeout=self.timeout, auth=self.auth, stream=False,
+                headers=headers, hooks=dict(response=self.handle_response))
+
+    def _target(self):
+        if self.how == 'copy':
+            return 'COPY', self.source
+        return self.method, self.url
+
+#urllib3 pool classes which time new connections, see timed_pool_classes
+_TIMED_POOLS = None
+
+'''
+urllib3 connection pool classes whose new connections time themselves
+
+A new connection records how long the DNS lookup, the TCP connect and (for
+https) the TLS handshake took in its timings dictionary, which
+connection_timings hands to the first response over it. The host is looked
+up once and the connection made to its first address.
+
+Returns a dictionary of scheme : pool class, for a PoolManager's
+pool_classes_by_scheme
+'''
+def timed_pool_classes():
+    global _TIMED_POOLS
+    if _TIMED_POOLS is not None:
+        return _TIMED_POOLS
+    import socket
+    from requests.packages.urllib3 import connection, connectionpool
+
+    class TimedConnection(object):
+        timings = None
+        secure = False
+
+        def _new_conn(self):
+            started = time.time()
+            host = getattr(self, '_dns_host', None)
+            if host is not None:
+                try:
+                    self._dns_host = socket.getaddrinfo(host, self.port, 0,
+                            socket.SOCK_STREAM)[0][4][0]
+                except socket.error:
+                    #Left to fail the usual way
+                    pass
+            resolved = time.time()
+            try:
+                return super(TimedConnection, self)._new_conn()
+            finally:
+                if host is not None:
+                    self._dns_host = host
+                self.timings = {'dns': resolved - started,
+                        'connect': time.time() - resolved, 'tls': 0.0}
+
+        def connect(self):
+            started = time.time()
+            super(TimedConnection, self).connect()
+            if self.secure and self.timings is not None:
+                self.timings['tls'] = max(0.0, time.time() - started
+                        - self.timings['dns'] - self.timings['connect'])
+
+    class TimedHTTPConnection(TimedConnection, connection.HTTPConnection):
+        pass
+
+    class TimedHTTPSConnection(TimedConnection, connection.HTTPSConnection):
+        secure = True
+
+    class TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    _TIMED_POOLS = {'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool}
+    return _TIMED_POOLS
+
+'''
+Subclasses of the urllib3 pool classes (a dictionary of scheme : pool class)
+which wait at most pool_timeout seconds for a free connection of a full
+blocking pool. requests never gives urllib3 a pool timeout so otherwise a
+connection which is never handed back leaves every request after it waiting
+forever once the rest are in use, this way they fail (with urllib3's
+EmptyPoolError) instead.
+
+They also count the connections taken in num_taken, one for every request.
+urllib3's num_requests misses the requests with a chunked body (eg. a
+CompressedBody), requests sends those over a connection of the pool itself
+rather than through urlopen.
+
+queue_class, if given, replaces the queue the pools keep their connections
+in, see pool_queue_class.
+
+Returns a dictionary of scheme : pool class, for a PoolManager's
+pool_classes_by_scheme
+'''
+def waiting_pool_classes(classes, pool_timeout, queue_class=None):
+    waiting = {}
+    for scheme, cls in classes.iteritems():
+        def _get_conn(self, timeout=None, cls=cls):
+            conn = cls._get_conn(self, pool_timeout if timeout is None else timeout)
+            self.num_taken += 1
+            return conn
+        attrs = {'_get_conn': _get_conn, 'num_taken': 0}
+        if queue_class is not None:
+            attrs['QueueCls'] = queue_class
+        waiting[scheme] = type('Waiting' + cls.__name__, (cls,), attrs)
+    return waiting
+
+#The queue for urllib3 pools to keep their connections in, None for their
+#own. Once the gevent engine has patched the process it's gevent's: the
+#gevent engine doesn't patch threading, so a greenlet waiting for a free
+#connection in urllib3's queue (real threading locks) would stall the hub
+def pool_queue_class():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('socket'):
+        return None
+    import gevent.queue
+    return gevent.queue.LifoQueue
+
+#Timings of the connection r came over if it was opened for r, None if it
+#was reused or wasn't timed
+def connection_timings(r):
+    conn = getattr(r.raw, '_connection', None)
+    timings = getattr(conn, 'timings', None)
+    if timings is not None:
+        conn.timings = None
+    return timings
+
+#The most streams sent at once over one HTTP/2 connection, fewer if the
+#server says so
+H2_MAX_STREAMS = 100
+
+#Headers which only mean something to HTTP/1.1, dropped from HTTP/2 requests
+H2_SKIP_HEADERS = frozenset(('connection', 'host', 'keep-alive',
+    'proxy-connection', 'transfer-encoding', 'upgrade'))
+
+#requests adapter class for HTTP/2, see http2_adapter_class
+_HTTP2_ADAPTER = None
+
+'''
+A requests transport adapter class which makes its requests over HTTP/2
+with hyper
+
+Requests to a host are streams multiplexed over as few connections as the
+server's limit on concurrent streams (at most H2_MAX_STREAMS) allows, up to
+maxconns of them. A new stream goes on the connection with the fewest body
+bytes still to send, then the fewest streams, so small requests aren't
+queued behind a large upload's share of the connection window. Bodies are
+sent a frame at a time, never more than the flow control windows allow, and
+the connection is only held for each frame so the streams on it take turns
+rather than one body going out whole before anything else. While a window
+is shut the upload reads from the connection until the server opens it.
+
+https negotiates h2 by ALPN and http speaks HTTP/2 from the start (prior
+knowledge), neither falls back to HTTP/1.1. Only gzip is asked for, the
+encoding decoded here. Needs hyper 0.7 (and h2 2.x), which is only imported
+when this is first called, after the gevent engine has patched the process.
+
+Returns the adapter class, made with (maxconns, block), where block waits
+for a stream once maxconns connections are full rather than opening an
+extra connection, closed once its streams are done (as ConnectionPool).
+With the gevent engine the wait is a greenlet's
+'''
+def http2_adapter_class():
+    global _HTTP2_ADAPTER
+    if _HTTP2_ADAPTER is not None:
+        return _HTTP2_ADAPTER
+    import socket
+    import ssl
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+    from hyper import HTTP20Connection
+    from hyper.tls import init_context
+    from hyper.http20.exceptions import StreamResetError
+
+    #A condition for greenlets, threading.Condition's waiters are real locks
+    class GreenCondition(object):
+
+        def __init__(self):
+            import gevent.lock
+            self._lock = gevent.lock.Semaphore()
+            self._waiters = []
+
+        def __enter__(self):
+            self._lock.acquire()
+
+        def __exit__(self, *exc_info):
+            self._lock.release()
+
+        def wait(self):
+            import gevent.event
+            waiter = gevent.event.Event()
+            self._waiters.append(waiter)
+            self._lock.release()
+            try:
+                waiter.wait()
+            finally:
+                self._lock.acquire()
+
+        def notify_all(self):
+            waiters, self._waiters = self._waiters, []
+            for waiter in waiters:
+                waiter.set()
+
+    #hyper's locks are threading's, which greenlets of one thread all hold
+    #at once, the gevent engine needs gevent's. So does the adapter's own
+    #condition, which waits for a free stream
+    RLock = threading.RLock
+    Condition = lambda: threading.Condition(threading.Lock())
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            import gevent.lock
+            RLock = gevent.lock.RLock
+            Condition = GreenCondition
+    except ImportError:
+        pass
+
+    #A response body as requests reads it, counting the bytes as they came
+    class Http2Body(object):
+
+        def __init__(self, resp):
+            self._resp = resp
+            self._done = False
+            self._received = 0
+            self._decoder = None
+            if 'gzip' in resp.headers.get('content-encoding', []):
+                self._decoder = zlib.decompressobj(31)
+
+        def read(self, amt=None, decode_content=True):
+            while not self._done:
+                data = self._resp.read(amt, decode_content=False)
+                self._done = amt is None or len(data) < amt
+                self._received += len(data)
+                if self._decoder is not None and decode_content:
+                    data = self._decoder.decompress(data)
+                    if self._done:
+                        data += self._decoder.flush()
+                if data or self._done:
+                    return data
+            return ''
+
+        #Bytes of the body received, as sent before any decoding
+        def tell(self):
+            return self._received
+
+        def release_conn(self):
+            pass
+
+        def close(self):
+            if not self._done:
+                self._done = True
+                self._resp.close()
+
+    class Http2Adapter(requests.adapters.BaseAdapter):
+
+        def __init__(self, maxconns=10, block=False):
+            requests.adapters.BaseAdapter.__init__(self)
+            self.maxconns = maxconns
+            self.block = block
+            #(host, port, scheme) : [[HTTP20Connection, streams, bytes unsent,
+            #closed once idle]...]
+            self.pools = {}
+            #Requests made and connections opened to make them
+            self.requests = 0
+            self.opened = 0
+            self._room = Condition()
+
+        #The connection for a stream with size bytes of body to send
+        def _acquire(self, host, port, scheme, size, verify):
+            with self._room:
+                pool = self.pools.setdefault((host, port, scheme), [])
+                while True:
+                    free = [slot for slot in pool if slot[1] < self._streams(slot[0])]
+                    if free:
+                        slot = min(free, key=lambda slot: (slot[2], slot[1]))
+                        break
+                    if len(pool) < self.maxconns or not self.block:
+                        slot = [self._connection(host, port, scheme, verify), 0, 0,
+                                len(pool) >= self.maxconns]
+                        pool.append(slot)
+                        self.opened += 1
+                        break
+                    self._room.wait()
+                slot[1] += 1
+                slot[2] += size
+                self.requests += 1
+                return slot
+
+        @staticmethod
+        def _streams(conn):
+            try:
+                with conn._conn as h2conn:
+                    return min(H2_MAX_STREAMS, h2conn.remote_settings.max_concurrent_streams)
+            except AttributeError:
+                return H2_MAX_STREAMS
+
+        def _connection(self, host, port, scheme, verify):
+            context = None
+            if scheme == 'https':
+                context = init_context(verify if isinstance(verify, basestring) else None)
+                if not verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+            conn = HTTP20Connection(host, port, secure=scheme == 'https',
+                    ssl_context=context)
+            if RLock is not threading.RLock:
+                conn._lock = RLock()
+                conn._write_lock = RLock()
+                conn._read_lock = RLock()
+                conn._conn.lock = RLock()
+            return conn
+
+        def _release(self, slot, unsent, broken):
+            with self._room:
+                slot[1] -= 1
+                slot[2] = max(0, slot[2] - unsent)
+                if broken or (slot[3] and not slot[1]):
+                    for pool in self.pools.itervalues():
+                        pool[:] = [other for other in pool if other is not slot]
+                    slot[0].close()
+                self._room.notify_all()
+
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+                proxies=None):
+            parsed = urlparse.urlparse(request.url)
+            secure = parsed.scheme == 'https'
+            body = request.body
+            size = len(body) if body is not None and hasattr(body, '__len__') else CHUNK_SIZE
+            slot = self._acquire(parsed.hostname, parsed.port or (443 if secure else 80),
+                    parsed.scheme, size if body else 0, verify)
+            conn = slot[0]
+            unsent = size if body else 0
+            broken = True
+            try:
+                conn.connect()
+                if isinstance(timeout, tuple):
+                    timeout = timeout[-1]
+                conn._sock.settimeout(timeout)
+                selector = parsed.path or '/'
+                if parsed.query:
+                    selector += '?' + parsed.query
+                with conn._write_lock:
+                    stream_id = conn.putrequest(request.method, selector)
+                    for name, value in request.headers.iteritems():
+                        if name.lower() in H2_SKIP_HEADERS:
+                            continue
+                        if name.lower() == 'accept-encoding' and value != 'identity':
+                            value = 'gzip'
+                        conn.putheader(name, value, stream_id)
+                    conn.endheaders(final=not body, stream_id=stream_id)
+                if body:
+                    for sent in self._send_body(conn, stream_id, body):
+                        with self._room:
+                            slot[2] = max(0, slot[2] - sent)
+                        unsent = max(0, unsent - sent)
+                resp = conn.get_response(stream_id)
+                broken = False
+            except StreamResetError as e:
+                broken = False
+                raise requests.ConnectionError(e, request=request)
+            except socket.timeout as e:
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except Exception as e:
+                raise requests.ConnectionError(e, request=request)
+            finally:
+                self._release(slot, unsent, broken)
+
+            response = requests.Response()
+            response.status_code = resp.status
+            response.headers = CaseInsensitiveDict(resp.headers.iter_raw())
+            response.encoding = get_encoding_from_headers(response.headers)
+            response.raw = Http2Body(resp)
+            response.reason = ''
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            if not stream:
+                response.content
+            return response
+
+        #Send body a frame at a time as the windows allow, yields the bytes sent
+        def _send_body(self, conn, stream_id, body):
+            for chunk in [body] if isinstance(body, basestring) else body:
+                while chunk:
+                    with conn._write_lock:
+                        with conn._conn as h2conn:
+                            n = min(len(chunk), h2conn.max_outbound_frame_size,
+                                    h2conn.local_flow_control_window(stream_id))
+                            if n > 0:
+                                h2conn.send_data(stream_id, chunk[:n])
+                        if n > 0:
+                            conn._send_outstanding_data()
+                    if n <= 0:
+                        #Read until the server opens the window
+                        conn._recv_cb(stream_id)
+                        continue
+                    chunk = chunk[n:]
+                    yield n
+            with conn._write_lock:
+                with conn._conn as h2conn:
+                    h2conn.end_stream(stream_id)
+                conn._send_outstanding_data()
+
+        def close(self):
+            with self._room:
+                for pool in self.pools.itervalues():
+                    for slot in pool:
+                        slot[0].close()
+                self.pools = {}
+
+    _HTTP2_ADAPTER = Http2Adapter
+    return _HTTP2_ADAPTER
+
+'''
+Keep-alive connections shared by every request made through it
+
+One of these can be handed to any number of HttpGrabberPushers so
+connections (and TLS sessions) opened for one batch are reused by the next
+rather than each request opening its own. The requests session is only built
+when the first request is sent, requests can't be imported before the gevent
+engine has monkey patched the process.
+
+Args:
+    maxconns - The most connections kept open to each host
+    block - Wait for a free connection when maxconns are in use, otherwise
+            open an extra connection and close it once the request is done.
+            With the gevent engine the wait is a greenlet's, see
+            pool_queue_class
+    pool_timeout - The most seconds block waits for a free connection
+    verify - Verify ssl certificates
+    timed - Time the DNS lookup, connect and TLS handshake of every new
+            connection for Metrics, see timed_pool_classes
+    http2 - Make the requests over HTTP/2 with hyper, many at once over
+            each connection, see http2_adapter_class. timed doesn't apply
+
+Example:
+
+    connections = asyncfetchpush.ConnectionPool(maxconns=20)
+    puts = asyncfetchpush.HttpGrabberPusher('PUT', files, connections=connections)
+    heads = asyncfetchpush.HttpGrabberPusher('HEAD', files, connections=connections)
+    ...
+    print connections.reuse_ratio()
+'''
+class ConnectionPool(object):
+
+    def __init__(self, maxconns=10, block=True, verify=False, timed=False, http2=False,
+            pool_timeout=POOL_TIMEOUT):
+        self.maxconns = maxconns
+        self.block = block
+        self.pool_timeout = pool_timeout
+        self.verify = verify
+        self.timed = timed
+        self.http2 = http2
+        self._session = None
+        self._adapter = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                import requests
+                if self.http2:
+                    self._adapter = http2_adapter_class()(self.maxconns, self.block)
+                else:
+                    self._adapter = requests.adapters.HTTPAdapter(
+                            pool_maxsize=self.maxconns, pool_block=self.block)
+                if not self.http2:
+                    poolmanager = self._adapter.poolmanager
+                    poolmanager.pool_classes_by_scheme = waiting_pool_classes(
+                            timed_pool_classes() if self.timed
+                            else poolmanager.pool_classes_by_scheme, self.pool_timeout,
+                            pool_queue_class())
+                self._session = requests.Session()
+                self._session.verify = self.verify
+                self._session.mount('http://', self._adapter)
+                self._session.mount('https://', self._adapter)
+            return self._session
+
+    def _host_pools(self):
+        if self._adapter is None or self.http2:
+            return []
+        pools = self._adapter.poolmanager.pools
+        return [pools[key] for key in pools.keys()]
+
+    #Number of requests made and connections opened to make them
+    def stats(self):
+        if self.http2 and self._adapter is not None:
+            return self._adapter.requests, self._adapter.opened
+        requests = 0
+        connections = 0
+        for pool in self._host_pools():
+            requests += pool.num_taken
+            connections += pool.num_connections
+        return requests, connections
+
+    #Fraction of requests which went over an already open connection
+    def reuse_ratio(self):
+        requests, connections = self.stats()
+        if not requests:
+            return 0.0
+        return max(requests - connections, 0) / float(requests)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+
+'''
+Adapts the number of requests in flight to what the server can take
+
+Additive increase, multiplicative decrease. Every window of completed
+requests (at least window, or the current limit if that is larger) the
+limit is raised by sqrt(limit) if throughput went up by 5% or more while
+latency stayed within tolerance of the baseline. The baseline is the lowest
+median latency of the last history windows, so it follows the server from
+off-peak to peak without chasing the latency the limit itself causes. The
+limit is cut by decrease if latency has grown past that, or straight away
+when a request gets a 429/503 or times out, at most once per window.
+
+Every change is kept in decisions and summarised by metrics().
+
+Args:
+    initial - The limit to start at
+    minimum - The limit never drops below this
+    maximum - The limit never rises above this
+    window - The fewest completed requests to base a decision on
+    tolerance - Latency may grow to tolerance * baseline before backing off
+    decrease - The limit is multiplied by this when backing off
+    history - The number of windows the baseline latency is taken from
+
+Example:
+
+    limiter = asyncfetchpush.ConcurrencyLimiter(initial=16, maximum=250)
+    requests = asyncfetchpush.HttpGrabberPusher('PUT', files, limit=250, limiter=limiter)
+    requests.make_requests()
+    print limiter.metrics()
+'''
+class ConcurrencyLimiter(object):
+
+    def __init__(self, initial=16, minimum=1, maximum=250, window=20,
+                tolerance=1.5, decrease=0.5, history=30):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.window = window
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.baseline = None
+        self._latencies = deque(maxlen=history)
+        self.latency = None
+        self.throughput = 0.0
+        self.decisions = []
+        self._samples = []
+        self._congested = False
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+
+    #Called with each finished request
+    def record(self, latency, congested=False):
+        with self._lock:
+            if congested and not self._congested:
+                #Once per window, a burst of errors is one signal not many
+                self._congested = True
+                self._change(int(self.limit * self.decrease), 'congestion')
+            if latency is not None:
+                self._samples.append(latency)
+            if len(self._samples) >= max(self.window, self.limit):
+                self._evaluate()
+
+    def _evaluate(self):
+        now = time.time()
+        samples = sorted(self._samples)
+        latency = samples[len(samples) / 2]
+        throughput = len(samples) / max(now - self._window_start, 1e-6)
+
+        self._latencies.append(latency)
+        self.baseline = min(self._latencies)
+
+        if latency > self.baseline * self.tolerance:
+            self._change(int(self.limit * self.decrease), 'latency')
+        elif throughput >= self.throughput * 1.05 and not self._congested:
+            self._change(self.limit + max(int(self.limit ** 0.5), 1), 'throughput')
+
+        self.latency = latency
+        self.throughput = throughput
+        self._samples = []
+        self._congested = False
+        self._window_start = now
+
+    def _change(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if limit == self.limit:
+            return
+        self.decisions.append({'timestamp': time.time(), 'from': self.limit,
+            'to': limit, 'reason': reason, 'latency': self.latency,
+            'throughput': self.throughput})
+        self.limit = limit
+
+    def metrics(self):
+        with self._lock:
+            return {'limit': self.limit,
+                    'minimum': self.minimum,
+                    'maximum': self.maximum,
+                    'baseline_latency': self.baseline,
+                    'latency': self.latency,
+                    'throughput': self.throughput,
+                    'increases': len([d for d in self.decisions if d['to'] > d['from']]),
+                    'decreases': len([d for d in self.decisions if d['to'] < d['from']])}
+
+'''
+Follows the progress of the requests a Pipeline makes, in requests and bytes
+
+The engines report from greenlets and worker threads as bytes move and
+requests finish, so reporting only appends the event to a deque (atomic in
+CPython) and never waits on a lock. The events are folded into the counts
+by whichever caller gets there first, which also draws the progress if it
+hasn't been for refresh seconds, the others carry on without waiting for it.
+
+This class draws nothing, for quiet runs or to embed and read the counts
+from. Subclasses override draw, see ProgressBarReporter and LogReporter.
+
+Args:
+    refresh - The most seconds between redraws
+
+Example:
+
+    reporter = asyncfetchpush.LogReporter(refresh=60)
+    requests = asyncfetchpush.HttpGrabberPusher('GET', files, reporter=reporter)
+    requests.make_requests()
+    print reporter.requests, reporter.failed, reporter.bytes
+'''
+class Reporter(object):
+
+    def __init__(self, refresh=0.5):
+        self.refresh = refresh
+        self.total = 0
+        self.requests = 0
+        self.failed = 0
+        self.bytes = 0
+        #Attempts which failed and are being made again
+        self.retried = 0
+        self.started = time.time()
+        self._drawn = 0
+        self._events = deque()
+        self._drawing = threading.Lock()
+
+    #Called with the number of requests about to be made
+    def start(self, total):
+        self._events.clear()
+        self.total = total
+        self.requests = self.failed = self.bytes = self.retried = 0
+        self.started = time.time()
+        self._drawn = 0
+        self._update()
+
+    #More requests were queued, eg. follow-ups
+    def expect(self, n):
+        self._events.append((n, 0, 0, 0, 0))
+        self._update()
+
+    def transferred(self, n):
+        self._events.append((0, 0, 0, n, 0))
+        self._update()
+
+    #A request finished for good
+    def completed(self, r):
+        self._events.append((0, 1, 0 if r.response else 1, 0, 0))
+        self._update()
+
+    #A request failed and is made again in delay seconds
+    def retrying(self, r, delay):
+        self._events.append((0, 0, 0, 0, 1))
+        self._update()
+
+    #Counts from elsewhere, eg. a worker process's ChannelReporter
+    def counted(self, total, requests, failed, n, retried=0):
+        self._events.append((total, requests, failed, n, retried))
+        self._update()
+
+    def finish(self):
+        with self._drawing:
+            self._fold()
+            self.draw(True)
+
+    #The events are folded into the totals as they come, not only when a
+    #redraw is due, so the deque holds no more than the events queued while
+    #another thread is folding, however many bytes go by between redraws
+    def _update(self):
+        if not self._drawing.acquire(False):
+            return
+        try:
+            self._fold()
+            if time.time() - self._drawn >= self.refresh:
+                self._drawn = time.time()
+                self.draw(False)
+        finally:
+            self._drawing.release()
+
+    def _fold(self):
+        events = self._events
+        while events:
+            total, requests, failed, byteses, retried = events.popleft()
+            self.total += total
+            self.requests += requests
+            self.failed += failed
+            self.bytes += byteses
+            self.retried += retried
+
+    #Bytes per second since the start
+    def rate(self):
+        return self.bytes / max(time.time() - self.started, 1e-6)
+
+    def draw(self, final):
+        pass
+
+'''
+A progress bar of the requests done, with the bytes transferred and the
+rate, redrawn on stderr at most every refresh seconds
+'''
+class ProgressBarReporter(Reporter):
+
+    def __init__(self, refresh=0.2, term_width=80):
+        Reporter.__init__(self, refresh)
+        self.term_width = term_width
+        self.bar = None
+
+    def start(self, total):
+        self.bar = progressbar.ProgressBar(
+                            widgets=[
+                                progressbar.Bar(),
+                                progressbar.Percentage(),
+                                ' reqs ',
+                                progressbar.SimpleProgress(),
+                                ' ',
+                                _TransferWidget(self)
+                                ],
+                            maxval=max(total, 1),
+                            term_width=self.term_width,
+                            poll=self.refresh).start()
+        Reporter.start(self, total)
+
+    def draw(self, final):
+        if self.bar is None:
+            return
+        self.bar.maxval = max(self.total, self.requests, 1)
+        self.bar.update(self.requests)
+        if final:
+            self.bar.finish()
+            self.bar = None
+
+class _TransferWidget(progressbar.Widget):
+    TIME_SENSITIVE = True
+
+    def __init__(self, reporter):
+        self.reporter = reporter
+
+    def update(self, pbar):
+        return "{0} {1}/s".format(size_to_string(self.reporter.bytes),
+                size_to_string(self.reporter.rate()))
+
+'''
+A line of progress every refresh seconds and one when the requests are
+done, for runs without a terminal such as cron jobs
+'''
+class LogReporter(Reporter):
+
+    def __init__(self, refresh=30.0, stream=None):
+        Reporter.__init__(self, refresh)
+        self.stream = stream if stream is not None else sys.stdout
+
+    def draw(self, final):
+        if not final and not self.requests and not self.bytes:
+            return
+        errors = ", ".join(text.format(n) for text, n in
+                (("{0} failed", self.failed), ("{0} retried", self.retried)) if n)
+        self.stream.write("{0} {1} of {2} requests{3}, {4} at {5}/s\n".format(
+            "Done:" if final else time.strftime("%H:%M:%S"),
+            self.requests, self.total,
+            " ({0})".format(errors) if errors else "",
+            size_to_string(self.bytes), size_to_string(self.rate())))
+        self.stream.flush()
+
+#The Reporter used when none is given, a bar on a terminal
+def default_reporter():
+    if sys.stderr.isatty():
+        return ProgressBarReporter()
+    return LogReporter()
+
+'''
+Timings and counters of every transfer, written as json lines and/or a
+Prometheus text file
+
+record() is called with every finished attempt of a request, with requests
+set each gets a json line:
+
+    {"type": "request", "url": "https://foo.com/bar.jar", "method": "GET",
+     "status": 200, "attempt": 1, "bytes": 152364, "error": null,
+     "wait": 0.0001, "dns": 0.002, "connect": 0.01, "tls": 0.03,
+     "ttfb": 0.05, "transfer": 0.2, "total": 0.29}
+
+dns, connect and tls are 0 when the request went over a connection which
+was already open (or the ConnectionPool isn't timed). wait is the time from
+the engine taking the request off the queue to sending it, our own
+scheduling. For a GET ttfb is from sending the request to the response
+headers and transfer is reading the body, for a PUT transfer is sending the
+body and ttfb is from its last byte to the response, the time the server
+took over it. Time spent outside the transfers, eg. walking or hashing
+files, is recorded with stage().
+
+Every interval seconds, and on close, a snapshot of the counters (requests
+by method and status, errors by class, retries, bytes, throughput, requests
+in flight and queued, average timings, stages) is written as a json line
+and the Prometheus text file is rewritten, eg. for node_exporter's textfile
+collector. The time spent in record() itself is counted as overhead.
+
+Args:
+    path - The json lines file, optional
+    promfile - The Prometheus text file, optional
+    interval - Seconds between snapshots
+    requests - Write a line per request attempt as well as the snapshots
+
+Example:
+
+    metrics = asyncfetchpush.Metrics('async.metrics.ndjson', 'async.prom')
+    requests = asyncfetchpush.HttpGrabberPusher('GET', files, metrics=metrics)
+    requests.make_requests()
+    metrics.close()
+'''
+class Metrics(object):
+
+    TIMINGS = ('wait', 'dns', 'connect', 'tls', 'ttfb', 'transfer', 'total')
+
+    def __init__(self, path=None, promfile=None, interval=10.0, requests=True):
+        self.path = path
+        self.promfile = promfile
+        self.interval = interval
+        self.requests = requests
+        #Called for the gauges of whatever is making the requests
+        self.gauges = None
+        self.statuses = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.retries = 0
+        self.sums = dict((name, 0.0) for name in self.TIMINGS)
+        self.counts = dict((name, 0) for name in self.TIMINGS)
+        self.stages = OrderedDict()
+        self.overhead = 0.0
+        self.start = time.time()
+        self._last = (self.start, 0)
+        self._fh = open(path, 'a') if path else None
+        self._lock = threading.Lock()
+
+    def stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @staticmethod
+    def error(r):
+        if r.response:
+            return None
+        if r.rcode:
+            return "http_{0}".format(r.rcode)
+        if r.exception is not None:
+            return type(r.exception).__name__
+        return "unknown"
+
+    #The timings of r's last attempt, None for those it didn't get to
+    @staticmethod
+    def timings(r):
+        finished = r.finished or time.time()
+        started = r.started or finished
+        setup = r.connection or {}
+        timings = {'wait': max(0.0, started - r.dispatched) if r.dispatched else 0.0,
+                'dns': setup.get('dns', 0.0), 'connect': setup.get('connect', 0.0),
+                'tls': setup.get('tls', 0.0), 'total': finished - started,
+                'ttfb': None, 'transfer': None}
+        ready = started + timings['dns'] + timings['connect'] + timings['tls']
+        if r.headers_at is None:
+            pass
+        elif r.method == 'PUT' and r.last_byte:
+            timings['transfer'] = max(0.0, r.last_byte - ready)
+            timings['ttfb'] = max(0.0, r.headers_at - r.last_byte)
+        else:
+            timings['ttfb'] = max(0.0, r.headers_at - ready)
+            timings['transfer'] = max(0.0, finished - r.headers_at)
+        return timings
+
+    #Called with every finished attempt
+    def record(self, r):
+        began = time.time()
+        timings = self.timings(r)
+        error = self.error(r)
+        with self._lock:
+            self.statuses[(r.method, r.status)] += 1
+            self.bytes[r.method] += r.bytes
+            if error:
+                self.errors[error] += 1
+            if r.attempts > 1:
+                self.retries += 1
+            for name, value in timings.iteritems():
+                if value is not None:
+                    self.sums[name] += value
+                    self.counts[name] += 1
+            if self._fh is not None and self.requests:
+                line = {'type': 'request', 'url': r.url, 'method': r.method,
+                        'status': r.status, 'attempt': r.attempts,
+                        'bytes': r.bytes, 'error': error}
+                line.update(timings)
+                self._fh.write(json.dumps(line) + "\n")
+            self.overhead += time.time() - began
+        if began - self._last[0] >= self.interval:
+            self.snapshot()
+
+    def snapshot(self):
+        gauges = self.gauges() if self.gauges is not None else {}
+        with self._lock:
+            now = time.time()
+            total = sum(self.bytes.itervalues())
+            count = sum(self.statuses.itervalues())
+            since, before = self._last
+            self._last = (now, total)
+            snap = {'type': 'snapshot', 'timestamp': now,
+                    'elapsed': now - self.start,
+                    'requests': count,
+                    'failed': sum(self.errors.itervalues()),
+                    'retries': self.retries,
+                    'bytes': total,
+                    'requests_per_second': count / max(now - self.start, 1e-6),
+                    'bytes_per_second': total / max(now - self.start, 1e-6),
+                    'recent_bytes_per_second': (total - before) / max(now - since, 1e-6),
+                    'in_flight': gauges.get('in_flight', 0),
+                    'queue_depth': gauges.get('queue_depth', 0),
+                    'statuses': dict(("{0} {1}".format(method, status), n)
+                        for (method, status), n in self.statuses.iteritems()),
+                    'errors': dict(self.errors),
+                    'bytes_by_method': dict(self.bytes),
+                    'timings': self.averages(),
+                    'stages': dict(self.stages),
+                    'overhead': self.overhead}
+            if self._fh is not None:
+                self._fh.write(json.dumps(snap) + "\n")
+                self._fh.flush()
+            if self.promfile:
+                self._write_prometheus(snap)
+        return snap
+
+    #The counters, for merge into the Metrics of eg. a coordinating process
+    def counters(self):
+        with self._lock:
+            return {'statuses': dict(self.statuses), 'errors': dict(self.errors),
+                    'bytes': dict(self.bytes), 'retries': self.retries,
+                    'sums': dict(self.sums), 'counts': dict(self.counts),
+                    'overhead': self.overhead}
+
+    #Add the counters of another Metrics to these
+    def merge(self, counters):
+        with self._lock:
+            for name in ('statuses', 'errors', 'bytes', 'sums', 'counts'):
+                mine = getattr(self, name)
+                for key, value in counters[name].iteritems():
+                    mine[key] = mine.get(key, 0) + value
+            self.retries += counters['retries']
+            self.overhead += counters['overhead']
+
+    #Mean seconds of each timing over the attempts which got that far
+    def averages(self):
+        return dict((name, self.sums[name] / self.counts[name])
+                for name in self.TIMINGS if self.counts[name])
+
+    def _write_prometheus(self, snap):
+        lines = []
+        #samples are (name suffix, labels, value)
+        def metric(name, kind, helptext, samples):
+            lines.append("# HELP asyncfetchpush_{0} {1}".format(name, helptext))
+            lines.append("# TYPE asyncfetchpush_{0} {1}".format(name, kind))
+            for suffix, labels, value in samples:
+                labels = ",".join('{0}="{1}"'.format(k, v) for k, v in labels)
+                lines.append("asyncfetchpush_{0}{1}{2} {3!r}".format(name, suffix,
+                    "{" + labels + "}" if labels else "", value))
+        metric('requests_total', 'counter', 'Finished request attempts',
+                [('', (('method', method), ('status', status)), n)
+                    for (method, status), n in sorted(self.statuses.iteritems())])
+        metric('errors_total', 'counter', 'Failed request attempts by error',
+                [('', (('class', error),), n) for error, n in sorted(self.errors.iteritems())])
+        metric('retries_total', 'counter', 'Attempts after the first',
+                [('', (), self.retries)])
+        metric('bytes_total', 'counter', 'Body bytes sent and received',
+                [('', (('method', method),), n) for method, n in sorted(self.bytes.iteritems())])
+        metric('request_seconds', 'summary', 'Time per attempt spent in each phase',
+                [('_sum', (('phase', name),), self.sums[name]) for name in self.TIMINGS]
+                + [('_count', (('phase', name),), self.counts[name]) for name in self.TIMINGS])
+        metric('throughput_bytes_per_second', 'gauge', 'Bytes per second since the start',
+                [('', (), snap['bytes_per_second'])])
+        metric('in_flight', 'gauge', 'Requests in flight', [('', (), snap['in_flight'])])
+        metric('queue_depth', 'gauge', 'Requests waiting to be sent',
+                [('', (), snap['queue_depth'])])
+        metric('stage_seconds', 'gauge', 'Seconds spent outside the transfers',
+                [('', (('stage', name),), seconds) for name, seconds in self.stages.iteritems()])
+        metric('instrumentation_seconds_total', 'counter', 'Seconds spent recording metrics',
+                [('', (), self.overhead)])
+        tmppath = self.promfile + '.tmp'
+        fh = open(tmppath, 'w')
+        fh.write("\n".join(lines) + "\n")
+        fh.close()
+        os.rename(tmppath, self.promfile)
+
+    def close(self):
+        snap = self.snapshot()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        return snap
+
+'''
+Engines make the requests from a queue, keeping at most limit in flight and
+starting the next as soon as one finishes
+
+on_complete is called with each finished AsyncGetPush and can return more
+requests to make (eg. the HEAD checking a PUT), these go ahead of whatever is
+left in the queue. The queue can be any iterable, it is only read as slots
+free up. schedule() puts a request back on the queue after a delay, the
+other requests carry on in the meantime. With a ConcurrencyLimiter the
+number in flight follows its limit, limit is then the most there can be.
+
+GeventEngine - runs each request in a greenlet from a grequests pool,
+    grequests monkey patches the socket/ssl modules when it is imported so
+    it is only imported once this engine is used
+AsyncioEngine - a single asyncio event loop hands each request to a thread
+    pool where the blocking requests call and file I/O happen. Nothing is
+    monkey patched. Uses trollius (the asyncio backport) where asyncio isn't
+    available
+
+Example:
+
+    engine = asyncfetchpush.make_engine('asyncio')
+    engine.run(requestlist, 50, ConnectionPool(50))
+'''
+class Engine(object):
+
+    def _start(self, source, limit, limiter, on_complete):
+        self.maximum = max(limit, 1)
+        self.limiter = limiter
+        self.source = iter(source)
+        self.followups = deque()
+        self.on_complete = on_complete
+        #Requests waiting to be put back on the queue
+        self.waiting = 0
+        #Requests taken off the queue so far
+        self.sent = 0
+
+    def _limit(self):
+        if self.limiter is None:
+            return self.maximum
+        return min(self.limiter.limit, self.maximum)
+
+    #The next request to make, None once the queue is empty
+    def _next(self):
+        if self.followups:
+            r = self.followups.popleft()
+        else:
+            r = next(self.source, None)
+        if r is not None:
+            r.dispatched = time.time()
+            self.sent += 1
+        return r
+
+    def _completed(self, r):
+        if self.on_complete is not None:
+            more = self.on_complete(r)
+            if more:
+                self.followups.extend(more)
+
+class GeventEngine(Engine):
+
+    def run(self, source, limit, connections=None, on_complete=None,
+            limiter=None):
+        import grequests
+        self.gevent = grequests.gevent
+        session = connections.session if connections else None
+        self._start(source, limit, limiter, on_complete)
+        self.wakeup = self.gevent.event.Event()
+        pool = self.pool = grequests.Pool(self.maximum)
+        while True:
+            if len(pool) >= self._limit():
+                self.gevent.wait(list(pool.greenlets), count=1)
+                continue
+            r = self._next()
+            if r is not None:
+                pool.spawn(self._send, r, session)
+            elif len(pool) or self.waiting:
+                #Wait for a request to finish or be requeued, finished
+                #requests may queue follow-ups
+                self.wakeup.clear()
+                self.gevent.wait(list(pool.greenlets) + [self.wakeup], count=1)
+            else:
+                break
+
+    def _send(self, r, session):
+        r.send(session)
+        self._completed(r)
+
+    def in_flight(self):
+        return len(self.pool)
+
+    def schedule(self, r, delay):
+        self.waiting += 1
+        self.gevent.spawn_later(delay, self._requeue, r)
+
+    def _requeue(self, r):
+        self.waiting -= 1
+        self.followups.append(r)
+        self.wakeup.set()
+
+class AsyncioEngine(Engine):
+
+    def run(self, source, limit, connections=None, on_complete=None,
+            limiter=None):
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._start(source, limit, limiter, on_complete)
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(self.maximum)
+        self.session = connections.session if connections else None
+        self.inflight = 0
+        try:
+            self.loop.call_soon(self._dispatch)
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            self.executor.shutdown()
+
+    #Only ever called on the loop thread so needs no locking
+    def _dispatch(self):
+        while self.inflight < self._limit():
+            r = self._next()
+            if r is None:
+                break
+            self.inflight += 1
+            job = self.loop.run_in_executor(self.executor, r.send, self.session)
+            job.add_done_callback(functools.partial(self._finished, r))
+        if not self.inflight and not self.waiting:
+            self.loop.stop()
+
+    def in_flight(self):
+        return self.inflight
+
+    def _finished(self, r, job):
+        self.inflight -= 1
+        try:
+            self._completed(r)
+        finally:
+            self._dispatch()
+
+    def schedule(self, r, delay):
+        self.waiting += 1
+        self.loop.call_later(delay, self._requeue, r)
+
+    def _requeue(self, r):
+        self.waiting -= 1
+        self.followups.append(r)
+        self._dispatch()
+
+def make_engine(name):
+    if name == 'gevent':
+        return GeventEngine()
+    elif name == 'asyncio':
+        return AsyncioEngine()
+    raise ValueError("Unknown engine {}, use one of {}".format(name, ', '.join(ENGINES)))
+
+'''
+Split requests into batches balanced by bytes and by number of requests
+
+Longest processing time first: requests are taken largest first and each
+goes to the batch with the fewest bytes so far which isn't full, so one huge
+file doesn't end up alone in a batch or alongside hundreds of tiny ones.
+There are as many batches as it takes to keep each under maxbytes and
+maxcount (on average, a single file bigger than maxbytes still fits
+somewhere). Each batch is then ordered by interleave.
+
+Args:
+    items - An iterable of (key, size in bytes), eg. (url, filesize)
+    maxbytes - Bytes per batch, 0 for no limit
+    maxcount - Requests per batch, 0 for no limit
+
+Returns a list of batches, lists of (key, size)
+
+Example:
+
+    for batch in pack([('http://foo.com/a.jar', 1048576), ...], maxbytes=268435456):
+        hgp.append(OrderedDict((url, urlsfiles[url]) for url, size in batch))
+'''
+def pack(items, maxbytes=0, maxcount=0):
+    items = sorted(items, key=lambda item: item[1], reverse=True)
+    if not items:
+        return []
+    total = sum(size for key, size in items)
+    batches = 1
+    if maxbytes > 0:
+        batches = max(batches, int(math.ceil(total / float(maxbytes))))
+    if maxcount > 0:
+        batches = max(batches, int(math.ceil(len(items) / float(maxcount))))
+    batches = min(batches, len(items))
+    #Spread the requests evenly too, full batches drop out of the heap
+    cap = int(math.ceil(len(items) / float(batches)))
+    heap = [(0, 0, i) for i in xrange(batches)]
+    packed = [[] for i in xrange(batches)]
+    for item in items:
+        size, count, i = heapq.heappop(heap)
+        while count >= cap:
+            size, count, i = heapq.heappop(heap)
+        packed[i].append(item)
+        heapq.heappush(heap, (size + item[1], count + 1, i))
+    return [interleave(batch) for batch in packed]
+
+'''
+Order (key, size) items largest first with the small ones spread evenly
+between the large ones (bigger than the mean), so while the large transfers
+keep the bandwidth busy the small, latency bound, ones keep the rest of the
+connections busy instead of all being left until the end. Items of equal
+size keep their order.
+'''
+def interleave(items):
+    items = sorted(items, key=lambda item: item[1], reverse=True)
+    if not items:
+        return items
+    mean = sum(size for key, size in items) / float(len(items))
+    large = [item for item in items if item[1] > mean]
+    small = [item for item in items if item[1] <= mean]
+    if not large:
+        return items
+    ordered = []
+    for n, item in enumerate(large):
+        ordered.append(item)
+        ordered.extend(small[n * len(small) // len(large):
+            (n + 1) * len(small) // len(large)])
+    return ordered
+
+#Take from each iterable in turn until they are all exhausted
+def roundrobin(iterables):
+    iterators = deque(iter(i) for i in iterables)
+    while iterators:
+        it = iterators.popleft()
+        try:
+            item = next(it)
+        except StopIteration:
+            continue
+        yield item
+        iterators.append(it)
+
+'''
+Makes the requests of several HttpGrabberPushers as one continuous queue
+
+Instead of every HttpGrabberPusher (so every chunk and method) waiting on
+the slowest of its requests before the next one starts, all their requests
+share one engine and a new transfer starts whenever a slot frees up. The
+HttpGrabberPushers are taken from in turn, so with batches made by pack the
+queue as a whole stays largest first. on_complete is called with each
+finished AsyncGetPush and may return follow-up requests, which are only
+queued once the request they follow has finished so eg. a PUT always
+completes before its verification HEAD.
+
+A request which fails with no response or a RETRY_STATUSES status is retried
+on its own, up to retries times, after an exponential backoff with jitter or
+as long as the server's Retry-After asks (up to retry_after_cap seconds),
+while the rest keep the pool busy. Retries are counted by the reporter.
+
+A grabber's requests are made from its jobs as the engine takes them, so
+only the requests in flight (and those kept for iterating afterwards) are
+ever held. The ones which failed for good are in failedrequests, and those
+of each HttpGrabberPusher in its failedrequests.
+
+Args:
+    grabbers - A list of HttpGrabberPushers
+    limit, retries, engine, connections, limiter, throttle, metrics,
+        reporter - As HttpGrabberPusher
+    keep - Keep the follow-up requests so the Pipeline can be iterated for
+           them afterwards, as HttpGrabberPusher
+    retry_after_cap - The most seconds a Retry-After delays a retry
+
+Example:
+
+    pipeline = asyncfetchpush.Pipeline(limit=250, connections=connections)
+    pipeline.append(puts)
+    pipeline.append(gets)
+    pipeline.make_requests(on_complete=lambda r: None)
+'''
+class Pipeline(object):
+    def __init__(self, grabbers=None,
+                limit=150,
+                retries=3,
+                engine='gevent',
+                connections=None,
+                limiter=None,
+                throttle=None,
+                metrics=None,
+                reporter=None,
+                keep=True,
+                retry_after_cap=RETRY_AFTER_CAP):
+        self.grabbers = []
+        self.followups = []
+        self.failedrequests = []
+        self.limit = limit
+        self.retries = retries
+        self.engine = engine
+        self.keep = keep
+        self.retry_after_cap = retry_after_cap
+        if connections is None:
+            connections = ConnectionPool(limit, timed=metrics is not None)
+        self.connections = connections
+        self.limiter = limiter
+        self.throttle = throttle
+        self.metrics = metrics
+        self.reporter = reporter if reporter is not None else default_reporter()
+        #Requests queued so far, including retries and follow-ups
+        self.queued = 0
+        #id of each of the grabbers' requests in progress : its grabber
+        self._owners = {}
+        #id of each grabber : the requests it had before make_requests,
+        #the rest are streamed so are counted as they're taken
+        self._expected = {}
+
+        for grabber in grabbers or []:
+            self.append(grabber)
+
+    def __iter__(self):
+        return itertools.chain(itertools.chain.from_iterable(self.grabbers),
+                self.followups)
+
+    def __len__(self):
+        return sum(len(g) for g in self.grabbers) + len(self.followups)
+
+    def append(self, grabber):
+        self.grabbers.append(grabber)
+
+    def _completed(self, r):
+        if self.limiter is not None:
+            self.limiter.record(r.latency, not r.response and r.congested())
+        if self.metrics is not None:
+            self.metrics.record(r)
+        if not r.response and r.retryable() and r.attempts <= self.retries:
+            delay = backoff(r.attempts - 1)
+            if r.retry_after is not None:
+                delay = max(delay, min(r.retry_after, self.retry_after_cap))
+            self.reporter.retrying(r, delay)
+            r.rerequest()
+            self.queued += 1
+            self._engine.schedule(r, delay)
+            return
+        if not r.response:
+            print "Request: " + r.url + " failed[" + str(r.attempts) + "]"
+        self.reporter.completed(r)
+
+        spawned = r.spawn()
+        if spawned:
+            self.reporter.expect(len(spawned))
+            self.queued += len(spawned)
+            if self.keep:
+                #A probed GET which isn't split goes again itself, it is
+                #kept already
+                self.followups.extend(f for f in spawned if f is not r)
+            return spawned
+        r.release()
+        if r.parent is not None:
+            #Only the whole download is reported
+            r = r.parent.segment_completed(r)
+            if r is None:
+                return
+            r.release()
+            if not r.response:
+                print "Request: {0} failed ({1})".format(r.url, r.exception or r.rcode)
+        grabber = self._owners.pop(id(r), None)
+        if not r.response:
+            self.failedrequests.append(r)
+            if grabber is not None:
+                grabber.failedrequests.append(r)
+
+        more = self.on_complete(r) if self.on_complete else None
+        if more:
+            self.reporter.expect(len(more))
+            for followup in more:
+                self._attach(None, followup)
+            self.queued += len(more)
+            if self.keep:
+                self.followups.extend(more)
+        return more
+
+    def _gauges(self):
+        return {'in_flight': self._engine.in_flight(),
+                'queue_depth': max(0, self.queued - self._engine.sent)}
+
+    def _attach(self, grabber, r):
+        r.throttle = self.throttle
+        r.reporter = self.reporter
+        if grabber is not None:
+            self._owners[id(r)] = grabber
+            if self._expected[id(grabber)]:
+                self._expected[id(grabber)] -= 1
+            else:
+                self.queued += 1
+                self.reporter.expect(1)
+        return r
+
+    def make_requests(self, on_complete=None):
+        self.on_complete = on_complete
+        self.queued = len(self)
+        self.failedrequests = []
+        for grabber in self.grabbers:
+            grabber.failedrequests = []
+            self._expected[id(grabber)] = len(grabber)
+        self.reporter.start(self.queued)
+        self._engine = make_engine(self.engine)
+        started = time.time()
+        if self.metrics is not None:
+            self.metrics.gauges = self._gauges
+        try:
+            self._engine.run(roundrobin([itertools.imap(functools.partial(self._attach, g),
+                g.requests()) for g in self.grabbers]),
+                    self.limit, self.connections, self._completed, self.limiter)
+        finally:
+            if self.metrics is not None:
+                self.metrics.gauges = None
+                self.metrics.stage('transfer', time.time() - started)
+            self.reporter.finish()
+            self._owners.clear()
+
+        if len(self.failedrequests) > 0:
+            print "Still Failures"
+
+'''
+A compact list of (url, filepath) jobs
+
+The jobs are kept as columns rather than an object each. The part of each
+url and filepath up to its last / is stored once in a table of prefixes
+shared by both columns, each job only holding its index into the table and
+the name after it, so a million files under a few thousand directories cost
+a hundred or so bytes each. A filepath of None is kept as None.
+
+Example:
+
+    jobs = JobList()
+    jobs.append('https://foo.com/repo/bar.jar', '/tmp/repo/bar.jar')
+    for url, filepath in jobs:
+        print url, filepath
+'''
+class JobList(object):
+
+    def __init__(self):
+        self.prefixes = []
+        self._prefix_ids = {}
+        self._urlprefix = array.array('l')
+        self._urlname = []
+        self._pathprefix = array.array('l')
+        self._pathname = []
+
+    def _split(self, value):
+        if value is None:
+            return -1, None
+        head, sep, name = value.rpartition('/')
+        head += sep
+        i = self._prefix_ids.get(head)
+        if i is None:
+            i = self._prefix_ids[head] = len(self.prefixes)
+            self.prefixes.append(head)
+        return i, name
+
+    def _join(self, i, name):
+        if i < 0:
+            return name
+        return self.prefixes[i] + name
+
+    def append(self, url, filepath):
+        i, name = self._split(url)
+        self._urlprefix.append(i)
+        self._urlname.append(name)
+        i, name = self._split(filepath)
+        self._pathprefix.append(i)
+        self._pathname.append(name)
+
+    def __len__(self):
+        return len(self._urlname)
+
+    def __getitem__(self, n):
+        return (self._join(self._urlprefix[n], self._urlname[n]),
+                self._join(self._pathprefix[n], self._pathname[n]))
+
+    def __iter__(self):
+        for n in xrange(len(self)):
+            yield self[n]
+
+    def urls(self):
+        for n in xrange(len(self)):
+            yield self._join(self._urlprefix[n], self._urlname[n])
 
 '''
 A quick and dirty wrapper around AsyncGetPush
@@ -105,7 +2642,33 @@ Args:
     comburlafile - A dictionary of file paths, using the url as the key
     limit - The amount of requests per pool
     timeout - The timeout per request in seconds
-    retries - The number of times to send a group of requests
+    retries - The number of times to retry a failed request
+    chunk_size - Bytes read from disk/written to disk at a time when
+                 streaming a PUT body or GET response
+    engine - 'gevent' or 'asyncio', see make_engine
+    connections - A ConnectionPool to share with other HttpGrabberPushers,
+                  one holding limit connections per host is made if not given
+    limiter - A ConcurrencyLimiter to adapt the number of requests in flight,
+              limit is then the most there can be
+    piece_size - PUT files bigger than this as a resumable upload of pieces
+                 this many bytes, see AsyncGetPush. 0 (default) never does
+    segments - GET files in up to this many byte ranges at once, see
+               AsyncGetPush. 0 (default) never splits a download
+    segment_size - The smallest range a download is split into
+    throttle - A Throttle limiting the bytes per second of every transfer
+    metrics - A Metrics recording the timings of every request
+    reporter - A Reporter of the progress, a ProgressBarReporter if stderr
+               is a terminal and a LogReporter if not by default
+    keep - Keep each request once it has been made so the HttpGrabberPusher
+           can be iterated for them afterwards. False only keeps the ones
+           which failed (in failedrequests), for lists of jobs too long to
+           hold a request object each
+    compress - Compress PUT bodies worth compressing with this
+               Content-Encoding, one of ENCODINGS, see AsyncGetPush
+    compress_min - The smallest file compressed, in bytes
+
+The urls and filepaths appended are kept in a JobList and each AsyncGetPush
+is only made as the engine takes it.
 
 Example:
 
@@ -122,6 +2685,9 @@ Example:
     Making the requests:
     requests.make_requests()
 
+    Making the requests, queueing a HEAD after each completes:
+    requests.make_requests(on_complete=lambda r: [AsyncGetPush('HEAD', r.url, r.filepath)])
+
     Iterating:
     for completed_request in requests:
         print completed_request.filepath
@@ -134,93 +2700,118 @@ class HttpGrabberPusher(object):
                 timeout=10,
                 retries=3,
                 username=None,
-                password=None):
+                password=None,
+                chunk_size=CHUNK_SIZE,
+                engine='gevent',
+                connections=None,
+                limiter=None,
+                piece_size=0,
+                segments=0,
+                segment_size=SEGMENT_SIZE,
+                throttle=None,
+                metrics=None,
+                reporter=None,
+                keep=True,
+                compress=None,
+                compress_min=COMPRESS_MIN):
         self.method = method
+        self.jobs = JobList()
+        #Requests appended ready made, then those made so far if keep
+        self.appended = []
+        #Iterables of requests read as the engine takes them, see stream
+        self.streams = []
         self.requestlist = []
         self.failedrequests = []
+        self.keep = keep
+        self.compress = compress
+        self.compress_min = compress_min
         self.limit = limit
         self.timeout = timeout
         self.retries = retries
         self.username = username
         self.password = password
-        self.original = []
+        self.chunk_size = chunk_size
+        self.piece_size = piece_size
+        self.segments = segments
+        self.segment_size = segment_size
+        self.engine = engine
+        if connections is None:
+            connections = ConnectionPool(limit, timed=metrics is not None)
+        self.connections = connections
+        self.limiter = limiter
+        self.throttle = throttle
+        self.metrics = metrics
+        self.reporter = reporter if reporter is not None else default_reporter()
 
         if comburlafile:
             self.append(comburlafile)
 
+    #The requests made, once make_requests has been called
     def __iter__(self):
         return iter(self.requestlist)
 
+    #The number of requests to make, not counting those streamed
+    def __len__(self):
+        return len(self.appended) + len(self.jobs)
+
+    #The url of every request to make
+    def urls(self):
+        return itertools.chain((r.url for r in self.appended), self.jobs.urls())
+
+    #Add an already made request, eg. a BundlePut
+    def append_request(self, r):
+        self.appended.append(r)
+
+    '''
+    Add an iterable of requests (eg. a generator reading a manifest) which
+    is only read as the engine takes requests, after the others, so the
+    first are being made while the rest are still to be read
+    '''
+    def stream(self, requests):
+        self.streams.append(requests)
+
     def append(self, dic):
-        self.original.append(dic)
         for key in dic:
-            self.requestlist.append(
-                    AsyncGetPush(
-                        self.method,
-                        key,
-                        dic[key],
-                        timeout=self.timeout,
-                        auth=(self.username, self.password) if self.username and self.password else None
-                        ))
-    #Recurse
-    def make_requests_r(self, rlist, count=0):
-
-            failed = []
-            if count < 1:
-                pool = grequests.Pool(self.limit)
-            elif count < 2:
-                time.sleep(10)
-                pool = grequests.Pool(self.limit/2)
-                (r.rerequest() for r in rlist)
-            elif count < 3 or count > 3:
-                time.sleep(10)
-                pool = grequests.Pool(1)
-                (r.rerequest() for r in rlist)
+            self.jobs.append(key, dic[key])
 
-            #Hack to turn off ssl certs
-            for r in rlist:
-                r.request.session.verify = False
-
-            jobs = [grequests.send(r.request, pool, stream=False) for r in rlist]
-            grequests.gevent.joinall(jobs)
-
-            for r in rlist:
-                if not r.response:
-                    print "Request: " + r.url + " failed[" + str(count) + "]"
-                    failed.append(r)
-            return failed
-
-    #Make the requests, use the recursive func
-    def make_requests(self):
-        global pbar
-        pbar = progressbar.ProgressBar(
-                            widgets=[
-                                progressbar.Bar(),
-                                progressbar.Percentage(),
-                                ' reqs ',
-                                progressbar.SimpleProgress()
-                                ],
-                            maxval=len(self.requestlist),
-                            term_width=80)
-        pbar = pbar.start()
-        fr = self.make_requests_r(self.requestlist, 0)
-        if len(fr) > 0:
-            for x in xrange(self.retries):
-                print "Trying Failed (try " + str(x) + " of " + str(self.retries) + " )"
-                pbar = progressbar.ProgressBar(
-                                    widgets=[
-                                        progressbar.Bar(),
-                                        progressbar.Percentage(),
-                                        ' reqs ',
-                                        progressbar.SimpleProgress()
-                                        ],
-                                    maxval=len(fr),
-                                    term_width=40)
-                fr = self.make_requests_r(fr, x)
-        pbar.finish()
-        if len(fr) > 0:
-            print "Still Failures"
-            self.failedrequests = fr
+    def make_request(self, url, filepath):
+        return AsyncGetPush(
+                self.method,
+                url,
+                filepath,
+                timeout=self.timeout,
+                auth=(self.username, self.password) if self.username and self.password else None,
+                chunk_size=self.chunk_size,
+                piece_size=self.piece_size,
+                segments=self.segments,
+                segment_size=self.segment_size,
+                compress=self.compress,
+                compress_min=self.compress_min
+                )
+
+    #The requests to make, each made from its job as it is taken
+    def requests(self):
+        self.requestlist = []
+        for r in self.appended:
+            if self.keep:
+                self.requestlist.append(r)
+            yield r
+        for url, filepath in self.jobs:
+            r = self.make_request(url, filepath)
+            if self.keep:
+                self.requestlist.append(r)
+            yield r
+        for r in itertools.chain.from_iterable(self.streams):
+            if self.keep:
+                self.requestlist.append(r)
+            yield r
+
+    #Make the requests, a Pipeline of just this HttpGrabberPusher
+    def make_requests(self, on_complete=None):
+        pipeline = Pipeline([self], self.limit, self.retries, self.engine,
+                self.connections, self.limiter, self.throttle, self.metrics,
+                self.reporter, self.keep)
+        pipeline.make_requests(on_complete)
 
     def request_header_dictionary(self):
         request_header_dict = {}
@@ -238,3 +2829,4 @@ class HttpGrabberPusher(object):
         failed = {}
         for f in self.failedrequests:
             failed.update({f.url:f.rcode})
+        return failed
@@ -5,10 +5,19 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 import asyncfetchpush
+import asyncfetchpush_fs
+import asyncfetchpush_state
+import asyncfetchpush_manifest
+import asyncfetchpush_workers
 import time
+import tempfile
 import math
+import random
+import urllib
 import getpass
-import hashlib
+import itertools
+import functools
+import pkgutil
 from collections import defaultdict
 from collections import OrderedDict
 ''' General Utils '''
@@ -16,12 +25,7 @@ from collections import OrderedDict
 def tree():
     return defaultdict(tree)
 
-def size_to_string(num, suffix="B"):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+size_to_string = asyncfetchpush.size_to_string
 
 def filesize_check(path):
     try:
@@ -32,12 +36,9 @@ def filesize_check(path):
 
 def shasum(filepath):
     try:
-        fh = open(filepath,'r')
-        h = hashlib.sha256(fh.read()).hexdigest()
-        fh.close()
-        return h
-    except OSError:
-        print "Error: file {} does not exist".format(path)
+        return asyncfetchpush_fs.shasum(filepath)
+    except (OSError, IOError):
+        print "Error: file {} does not exist".format(filepath)
         exit(1)
 
 
@@ -82,11 +83,12 @@ async_requests - METHOD : [AsyncRequestObj]
     is then inspected after the requests have been made
     for the results.
 
-a log file is also produced to allow resuming of requests
-holding filesizes etc. This will always be async.log.json
-in the execution directory.
+a journal is also produced to allow resuming of requests
+holding filesizes etc. This is async.log.ndjson in the
+execution directory by default (--journal).
 
-The log is json format and ordered by timestamp key value
+The journal is appended to, a line of json per request at
+the start of a run then a line per completed request
 '''
 class HTTPRequests:
     def __init__(self, filehandle, options):
@@ -100,28 +102,140 @@ class HTTPRequests:
         #Contains the actual Async requests (batched)
         self.async_requests = {}
 
+        #Urls with a verification HEAD queued behind their PUT
+        self.checking = set()
+
         self.username = ""
         self.password = ""
         self.dry = True
         self.basedir = ""
         self.maxrequestsize = options.size * 1048576
+        self.chunk_size = options.chunksize * 1024
+
+        #Progress of the requests, a bar on a terminal and lines in a log
+        if options.progress == 'bar' or (options.progress is None
+                and sys.stderr.isatty()):
+            self.reporter = asyncfetchpush.ProgressBarReporter()
+        elif options.progress == 'none':
+            self.reporter = asyncfetchpush.Reporter()
+        else:
+            self.reporter = asyncfetchpush.LogReporter(options.progressinterval)
+
+        #hyper is only imported once the engine is running, but checked for now
+        if options.http2 and pkgutil.find_loader('hyper') is None:
+            print "Error: --http2 needs the hyper module"
+            exit(1)
+
+        #The limiter, metrics, connections and throttle
+        self._setup_transfers()
         self.retries = 3
 
-        #Total filsize of requests
-        self.request_total_filesize = {'HEAD':0, 'PUT':0, 'GET':0}
+        #Connections and limiters of the --workers, for the reports
+        if options.workers > 1 and not hasattr(os, 'fork'):
+            print "Error: --workers needs os.fork, which isn't available here"
+            exit(1)
+        self.worker_connections = [0, 0]
+        self.worker_limiters = []
+
+        #sha256 of files unchanged since they were last hashed, --dedup
+        #hashes the files too
+        self.digests = None
+        if options.checksum or options.dedup:
+            self.digests = asyncfetchpush_fs.DigestCache(options.digestcache,
+                    options.digestcachesize)
+
+        #stat results from walking --basedir, reused by the digest cache
+        self.stats = {}
+
+        #What was pushed by earlier runs, unchanged files aren't uploaded
+        self.index = None
+        if options.incremental:
+            self.index = asyncfetchpush_state.RemoteIndex(options.index)
+        #Unchanged urls which get a HEAD to check the index is still right
+        self.sampling = set()
+
+        #Urls of --bundle archives : urls of the files in them
+        self.bundles = {}
+
+        #Requests with a compressed body: count, bytes, bytes on the wire
+        self.compressed = [0, 0, 0]
+        if options.compress:
+            try:
+                asyncfetchpush.make_compressor(options.compress)
+            except ImportError:
+                print "Error: --compress zstd needs the zstandard module"
+                exit(1)
+
+        #--dedup: sha256 : a url the server has that content at, sha256 : the
+        #urls of files waiting for the first upload of their content, and the
+        #files and bytes made on the server instead of being uploaded
+        self.sources = {}
+        self.waiting = {}
+        self.deduped = [0, 0]
+        #Cleared once the server says it can't make files, eg. a 405 for COPY
+        self.linking = True
+
+        #Settings read from the input json, eg. username
+        self.settings = {}
+        #The HttpGrabberPusher of requests made as the inputs are read
+        self.stream = None
+
         #Logging stuff
         self.logfile = "async.log.json"
-        self.lf_json_all = self._logfile_json()
-        self.last_log_key = self._lastlogentry()
+        self.journal = asyncfetchpush_state.Journal(options.journal,
+                syncevery=options.journalsync,
+                maxbytes=options.journalmaxsize * 1048576)
+        if options.compactlog:
+            self.journal.compact()
         self.log_time = time.time()
 
         #Produce the async requests
         self._compose_ordered_requets()
 
+    def _setup_transfers(self, worker=None, workers=1):
+        '''
+        What the requests are made with. A worker of --workers gets its share
+        of --limit, --maxconns and the rate limits, and writes its --metrics
+        lines to a file of its own (FILE.N), the coordinator merges the
+        counters for the totals
+        '''
+        options = self.options
+        #Most requests in flight
+        self.limit = max(1, options.limit // workers)
+
+        #Adapts the number of requests in flight up to --limit
+        self.limiter = None
+        if options.adaptive:
+            self.limiter = asyncfetchpush.ConcurrencyLimiter(
+                    initial=min(16, self.limit), minimum=min(options.minlimit, self.limit),
+                    maximum=self.limit)
+
+        #Timings of every request and counters of the run
+        self.metrics = None
+        if worker is not None and (options.metrics or options.prometheus):
+            self.metrics = asyncfetchpush.Metrics(
+                    "{0}.{1}".format(options.metrics, worker) if options.metrics else None,
+                    interval=options.metricsinterval)
+        elif options.metrics or options.prometheus:
+            self.metrics = asyncfetchpush.Metrics(options.metrics,
+                    options.prometheus, options.metricsinterval)
+
+        #Keep-alive connections shared by every batch and method, requests
+        #wait for one once --maxconns are open
+        self.connections = asyncfetchpush.ConnectionPool(max(1, options.maxconns // workers),
+                timed=self.metrics is not None, http2=options.http2)
+
+        #Bytes per second shared by every transfer, in total and per host
+        self.throttle = None
+        if options.rate or options.hostrate or options.ratecontrol:
+            self.throttle = asyncfetchpush.Throttle(
+                    asyncfetchpush.parse_rate(options.rate or 0),
+                    self._host_rates(options.hostrate or []),
+                    control=options.ratecontrol, share=workers)
+
     def _set_username_password(self, j):
         if self.options.username:
             self.username = self.options.username
-        j = j['HTTPAsyncData']
         if j.has_key('username'):
             self.username = j['username']
 
@@ -132,18 +246,25 @@ class HTTPRequests:
             self.password = j['password']
 
 
-    def _logfile_json(self):
-        return getJson(self.logfile)
-
-    def _lastlogentry(self):
-        if self.lf_json_all:
-            od = OrderedDict(sorted(self.lf_json_all.items()))
-            return self.lf_json_all.keys()[-1]
+    def _last_run(self):
+        '''
+        The requests of the last run from the journal, or from the newest
+        entry of an async.log.json written before there was a journal
+        '''
+        run, requests = self.journal.last_run()
+        if run is None and os.path.exists(self.logfile):
+            lf_json_all = getJson(self.logfile)
+            if lf_json_all:
+                requests = lf_json_all[max(lf_json_all, key=float)]
+        return requests
 
 
     def _incomplete_requests(self):
-        for url, content in self.request_objects.iteritems():
+        for url, content in self.request_objects.items():
             if content.completed_timestamp:
+                #What the server has now, for --dedup
+                if content.checksum and content.method in ('PUT', 'HEAD'):
+                    self.sources.setdefault(content.checksum, url)
                 self.request_objects.pop(url)
 
 
@@ -159,38 +280,57 @@ class HTTPRequests:
             - etc...
 
         This is to be combined with the log for resume and filesize/check support
+
+        The inputs are read a block or line at a time, see _entries. Unless
+        something needs the whole list first (see _streamable) the requests
+        are made from them as they're read
         '''
-        j = getJson(self.filehandle)
-        if not j.has_key('HTTPAsyncData'):
-            #Throw exception
-            print "The json file doesn't contain valid HTTPAsync data section(s)"
+        if self.options.pstdin and not self.options.baseurl:
+            print "Error: --put needs a --baseurl to upload to"
+            exit(1)
+        if [self.options.pstdin_json, self.options.gstdin, self.options.pstdin].count(True) > 1:
+            print "Error: only one of --stdinjson, --get and --put can read stdin"
+            exit(1)
+        entries = self._entries()
+        if self._streamable():
+            self._stream_requests(entries)
+            self._write_to_log()
+            return
+
         #Load the log if continue is specified
-        self._set_username_password(j)
         if self.options.resume:
-            for url, contents in self.lf_json_all[self.last_log_key].iteritems():
+            #Only the username and password are wanted from the input
+            for entry in entries:
+                pass
+            self._set_username_password(self.settings)
+            for url, contents in self._last_run().iteritems():
                 self.request_objects.update({url:HTTPRequestHelper(**contents)})
             self._continue_requests()
+            if self.options.checksum:
+                self._checksum_requests()
 
         elif self.options.checkonly or self.options.checkfirst:
             #Try request only once
             self.retries = 0
             logfiler = {}
             #Try and load logfile first, this will save calculating the filesizes
-            try:
-                for url, contents in self.lf_json_all[self.last_log_key].iteritems():
-                    if contents['method'] == 'HEAD' or contents['method'] == 'PUT':
-                        logfiler.update({url:HTTPRequestHelper(**contents)})
-            except KeyError:
-                print "Cannot load previous log entry " + str(self.last_log_key)
+            for url, contents in self._last_run().iteritems():
+                if contents['method'] == 'HEAD' or contents['method'] == 'PUT':
+                    logfiler.update({url:HTTPRequestHelper(**contents)})
 
-            for method, contents in j['HTTPAsyncData'].iteritems():
+            for method, url, filepath in entries:
                 if method == 'HEAD' or method == 'PUT':
-                    for url, filepath in contents.iteritems():
-                        if logfiler.has_key(url):
-                            self.request_objects.update({url:logfiler[url]})
-                        else:
-                            self.request_objects.update({url:HTTPRequestHelper(method,filepath)})
-                        self.request_objects[url].change_to_check()
+                    if logfiler.has_key(url):
+                        self.request_objects.update({url:logfiler[url]})
+                    else:
+                        self.request_objects.update({url:HTTPRequestHelper(method,filepath)})
+                    self.request_objects[url].change_to_check()
+            self._set_username_password(self.settings)
+            if self.options.basedir:
+                #The walk has the filesizes already, no need for the log
+                self._scan_basedir()
+                for url, rh in self.request_objects.iteritems():
+                    rh.change_to_check()
             self._build_async_reqs()
             self._check_uploads()
 
@@ -203,117 +343,700 @@ class HTTPRequests:
                 self.async_requests = {}
                 self.retries = 3
                 self._build_async_reqs()
+            if self.options.checksum:
+                self._checksum_requests()
 
         else:
             #Get the items in the provided file
-            for method, contents in j['HTTPAsyncData'].iteritems():
-                try:
-                    for url, filepath in contents.iteritems():
-                        self.request_objects.update({url:HTTPRequestHelper(method,
-                            filepath)})
-                except Exception as e:
-                    print "Exception" + str(e) + " " + str(method) + " could not be iterated, skipping"
+            for method, url, filepath in entries:
+                self.request_objects.update({url:HTTPRequestHelper(method,
+                    filepath)})
+            self._set_username_password(self.settings)
+            if self.options.basedir:
+                self._scan_basedir()
+            #Before the index is consulted, it compares the sha256 if it has one
+            if self.options.checksum:
+                self._checksum_requests()
+            if self.index is not None:
+                self._skip_unchanged()
             self._build_async_reqs()
         self._write_to_log()
 
+    def _entries(self):
+        '''
+        (method, url, filepath) of every request in the inputs: the json or
+        NDJSON of -i/--stdinjson, the urls to GET of --urlfile and --get and
+        the files to PUT of --put. Read as it is iterated, the settings in
+        the json are in self.settings once they've been read
+        '''
+        if self.filehandle:
+            if self.filehandle is sys.stdin:
+                self.filehandle = self._stdin()
+            manifest = asyncfetchpush_manifest.Manifest(self.filehandle)
+            self.settings = manifest.settings
+            try:
+                for entry in manifest:
+                    yield entry
+            except ValueError as e:
+                print "Error reading the json, stopped after {0} requests: {1}".format(
+                        manifest.count, e)
+            self.filehandle.close()
+            if not manifest.count and not self.options.basedir and not self.options.resume:
+                print "The json file doesn't contain valid HTTPAsync data section(s)"
+        if self.options.urlfile or self.options.gstdin:
+            destination = self._destination()
+            for fh in ([open(self.options.urlfile, 'r')] if self.options.urlfile else []) + (
+                    [self._stdin()] if self.options.gstdin else []):
+                for url, filepath in asyncfetchpush_manifest.read_urls(fh,
+                        destination, self.options.flatdirs):
+                    yield 'GET', url, filepath
+                fh.close()
+        if self.options.pstdin:
+            for url, filepath in asyncfetchpush_manifest.read_files(self._stdin(),
+                    self.options.baseurl, self.options.flatdirs):
+                yield 'PUT', url, filepath
+
+    def _stdin(self):
+        '''
+        stdin, which the gevent engine reads without blocking every greenlet
+        so a slow producer doesn't hold up the transfers already going
+        '''
+        if self.options.engine == 'gevent' and self._streamable():
+            import gevent.fileobject
+            return gevent.fileobject.FileObject(sys.stdin, 'rb')
+        return sys.stdin
+
+    def _destination(self):
+        destination = self.options.destination
+        if not destination:
+            destination = tempfile.mkdtemp(prefix='asyncfetchpush')
+            print "Downloading to " + destination
+        elif not os.path.isdir(destination):
+            os.makedirs(destination)
+        return destination
+
+    def _streamable(self):
+        '''
+        Whether the requests can be made as the inputs are read. Balancing
+        --size/--chunkcount batches, --bundle, --checksum, --dedup,
+        --incremental, --resume, --checkonly, --checkfirst, --basedir, --dry
+        and dealing them out to --workers all need the whole list first
+        '''
+        o = self.options
+        return bool((self.filehandle or o.urlfile or o.gstdin or o.pstdin)
+                and not (o.size or o.chunkcount or o.bundle or o.checksum
+                    or o.dedup or o.incremental or o.resume or o.checkonly or o.checkfirst
+                    or o.basedir or o.dry or o.workers > 1))
 
+    def _stream_requests(self, entries):
+        '''
+        Queue the requests of entries to be made as the engine takes them,
+        in a json input the username and password have to come before the
+        first request
+        '''
+        entries = iter(entries)
+        first = next(entries, None)
+        self._set_username_password(self.settings)
+        if first is None:
+            return
+        self.stream = self._new_async_req('GET')
+        self.stream.stream(self._streamed(itertools.chain([first], entries)))
+
+    def _streamed(self, entries):
+        #One HttpGrabberPusher per method to make the requests with
+        makers = {}
+        for method, url, filepath in entries:
+            if url in self.request_objects:
+                continue
+            filesize = 0
+            if method == 'PUT':
+                try:
+                    filesize = os.stat(filepath).st_size
+                except OSError:
+                    print "Error: file {} does not exist, skipping it".format(filepath)
+                    continue
+            rh = HTTPRequestHelper(method, filepath, filesize=filesize)
+            self.request_objects[url] = rh
+            self.journal.add(url, rh.todict())
+            if method not in makers:
+                makers[method] = self._new_async_req(method)
+            yield makers[method].make_request(url, filepath)
 
 
-    def _build_async_reqs(self):
-        for url, rh in self.request_objects.iteritems():
-            self._build_async_req(url,rh)
-
-    def _build_async_req(self, url, rh):
-        method = rh.method
-
-        #Create the async request if it doesnt exist
-        if not self.async_requests.has_key(method):
-            self.async_requests.update({method:
-                [asyncfetchpush.HttpGrabberPusher(rh.method, limit=250,
-                    timeout=90, retries=self.retries, username=self.username,
-                    password=self.password)]})
-
-        #Last item in request list
-        reqlist = self.async_requests[method]
-        reqlist_cur = self.async_requests[method][-1]
-        #Add request to last item in asyncrequest list if within size else create new request
-        if (self.request_total_filesize[method] + rh.filesize) > self.maxrequestsize and self.maxrequestsize > 0:
-            reqlist.append(asyncfetchpush.HttpGrabberPusher(rh.method,
-                limit=250, timeout=90, retries=self.retries,
-                username=self.username, password=self.password))
-            reqlist_cur = reqlist[-1]
-            self.request_total_filesize[method] = 0
 
-        reqlist_cur.append({url:rh.filepath})
-        self.request_total_filesize[method] += rh.filesize
 
+    def _scan_basedir(self):
+        '''
+        PUT every file under --basedir to --baseurl, keeping the directory
+        structure unless --flatdirs. The tree is walked in parallel and the
+        size comes from the walk so files aren't stat'd a second time
+        '''
+        if not self.options.baseurl:
+            print "Error: --basedir needs a --baseurl to upload to"
+            exit(1)
+        baseurl = self.options.baseurl.rstrip('/') + '/'
+        basedir = os.path.abspath(self.options.basedir)
+        started = time.time()
+        for path, st in asyncfetchpush_fs.scan_tree(basedir, self.options.scanworkers):
+            if self.options.flatdirs:
+                name = os.path.basename(path)
+            else:
+                name = os.path.relpath(path, basedir).replace(os.sep, '/')
+            url = baseurl + name
+            if url in self.request_objects:
+                print "Warning: {} and {} both upload to {}, skipping the second".format(
+                        self.request_objects[url].filepath, path, url)
+                continue
+            self.request_objects[url] = HTTPRequestHelper('PUT', path,
+                    filesize=st.st_size, mtime=st.st_mtime)
+            if self.digests is not None:
+                self.stats[path] = st
+        self._stage('scan', started)
+
+    def _stage(self, name, started):
+        if self.metrics is not None:
+            self.metrics.stage(name, time.time() - started)
+
+    def _checksum_requests(self):
+        '''
+        sha256 the files to PUT in parallel, digests of files unchanged
+        since an earlier run come from the digest cache
+        '''
+        helpers = [rh for rh in self.request_objects.itervalues()
+                if rh.method in ('PUT', 'HEAD') and not rh.checksum]
+        if not helpers:
+            return
+        started = time.time()
+        try:
+            digests = asyncfetchpush_fs.checksum_files(
+                    set(rh.filepath for rh in helpers), self.digests,
+                    self.options.hashworkers, self.stats)
+        except (OSError, IOError) as e:
+            print "Error: can't checksum {}: {}".format(e.filename, e.strerror)
+            exit(1)
+        for rh in helpers:
+            rh.checksum = digests[rh.filepath]
+        self.digests.save()
+        self._stage('hash', started)
+
+    def _skip_unchanged(self):
+        '''
+        Drop PUTs of files the index says were already uploaded as they are
+        now, without asking the server. --verifysample of them get a HEAD
+        instead, anything the server doesn't have (or has a different size
+        or ETag of) is forgotten from the index and uploaded after all
+        '''
+        unchanged = []
+        for url, rh in self.request_objects.items():
+            if rh.method != 'PUT':
+                continue
+            if rh.mtime is None:
+                try:
+                    rh.mtime = os.stat(rh.filepath).st_mtime
+                except OSError:
+                    continue
+            if self.index.unchanged(url, rh.filesize, rh.checksum, rh.mtime):
+                unchanged.append(url)
+        if not unchanged:
+            return
+
+        samples = int(math.ceil(len(unchanged) * self.options.verifysample))
+        self.sampling = set(random.sample(unchanged, min(samples, len(unchanged))))
+        for url in unchanged:
+            if url in self.sampling:
+                self.request_objects[url].change_to_check()
+            else:
+                del self.request_objects[url]
+        print "Skipping {0} files unchanged since they were uploaded, verifying {1}".format(
+                len(unchanged), len(self.sampling))
 
+    def _build_async_reqs(self):
+        '''
+        One HttpGrabberPusher per batch of each method, balanced by bytes
+        (--size) and number of requests (--chunkcount) and ordered largest
+        first, see asyncfetchpush.pack
+        '''
+        linked = self._build_links() if self.options.dedup else set()
+        bundled = self._build_bundles(linked) if self.options.bundle else set()
+        bymethod = OrderedDict()
+        for url, rh in self.request_objects.iteritems():
+            if url in bundled or url in linked:
+                continue
+            bymethod.setdefault(rh.method, []).append((url, rh.filesize))
+        for method, items in bymethod.iteritems():
+            for batch in asyncfetchpush.pack(items, self.maxrequestsize,
+                    self.options.chunkcount):
+                grabber = self._new_async_req(method)
+                grabber.append(OrderedDict((url, self.request_objects[url].filepath)
+                    for url, size in batch))
+                self.async_requests.setdefault(method, []).append(grabber)
+
+    def _build_links(self):
+        '''
+        Upload each content once (--dedup). Of the PUTs of files with the
+        same sha256 the first is uploaded and the others wait for it, then
+        are made on the server from it (see asyncfetchpush.LinkedPut).
+        Content the server had before the run, in the --incremental index or
+        uploaded by the run --resume carries on, is linked straight away.
+        Returns the urls which aren't uploaded as usual
+        '''
+        self._checksum_requests()
+        if self.index is not None:
+            for url, checksum in self.index.checksums():
+                #Not from a url this run uploads something else to
+                if url not in self.request_objects:
+                    self.sources.setdefault(checksum, url)
+        grabber = self._new_async_req('PUT')
+        auth = (self.username, self.password) if self.username and self.password else None
+        first = {}
+        linked = set()
+        for url, rh in self.request_objects.iteritems():
+            if rh.method != 'PUT' or not rh.checksum:
+                continue
+            if rh.checksum in self.sources:
+                grabber.append_request(self._link(url, self.sources[rh.checksum],
+                    timeout=90, auth=auth))
+            elif rh.checksum in first:
+                self.waiting.setdefault(rh.checksum, []).append(url)
+            else:
+                first[rh.checksum] = url
+                continue
+            linked.add(url)
+        if grabber.appended:
+            self.async_requests.setdefault('PUT', []).append(grabber)
+        if linked:
+            print "Making {0} files on the server from a copy of the same content".format(
+                    len(linked))
+        return linked
+
+    def _link(self, url, source, timeout, auth):
+        rh = self.request_objects[url]
+        return asyncfetchpush.LinkedPut(url, rh.filepath, self.options.dedup,
+                source=source, checksum=rh.checksum, timeout=timeout, auth=auth)
+
+    def _put(self, url, timeout, auth):
+        #A PUT of url's file made after the first requests, eg. as a fallback
+        return asyncfetchpush.AsyncGetPush('PUT', url, self.request_objects[url].filepath,
+                timeout=timeout, auth=auth, chunk_size=self.chunk_size,
+                piece_size=self.options.piecesize * 1048576,
+                compress=self.options.compress,
+                compress_min=self.options.compressmin)
+
+    def _build_bundles(self, exclude=()):
+        '''
+        Group the PUTs of files no bigger than --bundle KiB under the bundle
+        root into tar archives the server unpacks, batched like any other
+        requests by --bundlesize and --bundlecount, apart from the urls in
+        exclude. Which file went in which archive is written to the
+        --bundlemanifest. Returns the urls bundled
+        '''
+        root = self.options.bundleroot or self.options.baseurl
+        if not root:
+            print "Error: --bundle needs a --bundleroot (or --baseurl) the archives are unpacked in"
+            exit(1)
+        root = root.rstrip('/') + '/'
+        header, value = self.options.bundleheader.split(':', 1)
+        headers = {header.strip(): value.strip()}
+
+        small = [(url, rh.filesize) for url, rh in self.request_objects.iteritems()
+                if rh.method == 'PUT' and url.startswith(root)
+                and rh.filesize <= self.options.bundle * 1024 and url not in exclude]
+        #Not worth it for a single file
+        if len(small) < 2:
+            return set()
+        grabber = self._new_async_req('PUT')
+        auth = (self.username, self.password) if self.username and self.password else None
+        manifest = {}
+        bundled = set()
+        batches = asyncfetchpush.pack(small, self.options.bundlesize * 1048576,
+                self.options.bundlecount)
+        for n, batch in enumerate(batches):
+            bundleurl = root + "bundle-{0:.0f}-{1}.tar".format(self.log_time * 1000, n)
+            members = [(urllib.unquote(url[len(root):]), self.request_objects[url].filepath)
+                    for url, size in batch]
+            grabber.append_request(asyncfetchpush.BundlePut(bundleurl, members,
+                headers, timeout=90, auth=auth, chunk_size=self.chunk_size))
+            self.bundles[bundleurl] = [url for url, size in batch]
+            manifest[bundleurl] = [dict(url=url, filepath=self.request_objects[url].filepath,
+                filesize=size, checksum=self.request_objects[url].checksum)
+                for url, size in batch]
+            bundled.update(self.bundles[bundleurl])
+        self.async_requests.setdefault('PUT', []).append(grabber)
+
+        fh = open(self.options.bundlemanifest, 'w')
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+        fh.close()
+        print "Bundling {0} files into {1} archives".format(len(bundled), len(batches))
+        return bundled
+
+    @staticmethod
+    def _host_rates(hostrates):
+        rates = {}
+        for hostrate in hostrates:
+            host, _, rate = hostrate.partition('=')
+            if not rate:
+                print "Error: --hostrate should be HOST=RATE, not " + hostrate
+                exit(1)
+            rates[host] = asyncfetchpush.parse_rate(rate)
+        return rates
+
+    def _new_async_req(self, method):
+        return asyncfetchpush.HttpGrabberPusher(method, limit=self.options.limit,
+                timeout=90, retries=self.retries, username=self.username,
+                password=self.password, chunk_size=self.chunk_size,
+                engine=self.options.engine, connections=self.connections,
+                piece_size=self.options.piecesize * 1048576,
+                segments=self.options.segments,
+                segment_size=self.options.segmentsize * 1048576,
+                throttle=self.throttle, metrics=self.metrics,
+                reporter=self.reporter, keep=False,
+                compress=self.options.compress,
+                compress_min=self.options.compressmin)
 
     def _continue_requests(self):
         self._incomplete_requests()
-        for url, rh in self.request_objects.iteritems():
-            self._build_async_req(url, rh)
+        self._build_async_reqs()
 
 
     def _write_to_log(self):
-        logfile_handle = open(self.logfile, 'w')
-        self.lf_json_all[self.log_time] = self.request_objects
-        logfile_handle.write(HTTPJsonEncoder(sort_keys=True, indent=3).encode(self.lf_json_all))
-        logfile_handle.close()
+        #Every request of this run, completions are appended as they happen
+        self.journal.start_run(self.log_time, ((url, rh.todict())
+            for url, rh in self.request_objects.iteritems()))
+
+    def _drop_request(self, url):
+        #Nothing more to do for url this run, a resume shouldn't retry it
+        if self.journal.run is not None:
+            self.journal.complete(url, self.request_objects[url].method, time.time())
+        del self.request_objects[url]
 
     def make_requests(self):
         try:
-            for method, chunks in self.async_requests.iteritems():
-                for requests in chunks:
-                    if not self.options.dry:
-                        print "Making requests..\n"
-                        requests.make_requests()
-                        responses = requests.request_response_dictionary()
-                        #failed = requests.request_failed_dictionary()
-                        for url, response in responses.iteritems():
-                            if response is True:
-                                self.request_objects[url].stamp()
-
-                        #for url, rcode in failed.iteritems()
-                        #    if rcode == 400:
-                        #        print "{0} failed with err {1}, deleting remote failed"
-
-            if self.options.check or self.options.checkonly:
+            if not self.options.dry:
+                print "Making requests..\n"
+                #Every chunk of every method goes through one queue, with
+                #--check each PUT queues its HEAD as soon as it completes
+                grabbers = itertools.chain(itertools.chain.from_iterable(
+                    self.async_requests.itervalues()), [self.stream] if self.stream is not None else [])
+                if self.options.workers > 1:
+                    self._sharded(list(grabbers))
+                else:
+                    self._pipeline(grabbers, self._request_completed)
+            elif self.options.check:
                 self._check_uploads()
+
+            if self.options.checkonly:
+                self._check_uploads()
+            self._report_connections()
+            self._report_limiter()
+            self._report_metrics()
+            self._report_compression()
+            self._report_dedup()
         except KeyError as e:
             print "Key error: " + str(e) + " does't exist in requests"
         except Exception as e:
             print "Error " + str(e)
         finally:
-            self._write_to_log()
+            if self.index is not None and not self.options.dry:
+                self.index.save()
+            self.journal.close()
+            if self.metrics is not None:
+                self.metrics.close()
+
+    def _pipeline(self, grabbers, on_complete=None):
+        pipeline = asyncfetchpush.Pipeline(grabbers, limit=self.limit,
+                retries=self.retries, engine=self.options.engine,
+                connections=self.connections, limiter=self.limiter,
+                throttle=self.throttle, metrics=self.metrics,
+                reporter=self.reporter, keep=False)
+        pipeline.make_requests(on_complete)
+        return pipeline
+
+    def _sharded(self, grabbers):
+        '''
+        Make the requests in --workers processes, each dealt an equal share
+        of them to make with its own engine, see asyncfetchpush_workers. The
+        journal, index and progress stay with this process, the workers send
+        it what they would have written to them
+        '''
+        workers = asyncfetchpush_workers.Workers(self.options.workers)
+        started = time.time()
+        self.reporter.start(sum(len(g) for g in grabbers))
+        workers.start(functools.partial(self._work, grabbers))
+        try:
+            failed = workers.run({'call': self._forwarded,
+                'progress': lambda counts: self.reporter.counted(*counts),
+                'finished': self._worker_finished})
+        finally:
+            self.reporter.finish()
+            self._stage('transfer', started)
+        if failed:
+            print "{0} of {1} workers failed, --resume to retry their requests".format(
+                    failed, self.options.workers)
+
+    def _work(self, grabbers, index, count, channel):
+        '''
+        A worker's share of the requests, made as they would be in a single
+        process but with the journal, index and progress sent to the
+        coordinator. Ends with its counters and connection and limiter stats
+        '''
+        #Kept so their buffers are never flushed (again) from this process
+        self.inherited = (self.journal, self.index, self.metrics)
+        self.journal = asyncfetchpush_workers.Forwarder(channel, 'journal',
+                run=self.journal.run)
+        if self.index is not None:
+            #Entries are only looked up in the copy of the index forked with
+            self.index = asyncfetchpush_workers.Forwarder(channel, 'index',
+                    get=self.index.get)
+        self.reporter = asyncfetchpush_workers.ChannelReporter(channel)
+        self._setup_transfers(index, count)
+        self._pipeline(asyncfetchpush_workers.deal(grabbers, index, count),
+                self._request_completed)
+        summary = {'worker': index, 'connections': self.connections.stats(),
+                'compressed': self.compressed, 'deduped': self.deduped,
+                'limiter': None, 'metrics': None}
+        if self.limiter is not None:
+            summary['limiter'] = (self.limiter.metrics(), self.limiter.decisions)
+        if self.metrics is not None:
+            summary['metrics'] = self.metrics.counters()
+            self.metrics.close()
+        channel.send('finished', summary)
+
+    def _forwarded(self, name, method, args, kwargs):
+        #A call a worker made on the journal or index
+        getattr({'journal': self.journal, 'index': self.index}[name], method)(*args, **kwargs)
+
+    def _worker_finished(self, summary):
+        requests, connections = summary['connections']
+        self.worker_connections[0] += requests
+        self.worker_connections[1] += connections
+        for n, count in enumerate(summary['compressed']):
+            self.compressed[n] += count
+        for n, count in enumerate(summary['deduped']):
+            self.deduped[n] += count
+        if summary['limiter'] is not None:
+            self.worker_limiters.append((summary['worker'],) + summary['limiter'])
+        if summary['metrics'] is not None and self.metrics is not None:
+            self.metrics.merge(summary['metrics'])
+
+    def _request_completed(self, r):
+        if r.url in self.bundles:
+            return self._bundle_completed(r)
+        if r.url not in self.request_objects:
+            return
+        if isinstance(r, asyncfetchpush.LinkedPut):
+            return self._link_completed(r)
+        if r.method == 'HEAD' and r.url in self.checking:
+            self.checking.discard(r.url)
+            if not self._verify_filesize(r.url, r.headers) and self.index is not None:
+                self.index.forget(r.url)
+            return
+        if r.method == 'HEAD' and r.url in self.sampling:
+            return self._verify_sample(r)
+        if not r.response:
+            return self._upload_failed(r)
+        if r.encoded is not None:
+            self.compressed[0] += 1
+            self.compressed[1] += r.bytes
+            self.compressed[2] += r.encoded
+        more = self._stamp(r, r.url, r.method)
+        if self.stream is not None and not more:
+            #Done with it, don't keep every url read
+            del self.request_objects[r.url]
+        return more
+
+    def _stamp(self, r, url, method):
+        '''
+        Record url as done by r. Returns the requests a PUT leads to, the
+        HEAD to verify it with --check and the --dedup copies waiting for it
+        '''
+        rh = self.request_objects[url]
+        rh.stamp()
+        if method == 'PUT' and r.url == url:
+            rh.encoded = r.encoded
+        self.journal.complete(url, rh.method, rh.completed_timestamp, encoded=rh.encoded)
+        if self.index is not None and method == 'PUT':
+            #The ETag of a bundle isn't the ETag of the files in it
+            etag = r.headers.get('etag') if r.headers and r.url == url else None
+            self.index.record(url, rh.filesize, rh.checksum, etag, rh.mtime, rh.encoded)
+        more = []
+        if self.options.check and method == 'PUT':
+            self.checking.add(url)
+            rh.change_to_check()
+            more.append(asyncfetchpush.AsyncGetPush('HEAD', url, rh.filepath,
+                timeout=r.timeout, auth=r.auth))
+        if method == 'PUT' and rh.checksum in self.waiting:
+            #The server has the content now, the copies waiting are made from it
+            self.sources[rh.checksum] = url
+            more.extend(self._link(waiting, url, r.timeout, r.auth) if self.linking
+                    else self._put(waiting, r.timeout, r.auth)
+                    for waiting in self.waiting.pop(rh.checksum))
+        return more
+
+    def _link_completed(self, r):
+        '''
+        A --dedup file made on the server is done as if it was uploaded, one
+        the server couldn't make is uploaded after all
+        '''
+        if r.response:
+            self.deduped[0] += 1
+            self.deduped[1] += self.request_objects[r.url].filesize
+            return self._stamp(r, r.url, 'PUT')
+        print "The server couldn't make {0} from {1}, uploading it".format(r.url,
+                r.source or r.checksum)
+        if r.rcode in (405, 501):
+            #Not something it does, upload the rest of the copies as well
+            self.linking = False
+        return [self._put(r.url, r.timeout, r.auth)]
+
+    def _upload_failed(self, r):
+        '''
+        With --dedup, when the first upload of a content fails for good the
+        next copy waiting for it is uploaded instead
+        '''
+        checksum = self.request_objects[r.url].checksum
+        if r.method != 'PUT' or checksum not in self.waiting:
+            return
+        url = self.waiting[checksum].pop(0)
+        if not self.waiting[checksum]:
+            del self.waiting[checksum]
+        return [self._put(url, r.timeout, r.auth)]
+
+    def _bundle_completed(self, r):
+        '''
+        Every file in a bundle which was unpacked is done (and with --check
+        gets its own HEAD), if the server wouldn't take the bundle they're
+        uploaded one at a time instead
+        '''
+        urls = self.bundles.pop(r.url)
+        more = []
+        if not r.response:
+            print "Bundle {0} failed, uploading its {1} files one at a time".format(
+                    r.url, len(urls))
+            for url in urls:
+                more.append(self._put(url, r.timeout, r.auth))
+            return more
+        for url in urls:
+            more.extend(self._stamp(r, url, 'PUT') or [])
+        return more
+
+    def _verify_sample(self, r):
+        '''
+        A HEAD for a file skipped by --incremental, if the server doesn't
+        match the index the index has drifted and the file is uploaded
+        '''
+        self.sampling.discard(r.url)
+        rh = self.request_objects[r.url]
+        entry = self.index.get(r.url)
+        if r.response:
+            etag = r.headers.get('etag')
+            if (int(r.headers.get('content-length', -1)) in (rh.filesize, entry.get('encoded'))
+                    and not (etag and entry['etag'] and etag != entry['etag'])):
+                #Still there as it was
+                self._drop_request(r.url)
+                return
+        print "Index is out of date for {0}, uploading it again".format(r.url)
+        self.index.forget(r.url)
+        rh.method = 'PUT'
+        return [self._put(r.url, r.timeout, r.auth)]
+
+    def _report_connections(self):
+        requests, connections = self.connections.stats()
+        requests += self.worker_connections[0]
+        connections += self.worker_connections[1]
+        if requests:
+            print "Connection reuse: {0:.1f}% ({1} connections for {2} requests)".format(
+                    max(requests - connections, 0) * 100.0 / requests, connections, requests)
+
+    def _report_limiter(self):
+        if self.limiter is None:
+            return
+        #One limiter, or one per worker
+        limiters = self.worker_limiters or [(None, self.limiter.metrics(), self.limiter.decisions)]
+        for worker, m, decisions in sorted(limiters):
+            print ("Concurrency limit{5}: {0} ({1} increases, {2} decreases,"
+                " range {3}-{4})").format(m['limit'], m['increases'],
+                        m['decreases'], m['minimum'], m['maximum'],
+                        "" if worker is None else " of worker {0}".format(worker))
+            if self.options.limiterlog:
+                lf = open(self.options.limiterlog, 'a')
+                for decision in decisions:
+                    lf.write(json.dumps(decision) + "\n")
+                lf.close()
+
+    def _report_compression(self):
+        if not self.compressed[0]:
+            return
+        files, size, encoded = self.compressed
+        print "Compressed: {0} files, {1} as {2} ({3:.1f}% smaller)".format(files,
+                size_to_string(size), size_to_string(encoded),
+                (1 - encoded / float(size)) * 100 if size else 0)
+
+    def _report_dedup(self):
+        if not self.deduped[0]:
+            return
+        files, size = self.deduped
+        print "Deduplicated: {0} files made on the server from content it had, {1} not uploaded".format(
+                files, size_to_string(size))
+
+    def _report_metrics(self):
+        '''
+        Where the time went, the mean of each part of a request and the
+        stages outside the transfers
+        '''
+        if self.metrics is None:
+            return
+        averages = self.metrics.averages()
+        print "Time per request: " + ", ".join("{0} {1:.1f}ms".format(name,
+            averages[name] * 1000) for name in self.metrics.TIMINGS if name in averages)
+        print "Time per stage: " + ", ".join("{0} {1:.2f}s".format(name, seconds)
+                for name, seconds in self.metrics.stages.iteritems())
+        print "Metrics overhead: {0:.3f}s".format(self.metrics.overhead)
 
     def _check_uploads(self):
         print "Checking uploaded files for filesize inconsistancies"
         #Change PUT to HEAD and make the requests
+        heads = []
         for url, rh in self.request_objects.iteritems():
             if rh.method == 'PUT':
                 rh.change_to_check()
-                self._build_async_req(url, rh)
-        headers = {}
-        for head in self.async_requests['HEAD']:
-            head.make_requests()
-            headers = merge_dictionaries(headers,head.request_header_dictionary())
-
-        for url in headers.keys():
-            try:
-                #print "Checking {0} is {1}".format(url, size_to_string(self.request_objects[url].filesize))
-                if int(headers[url]['content-length']) != int(self.request_objects[url].filesize):
-                    print ("filesize for {0} do not match:"
-                        "\nOriginal:\t\t{1}"
-                        "\nHead response:\t\t{2}").format(url,
-                                self.request_objects[url].filesize,
-                                headers[url]['content-length'])
-                else:
-                    #Already exists so pop it from our list, avoid reuploading
-                    del self.request_objects[url]
+                heads.append((url, rh.filesize))
+        #A HEAD sends no body, so only --chunkcount splits them
+        for batch in asyncfetchpush.pack(heads, 0, self.options.chunkcount):
+            grabber = self._new_async_req('HEAD')
+            grabber.append(OrderedDict((url, self.request_objects[url].filepath)
+                for url, size in batch))
+            self.async_requests.setdefault('HEAD', []).append(grabber)
+        #Each is checked as it completes, the requests aren't kept
+        self._pipeline(self.async_requests.get('HEAD', []), self._head_completed)
+
+    def _head_completed(self, r):
+        self._verify_filesize(r.url, r.headers)
+
+    def _verify_filesize(self, url, headers):
+        try:
+            #print "Checking {0} is {1}".format(url, size_to_string(self.request_objects[url].filesize))
+            rh = self.request_objects[url]
+            #The HEAD asks for the file as it is, unless the server kept the
+            #compressed body it was sent
+            if int(headers['content-length']) not in (int(rh.filesize), rh.encoded):
+                if (headers.get('content-encoding', 'identity') != 'identity'
+                        and rh.encoded is None):
+                    print "Can't check the filesize of {0}, the server has it compressed".format(url)
+                    return False
+                print ("filesize for {0} do not match:"
+                    "\nOriginal:\t\t{1}"
+                    "\nHead response:\t\t{2}").format(url,
+                            self.request_objects[url].filesize,
+                            headers['content-length'])
+                return False
+            else:
+                #Already exists so pop it from our list, avoid reuploading
+                self._drop_request(url)
+                return True
 
-            except KeyError as e:
-                print "url {} does not exist or did not return headers: Exception KeyError {}".format(url, e)
+        except KeyError as e:
+            print "url {} does not exist or did not return headers: Exception KeyError {}".format(url, e)
+            return False
 
     def __str__(self):
         ret = ""
@@ -322,8 +1045,8 @@ class HTTPRequests:
             ret += "\n\n" + str(method) + ":\n\t"
             for i in range(0,len(self.async_requests[method])):
                 ret += "\n\n Chunk {} of {}\n\t".format(i, len(self.async_requests[method]))
-                for request in self.async_requests[method][i].requestlist:
-                    ret += "\n\t" + str(request.url)
+                for url in self.async_requests[method][i].urls():
+                    ret += "\n\t" + str(url)
                     tnr += 1
 
         tfs = 0
@@ -336,15 +1059,11 @@ class HTTPRequests:
             "\nUsing username:\t{2}").format(size_to_string(tfs),
                                             str(tnr),
                                             self.username)
+        if self.stream is not None:
+            ret += "\nMore requests are made as the input is read"
 
         return ret
 
-#Used to write the HTTPRequestHelper object to json
-class HTTPJsonEncoder(json.JSONEncoder):
-
-    def default(self, obj):
-        return obj.__dict__
-
 '''
 This class is a helper to contain information about a single url/prerequest
 object
@@ -352,17 +1071,25 @@ object
 It provides functions to be called by
 '''
 class HTTPRequestHelper(object):
+    #One of these per url, no __dict__ keeps a long list small
+    __slots__ = ('filepath', 'completed_timestamp', 'method', 'filesize',
+            'checksum', 'mtime', 'encoded')
+
     def __init__(self, method, filepath, completed_timestamp=None,
-        filesize=0, checksum=None):
+        filesize=0, checksum=None, mtime=None, encoded=None):
 
         self.filepath = filepath
         self.completed_timestamp = completed_timestamp
         self.method = method
         self.filesize = filesize
+        self.checksum = checksum
+        self.mtime = mtime
+        #Bytes the file was uploaded as, if it was compressed
+        self.encoded = encoded
         if self.filesize == 0 and self.method == 'PUT':
             self.filesize = self._filesize()
-            if checksum is True:
-                self.checksum = self._checksum()
+        if self.checksum is True:
+            self.checksum = self._checksum()
 
     def _filesize(self):
         return filesize_check(self.filepath)
@@ -383,6 +1110,10 @@ class HTTPRequestHelper(object):
     def stamp(self):
         self.completed_timestamp = time.time()
 
+    #What the journal records, HTTPRequestHelper(**todict()) makes it again
+    def todict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
     #def change_to_delete(self):
     #    self.method = 'DELETE'
 
@@ -411,7 +1142,8 @@ def parse_args():
     op = optparse.OptionParser(description="Get/Push files in a asynchronous way.")
 
     #Just feed the script a premade JSON file, all options are set in here
-    op.add_option('-i', "--inputfile", dest='json', help=("a .json metafile to parse" "see example.json"))
+    op.add_option('-i', "--inputfile", dest='json', help=("a .json metafile to parse, see the README, or NDJSON with"
+        " a request per line"))
 
     #List our intentions
     op.add_option('-d', "--dry", action="store_true", default=False,
@@ -422,16 +1154,93 @@ def parse_args():
 
     op.add_option('-p', "--password", help=("Make the requests with a password"))
     op.add_option('', "--flatdirs", help=("Flatten the directory structure"), action="store_true", default=False)
-    op.add_option('', "--resume", help=("Resume operations from async.log.json"), action="store_true", default=False)
+    op.add_option('', "--resume", help=("Resume the last run recorded in the journal"), action="store_true", default=False)
+    op.add_option('', "--journal", default="async.log.ndjson",
+            help=("Append-only log of every run's requests and completions"))
+    op.add_option('', "--journalsync", type="int", default=100,
+            help=("Completions written to the journal between fsyncs"))
+    op.add_option('', "--journalmaxsize", type="int", default=64,
+            help=("Start a new journal once it's this many MiB, keeping the"
+                " last 3 as .1 .2 .3"))
+    op.add_option('', "--compactlog", action="store_true", default=False,
+            help=("Rewrite the journal as just the last run before starting"))
+    op.add_option('', "--engine", type="choice", choices=asyncfetchpush.ENGINES,
+            default='gevent', help=("Transfer engine to make the requests with,"
+                " one of " + ", ".join(asyncfetchpush.ENGINES)))
+    op.add_option('', "--limit", type="int", default=250,
+            help=("Maximum number of requests in flight"))
+    op.add_option('', "--workers", type="int", default=1,
+            help=("Make the requests in this many processes, each with its own"
+                " engine and share of --limit, --maxconns and the rate limits"))
+    op.add_option('', "--adaptive", action="store_true", default=False,
+            help=("Adapt the number of requests in flight (up to --limit) to"
+                " the server's latency and errors"))
+    op.add_option('', "--minlimit", type="int", default=4,
+            help=("With --adaptive never drop below this many requests in flight"))
+    op.add_option('', "--limiterlog", help=("With --adaptive append each"
+            " change of the limit to this file as a json line"))
+    op.add_option('', "--maxconns", type="int", default=250,
+            help=("Maximum number of connections open to each host at once"))
+    op.add_option('', "--http2", action="store_true", default=False,
+            help=("Make the requests over HTTP/2, up to 100 at once over each"
+                " of --maxconns connections per host. Needs hyper"))
+    op.add_option('', "--rate",
+            help=("Limit all transfers together to this many bytes per second,"
+                " eg. 512K, 20M or 1G"))
+    op.add_option('', "--hostrate", action="append", metavar="HOST=RATE",
+            help=("Limit transfers to and from HOST to RATE bytes per second,"
+                " can be given more than once"))
+    op.add_option('', "--ratecontrol", metavar="FILE",
+            help=("Json file of rate limits, reread while running when it"
+                " changes or on SIGUSR1, eg. {\"rate\": \"50M\","
+                " \"hosts\": {\"foo.com\": \"10M\"}}"))
+    op.add_option('', "--progress", type="choice", choices=('bar', 'log', 'none'),
+            help=("How to show progress: bar (the default on a terminal), log"
+                " (a line every --progressinterval seconds, the default otherwise)"
+                " or none"))
+    op.add_option('', "--progressinterval", type="float", default=30.0,
+            help=("Seconds between lines of --progress log"))
+    op.add_option('-q', "--quiet", action="store_const", const="none", dest="progress",
+            help=("No progress, the same as --progress none"))
+    op.add_option('', "--metrics", metavar="FILE",
+            help=("Append the timings of every request (dns, connect, tls,"
+                " time to first byte, transfer) and snapshots of the run's"
+                " counters to this file as json lines"))
+    op.add_option('', "--prometheus", metavar="FILE",
+            help=("Keep the run's counters in this file in the Prometheus"
+                " text format, eg. for node_exporter's textfile collector"))
+    op.add_option('', "--metricsinterval", type="float", default=10.0,
+            help=("Seconds between snapshots of the counters"))
+    op.add_option('', "--chunksize", type="int", default=asyncfetchpush.CHUNK_SIZE / 1024,
+            help=("Size in KiB of the chunks streamed to/from disk per request"))
+    op.add_option('', "--compress", type="choice", choices=asyncfetchpush.ENCODINGS,
+            help=("Compress PUT bodies worth compressing (not jars, archives,"
+                " images...) as they are sent, with this Content-Encoding: "
+                + ", ".join(asyncfetchpush.ENCODINGS) + ". zstd needs zstandard"))
+    op.add_option('', "--compressmin", type="int", default=asyncfetchpush.COMPRESS_MIN,
+            help=("Smallest file in bytes to compress with --compress"))
+    op.add_option('', "--piecesize", type="int", default=0,
+            help=("PUT files bigger than this many MiB as a resumable upload"
+                " in pieces of this size, if the server supports Content-Range"
+                " uploads. 0 (default) sends every file in one PUT"))
     ''' Fetch (GET) opts'''
     fetchopt = optparse.OptionGroup(op, "HTTP GET options",
             "Options for fetching files, output dir, link file/list etc")
 
     fetchopt.add_option("", "--urlfile", type="string",
-            help=("A list of urls, newline seperated"))
+            help=("A list of urls to GET, newline seperated, saved under"
+                " --destination"))
 
     fetchopt.add_option("", "--get", dest="gstdin",
-            help=("Read a list of URLs from stdin"), action="store_true", default=False)
+            help=("Read a list of URLs to GET from stdin"), action="store_true", default=False)
+
+    fetchopt.add_option("", "--segments", type="int", default=0,
+            help=("Download large files as up to this many byte ranges at"
+                " once, when the server accepts ranges"))
+
+    fetchopt.add_option("", "--segmentsize", type="int",
+            default=asyncfetchpush.SEGMENT_SIZE / 1048576,
+            help=("Smallest range in MiB a download is split into with --segments"))
 
     fetchopt.add_option("", "--destination", type="string",
             help=("A destination directory for the fetched files\n"
@@ -446,16 +1255,59 @@ def parse_args():
     putopt.add_option("", "--basedir", type="string",
             help=("Base directory from which to upload all files and folders"))
 
+    putopt.add_option("", "--scanworkers", type="int", default=asyncfetchpush_fs.SCAN_WORKERS,
+            help=("Number of directories under --basedir listed at once"))
+
     putopt.add_option("", "--put", dest="pstdin",
             help=("Read a list of files from stdin, newline seperated"), action="store_true", default=False)
 
+    putopt.add_option('', "--checksum", action="store_true", default=False,
+            help=("sha256 the files to upload, in parallel, recorded in the log"))
+    putopt.add_option('', "--hashworkers", type="int", default=None,
+            help=("Number of threads hashing files, one per cpu by default"))
+    putopt.add_option('', "--dedup", type="choice", choices=asyncfetchpush.LINK_METHODS,
+            help=("Upload files with the same content (sha256) once, the other"
+                " copies are made on the server from it: copy (a WebDAV COPY) or"
+                " checksum (a checksum deploy, eg. Artifactory). With --incremental"
+                " content uploaded by earlier runs is reused too. Hashes the files"
+                " as --checksum"))
+    putopt.add_option('', "--digestcache", default="async.digests.json",
+            help=("File caching the sha256 of files between runs"))
+    putopt.add_option('', "--digestcachesize", type="int", default=100000,
+            help=("The most digests to keep in the cache"))
+
+    putopt.add_option('', "--incremental", action="store_true", default=False,
+            help=("Only upload files which changed since they were last uploaded,"
+                " according to the index of earlier uploads"))
+    putopt.add_option('', "--index", default="async.index.json",
+            help=("File recording every successful upload for --incremental"))
+    putopt.add_option('', "--verifysample", type="float", default=0.0,
+            help=("With --incremental HEAD this fraction (0-1) of the skipped"
+                " files and upload any the server doesn't have"))
+
+    putopt.add_option('', "--bundle", type="int", default=0,
+            help=("Upload files up to this many KiB as tar archives the server"
+                " unpacks, eg. Artifactory. 0 (default) uploads every file on its own"))
+    putopt.add_option('', "--bundleroot", help=("The url archives are unpacked"
+            " in, only files under it are bundled. --baseurl by default"))
+    putopt.add_option('', "--bundlesize", type="int", default=64,
+            help=("Aim for archives of at most this many MiB"))
+    putopt.add_option('', "--bundlecount", type="int", default=1000,
+            help=("Aim for at most this many files per archive"))
+    putopt.add_option('', "--bundleheader", default="X-Explode-Archive: true",
+            help=("Header asking the server to unpack an archive"))
+    putopt.add_option('', "--bundlemanifest", default="async.bundles.json",
+            help=("File listing which files went in which archive"))
+
     putopt.add_option('', "--size", type="int", default=0, help=("Aim to send number of files to send in MiB"))
+    putopt.add_option('', "--chunkcount", type="int", default=0,
+            help=("Aim for at most this many requests per chunk"))
 
     putstdinopt = optparse.OptionGroup(op, "HTTP PUT STDIN options",
             "Options for pusing files via stdin")
 
     putstdinopt.add_option("", "--stdinjson", dest="pstdin_json", action="store_true", default=False,
-            help=("Read stdin as json"))
+            help=("Read stdin as json (or NDJSON)"))
 
     putstdinopt.add_option("", "--baseurl", dest="baseurl",
             help=("The base URL for puts eg. http://foo.com/somedir/"))
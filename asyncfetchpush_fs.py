@@ -0,0 +1,214 @@
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+import Queue
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+try:
+    from os import scandir
+except ImportError:
+    #The backport, os.scandir is python 3.5+
+    from scandir import scandir
+'''
+Local filesystem helpers for asyncfetchpush_cmd, walking directories,
+hashing files and caching their digests between runs
+'''
+
+#Directories listed at once while walking a tree
+SCAN_WORKERS = 8
+
+#Bytes read per update while hashing a file
+HASH_BLOCK_SIZE = 1048576
+
+#sha256 of a file, read HASH_BLOCK_SIZE bytes at a time
+def shasum(filepath, blocksize=HASH_BLOCK_SIZE):
+    h = hashlib.sha256()
+    fh = open(filepath, 'rb')
+    try:
+        block = fh.read(blocksize)
+        while block:
+            h.update(block)
+            block = fh.read(blocksize)
+    finally:
+        fh.close()
+    return h.hexdigest()
+
+'''
+Digests of files which haven't changed since they were last hashed
+
+Entries are keyed by (path, size, mtime, device, inode) so a file which is
+modified, replaced or moved is hashed again. The cache is saved as json and
+holds at most maxentries, dropping the least recently used first.
+
+Args:
+    path - The json file the cache is loaded from and saved to
+    maxentries - The most digests to keep
+
+Example:
+
+    cache = DigestCache('async.digests.json')
+    digest = cache.get('/tmp/bar.jar')
+    if digest is None:
+        cache.put('/tmp/bar.jar', shasum('/tmp/bar.jar'))
+    cache.save()
+'''
+class DigestCache(object):
+
+    def __init__(self, path="async.digests.json", maxentries=100000):
+        self.path = path
+        self.maxentries = maxentries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            fh = open(self.path, 'r')
+            try:
+                #Saved least recently used first
+                for key, digest in json.load(fh)[-self.maxentries:]:
+                    self.entries[key] = digest
+            finally:
+                fh.close()
+        except (IOError, ValueError, TypeError):
+            self.entries = OrderedDict()
+
+    @staticmethod
+    def key(path, st=None):
+        if st is None:
+            st = os.stat(path)
+        return "{0}:{1}:{2!r}:{3}:{4}".format(os.path.realpath(path),
+                st.st_size, st.st_mtime, st.st_dev, st.st_ino)
+
+    def get(self, path, st=None):
+        key = self.key(path, st)
+        with self._lock:
+            digest = self.entries.pop(key, None)
+            if digest is None:
+                self.misses += 1
+                return None
+            #Most recently used go to the end
+            self.entries[key] = digest
+            self.hits += 1
+            return digest
+
+    def put(self, path, digest, st=None):
+        key = self.key(path, st)
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = digest
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        with self._lock:
+            tmppath = self.path + '.tmp'
+            fh = open(tmppath, 'w')
+            json.dump(self.entries.items(), fh)
+            fh.close()
+            os.rename(tmppath, self.path)
+
+'''
+sha256 every file in paths using a pool of worker threads
+
+hashlib and file reads release the GIL so the threads hash in parallel.
+Digests found in cache aren't recalculated and new ones are added to it.
+
+Args:
+    paths - An iterable of file paths
+    cache - A DigestCache, optional
+    workers - The number of threads, one per cpu by default
+    stats - A dictionary of path : stat result already fetched, eg. by
+            scan_tree, saves stat'ing those files again
+
+Returns a dictionary of path : digest
+'''
+def checksum_files(paths, cache=None, workers=None, stats=None):
+    digests = {}
+    tohash = []
+    for path in paths:
+        st = stats.get(path) if stats else None
+        if st is None:
+            st = os.stat(path)
+        digest = cache.get(path, st) if cache is not None else None
+        if digest is None:
+            tohash.append((path, st))
+        else:
+            digests[path] = digest
+
+    if not tohash:
+        return digests
+
+    pool = ThreadPool(workers or multiprocessing.cpu_count())
+    try:
+        hashed = pool.imap_unordered(_hash_one, tohash)
+        for path, st, digest in hashed:
+            digests[path] = digest
+            if cache is not None:
+                cache.put(path, digest, st)
+    finally:
+        pool.close()
+        pool.join()
+    return digests
+
+def _hash_one(item):
+    path, st = item
+    return path, st, shasum(path)
+
+'''
+Walk a directory tree, listing directories on a pool of threads
+
+Each directory is listed with scandir by whichever thread is free, so on a
+network filesystem many listings are in flight at once, and the subtrees it
+finds are queued as they turn up. Files are yielded as soon as their
+directory has been listed, with the stat result scandir already fetched.
+Symlinks to directories aren't followed. The order files are yielded in
+isn't defined.
+
+Args:
+    basedir - The root of the tree
+    workers - The number of directories listed at once
+
+Example:
+
+    for path, st in scan_tree('/tmp/artifacts'):
+        print path, st.st_size
+'''
+def scan_tree(basedir, workers=SCAN_WORKERS):
+    pool = ThreadPool(workers)
+    listed = Queue.Queue()
+    pending = 0
+    try:
+        pool.apply_async(_scan_dir, (basedir,), callback=listed.put)
+        pending += 1
+        while pending:
+            #A timeout keeps the main thread interruptible on python 2
+            dirpath, files, subdirs, error = listed.get(True, 86400)
+            pending -= 1
+            if error is not None:
+                print "Error: can't list {}: {}".format(dirpath, error)
+            for subdir in subdirs:
+                pool.apply_async(_scan_dir, (subdir,), callback=listed.put)
+                pending += 1
+            for item in files:
+                yield item
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _scan_dir(dirpath):
+    files = []
+    subdirs = []
+    try:
+        for entry in scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                files.append((entry.path, entry.stat()))
+    except OSError as e:
+        return dirpath, files, subdirs, e.strerror
+    return dirpath, files, subdirs, None
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import itertools
+import StringIO
+import urllib
+import urlparse
+'''
+Readers of the lists of requests asyncfetchpush_cmd takes, which parse their
+input a block or a line at a time so requests can be made from the first
+entries while the rest are still being read, and a list of millions of
+entries is never held as one json document
+'''
+
+#Bytes read at a time by the json reader
+BLOCK_SIZE = 65536
+
+_WHITESPACE = ' \t\r\n'
+_SCALAR = re.compile(r'[^\s,:\[\]{}"]+')
+
+#The tokens of a json document, ('"', string), ('v', number/true/false/null)
+#or (punctuation, None)
+def _tokens(blocks):
+    buf = ''
+    i = 0
+    for block in itertools.chain(blocks, [None]):
+        eof = block is None
+        if not eof:
+            buf = buf[i:] + block
+            i = 0
+        while True:
+            while i < len(buf) and buf[i] in _WHITESPACE:
+                i += 1
+            if i >= len(buf):
+                break
+            c = buf[i]
+            if c in '{}[]:,':
+                yield c, None
+                i += 1
+            elif c == '"':
+                try:
+                    value, end = json.decoder.scanstring(buf, i + 1, 'utf-8', True)
+                except ValueError:
+                    #Cut off by the end of the block
+                    if eof:
+                        raise
+                    break
+                yield '"', value
+                i = end
+            else:
+                m = _SCALAR.match(buf, i)
+                if m is None:
+                    raise ValueError("Unexpected {0!r} in json".format(c))
+                if m.end() == len(buf) and not eof:
+                    break
+                yield 'v', json.loads(m.group())
+                i = m.end()
+
+'''
+(path, value) of every string, number, true, false or null in a json
+document, where path is the tuple of keys (and list indices) leading to it.
+Read from blocks, an iterable of strings, so the document is never held in
+memory as a whole
+
+Example:
+
+    for path, value in iter_json(iter(lambda: fh.read(65536), '')):
+        #{"a": {"b": [1, 2]}} gives (('a', 'b', 0), 1) and (('a', 'b', 1), 2)
+'''
+def iter_json(blocks):
+    kinds = []
+    keys = []
+    expecting_key = False
+    for token, value in _tokens(blocks):
+        if token == '{' or token == '[':
+            kinds.append(token)
+            keys.append(None if token == '{' else 0)
+            expecting_key = token == '{'
+        elif token == '}' or token == ']':
+            kinds.pop()
+            keys.pop()
+            expecting_key = False
+        elif token == ',':
+            if kinds and kinds[-1] == '[':
+                keys[-1] += 1
+            else:
+                expecting_key = True
+        elif token == ':':
+            continue
+        elif expecting_key:
+            keys[-1] = value
+            expecting_key = False
+        else:
+            yield tuple(keys), value
+
+#Whether line is a line of NDJSON rather than the start of a json document
+def _is_ndjson(line):
+    try:
+        entry = json.loads(line)
+    except (ValueError, TypeError):
+        return False
+    return isinstance(entry, dict) and 'url' in entry
+
+'''
+The requests of a json or NDJSON manifest, read as they are iterated
+
+json is the HTTPAsyncData format, a map of method to a map of url to
+filepath, any other string under HTTPAsyncData (eg. username, password) is
+kept in settings as it is read. NDJSON has a request per line, spotted by
+the first line being an object with a url:
+
+    {"method": "PUT", "url": "https://foo.com/bar.jar", "filepath": "/tmp/bar.jar"}
+
+Lines without a method are method (if given) and lines which aren't a
+request are skipped with a warning.
+
+Args:
+    fh - The file (or stdin) to read
+    method - The method of NDJSON lines without one
+
+Example:
+
+    manifest = Manifest(open('uploadlist.json'))
+    for method, url, filepath in manifest:
+        print method, url, filepath
+    print manifest.settings.get('username')
+'''
+class Manifest(object):
+
+    def __init__(self, fh, method=None, blocksize=BLOCK_SIZE):
+        self.fh = fh
+        self.method = method
+        self.blocksize = blocksize
+        self.settings = {}
+        self.format = None
+        #Requests read so far
+        self.count = 0
+
+    #The format is told from the first line of the first block, a json
+    #document all on one line is never read whole to find its end. The block
+    #is then given back to the reader of that format
+    def __iter__(self):
+        head = self.fh.read(self.blocksize)
+        first = next((line for line in head.splitlines(True) if line.strip()), '')
+        whole = first.endswith('\n') or len(head) < self.blocksize
+        if whole and _is_ndjson(first):
+            self.format = 'ndjson'
+            #readline finishes the line the block ended in
+            entries = self._ndjson(itertools.chain(
+                StringIO.StringIO(head + self.fh.readline()), iter(self.fh.readline, '')))
+        else:
+            self.format = 'json'
+            entries = self._json(itertools.chain([head],
+                iter(lambda: self.fh.read(self.blocksize), '')))
+        for entry in entries:
+            self.count += 1
+            yield entry
+
+    def _json(self, blocks):
+        for path, value in iter_json(blocks):
+            if not path or path[0] != 'HTTPAsyncData':
+                continue
+            if len(path) == 3 and isinstance(value, basestring):
+                yield path[1], path[2], value
+            elif len(path) == 2:
+                self.settings[path[1]] = value
+
+    def _ndjson(self, lines):
+        for n, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                yield (entry.get('method', self.method) or entry['method'],
+                        entry['url'], entry['filepath'])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                print "Warning: skipping line {0} of the manifest, not a request".format(n + 1)
+
+'''
+(url, filepath) to GET each url of a newline separated list to, under
+destination. The file keeps the url's path below destination (or just its
+name with flatdirs) and its directory is made as it is read. Blank lines
+and lines starting with # are skipped, as are urls which wouldn't be saved
+under destination.
+'''
+def read_urls(fh, destination, flatdirs=False):
+    destination = os.path.abspath(destination)
+    made = set()
+    for line in iter(fh.readline, ''):
+        url = line.strip()
+        if not url or url.startswith('#'):
+            continue
+        name = urllib.unquote(urlparse.urlparse(url).path)
+        if flatdirs:
+            name = name.rsplit('/', 1)[-1]
+        filepath = os.path.normpath(os.path.join(destination, *name.split('/')))
+        if not filepath.startswith(destination + os.sep):
+            print "Warning: skipping {0}, it has no file name under {1}".format(url, destination)
+            continue
+        directory = os.path.dirname(filepath)
+        if directory not in made:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            made.add(directory)
+        yield url, filepath
+
+'''
+(url, filepath) to PUT each file of a newline separated list to, the url is
+baseurl plus the file's path (or just its name with flatdirs). Absolute
+paths keep their whole path under baseurl, paths leading out of the current
+directory with .. are skipped.
+'''
+def read_files(fh, baseurl, flatdirs=False):
+    baseurl = baseurl.rstrip('/') + '/'
+    for line in iter(fh.readline, ''):
+        filepath = line.rstrip('\r\n')
+        if not filepath.strip():
+            continue
+        name = os.path.normpath(filepath)
+        if flatdirs:
+            name = os.path.basename(name)
+        name = name.lstrip(os.sep)
+        if name == '..' or name.startswith('..' + os.sep):
+            print "Warning: skipping {0}, it is outside the current directory".format(filepath)
+            continue
+        yield baseurl + name.replace(os.sep, '/'), filepath
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+from collections import OrderedDict
+'''
+State asyncfetchpush_cmd keeps between runs, a journal of the requests each
+run made and an index of what has been pushed to remote servers so an
+incremental upload can tell which files are unchanged without asking the
+server about each one
+'''
+
+'''
+An index of successfully uploaded urls
+
+Each url maps to the size, sha256 and mtime of the file which was uploaded,
+the ETag the server answered with (if any), the size it was sent as if it
+was compressed and when the upload completed.
+Entries are only recorded from responses the uploads already get, the index
+is saved as json. While entries change it is saved every saveinterval
+seconds, so a run which is killed keeps most of what it uploaded, and
+should be saved once more at the end.
+
+Args:
+    path - The json file the index is loaded from and saved to
+    saveinterval - Most seconds between saves while entries change, 0 only
+                   saves when save() is called
+
+Example:
+
+    index = RemoteIndex('async.index.json')
+    if not index.unchanged('https://foo.com/bar.jar', 152364, mtime=1429795306.0):
+        #upload it then
+        index.record('https://foo.com/bar.jar', 152364, mtime=1429795306.0)
+    index.save()
+'''
+class RemoteIndex(object):
+
+    def __init__(self, path="async.index.json", saveinterval=30.0):
+        self.path = path
+        self.saveinterval = saveinterval
+        self.entries = {}
+        self._saved = time.time()
+        self._load()
+
+    def _load(self):
+        try:
+            fh = open(self.path, 'r')
+            try:
+                self.entries = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            self.entries = {}
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def record(self, url, size, checksum=None, etag=None, mtime=None, encoded=None):
+        self.entries[url] = {'size': size, 'checksum': checksum, 'etag': etag,
+                'mtime': mtime, 'encoded': encoded, 'timestamp': time.time()}
+        self._changed()
+
+    def forget(self, url):
+        self.entries.pop(url, None)
+        self._changed()
+
+    def _changed(self):
+        if self.saveinterval and time.time() - self._saved >= self.saveinterval:
+            self.save()
+
+    #(url, sha256) of every entry uploaded with a sha256
+    def checksums(self):
+        for url, entry in self.entries.iteritems():
+            if entry.get('checksum'):
+                yield url, entry['checksum']
+
+    '''
+    Whether the file last uploaded to url is the same as a file of this
+    size, sha256 and mtime. The sha256 decides if both sides have one,
+    otherwise the size and mtime have to match.
+    '''
+    def unchanged(self, url, size, checksum=None, mtime=None):
+        entry = self.entries.get(url)
+        if entry is None or entry['size'] != size:
+            return False
+        if checksum and entry['checksum']:
+            return checksum == entry['checksum']
+        return mtime is not None and entry['mtime'] == mtime
+
+    def save(self):
+        tmppath = self.path + '.tmp'
+        fh = open(tmppath, 'w')
+        json.dump(self.entries, fh)
+        fh.close()
+        os.rename(tmppath, self.path)
+        self._saved = time.time()
+
+'''
+An append-only log of runs, one json object per line
+
+A run starts with a header line followed by a line per request, written and
+synced before any request is made (requests streamed from a manifest are
+added as each is read). Completions are appended as they happen, each is
+flushed to the OS straight away and fsync'd in batches of syncevery
+(or every syncinterval seconds) so a crash loses at most the last batch on a
+machine crash and nothing on a process crash. Where the last run starts is
+kept in path.last so loading it only reads that run, not all history.
+
+When the journal grows past maxbytes the next run starts a new file, the
+old ones are kept as path.1 ... path.keep. compact() rewrites the journal as
+just the last run with its completions folded in.
+
+    {"run": 1429795306.08}
+    {"run": 1429795306.08, "url": "https://foo.com/bar.jar", "request": {"method": "PUT", ...}}
+    {"run": 1429795306.08, "url": "https://foo.com/bar.jar", "method": "PUT", "completed_timestamp": 1429795309.1}
+
+Args:
+    path - The journal file
+    syncevery - Completions written between fsyncs
+    syncinterval - Most seconds between fsyncs while completions arrive
+    maxbytes - Size at which the journal is rotated, 0 never rotates
+    keep - The number of rotated journals kept
+'''
+class Journal(object):
+
+    def __init__(self, path="async.log.ndjson", syncevery=100, syncinterval=1.0,
+            maxbytes=67108864, keep=3):
+        self.path = path
+        self.syncevery = syncevery
+        self.syncinterval = syncinterval
+        self.maxbytes = maxbytes
+        self.keep = keep
+        self.run = None
+        self._fh = None
+        self._unsynced = 0
+        self._lastsync = time.time()
+
+    def _open(self):
+        if self._fh is None:
+            self._fh = open(self.path, 'ab')
+        return self._fh
+
+    def _write(self, record):
+        fh = self._open()
+        fh.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def sync(self):
+        if self._fh is None:
+            return
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+        self._lastsync = time.time()
+
+    def close(self):
+        if self._fh is not None:
+            self.sync()
+            self._fh.close()
+            self._fh = None
+
+    def _rotate(self):
+        self.close()
+        for i in xrange(self.keep - 1, 0, -1):
+            if os.path.exists("{0}.{1}".format(self.path, i)):
+                os.rename("{0}.{1}".format(self.path, i),
+                        "{0}.{1}".format(self.path, i + 1))
+        if self.keep > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    '''
+    Record the start of a run and every request in it
+
+    Args:
+        run - The run's timestamp
+        requests - An iterable of (url, dictionary describing the request)
+    '''
+    def start_run(self, run, requests):
+        try:
+            if self.maxbytes and os.path.getsize(self.path) > self.maxbytes:
+                self._rotate()
+        except OSError:
+            pass
+        self.run = run
+        fh = self._open()
+        fh.seek(0, os.SEEK_END)
+        offset = fh.tell()
+        if offset and not self._ends_with_newline():
+            #The last run was cut off mid line
+            fh.write("\n")
+            offset += 1
+        self._write({'run': run})
+        for url, request in requests:
+            self._write({'run': run, 'url': url, 'request': request})
+        self.sync()
+        self._write_last(run, offset)
+
+    def _ends_with_newline(self):
+        fh = open(self.path, 'rb')
+        try:
+            fh.seek(-1, os.SEEK_END)
+            return fh.read(1) == "\n"
+        finally:
+            fh.close()
+
+    def _write_last(self, run, offset):
+        tmppath = self.path + '.last.tmp'
+        fh = open(tmppath, 'w')
+        json.dump({'run': run, 'offset': offset}, fh)
+        fh.close()
+        os.rename(tmppath, self.path + '.last')
+
+    #Record a request of the current run read after it started, eg. from a
+    #streamed manifest, before it is made
+    def add(self, url, request):
+        self._write({'run': self.run, 'url': url, 'request': request})
+        self._written()
+
+    #Record a request of the current run completing, with any fields of its
+    #request which changed (those which are None aren't written)
+    def complete(self, url, method, timestamp, **fields):
+        record = {'run': self.run, 'url': url, 'method': method,
+            'completed_timestamp': timestamp}
+        record.update((name, value) for name, value in fields.iteritems()
+                if value is not None)
+        self._write(record)
+        self._written()
+
+    def _written(self):
+        self._fh.flush()
+        self._unsynced += 1
+        if (self._unsynced >= self.syncevery
+                or time.time() - self._lastsync >= self.syncinterval):
+            self.sync()
+
+    def _last_offset(self):
+        try:
+            fh = open(self.path + '.last', 'r')
+            try:
+                offset = json.load(fh)['offset']
+            finally:
+                fh.close()
+            if offset <= os.path.getsize(self.path):
+                return offset
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+        #No index, find the last run header the slow way
+        offset = None
+        try:
+            fh = open(self.path, 'rb')
+        except IOError:
+            return None
+        try:
+            pos = 0
+            for line in fh:
+                #Keys are sorted so only headers start with run
+                if line.startswith('{"run": ') and self._header(line):
+                    offset = pos
+                pos += len(line)
+        finally:
+            fh.close()
+        return offset
+
+    @staticmethod
+    def _header(line):
+        try:
+            return json.loads(line).keys() == ['run']
+        except ValueError:
+            return False
+
+    '''
+    The requests of the last run with their completions applied
+
+    Returns (run timestamp, OrderedDict of url : request dictionary) or
+    (None, empty OrderedDict) if there is no journal
+    '''
+    def last_run(self):
+        requests = OrderedDict()
+        offset = self._last_offset()
+        if offset is None:
+            return None, requests
+        try:
+            fh = open(self.path, 'rb')
+        except IOError:
+            return None, requests
+        run = None
+        try:
+            fh.seek(offset)
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #Torn write from a crash
+                    continue
+                if 'url' not in record:
+                    if run is not None and record['run'] != run:
+                        break
+                    run = record['run']
+                elif record['run'] != run:
+                    continue
+                elif 'request' in record:
+                    requests[record['url']] = record['request']
+                elif record['url'] in requests:
+                    for name, value in record.iteritems():
+                        if name not in ('run', 'url'):
+                            requests[record['url']][name] = value
+        finally:
+            fh.close()
+        return run, requests
+
+    #Rewrite the journal as only the last run, one line per request
+    def compact(self):
+        run, requests = self.last_run()
+        self.close()
+        if run is None:
+            return
+        tmppath = self.path + '.tmp'
+        fh = open(tmppath, 'wb')
+        fh.write(json.dumps({'run': run}, sort_keys=True) + "\n")
+        for url, request in requests.iteritems():
+            fh.write(json.dumps({'run': run, 'url': url, 'request': request},
+                sort_keys=True) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+        os.rename(tmppath, self.path)
+        self._write_last(run, 0)
@@ -0,0 +1,213 @@
+import os
+import sys
+import errno
+import random
+import select
+import struct
+import cPickle
+import threading
+import traceback
+import asyncfetchpush
+'''
+Making the requests of one run in several processes, so TLS, compression
+and the engines' own overhead aren't held to a single cpu core
+
+A coordinator forks the workers once the list of requests is known, each
+worker is dealt its share of the requests and makes them with an engine of
+its own. Anything which has to stay in one place (eg. the journal) is left
+with the coordinator, the workers send it messages over a pipe each, which
+the coordinator hands to its handlers as they arrive.
+
+Linux and other unixes only, the workers are forked.
+
+Example:
+
+    def work(index, count, channel):
+        journal = Forwarder(channel, 'journal')
+        pipeline = asyncfetchpush.Pipeline(deal(grabbers, index, count),
+                reporter=ChannelReporter(channel))
+        pipeline.make_requests(lambda r: journal.complete(r.url, r.method, time.time()))
+
+    workers = Workers(4)
+    workers.start(work)
+    workers.run({'call': lambda name, method, args, kwargs:
+                    getattr(journal, method)(*args, **kwargs),
+                 'progress': lambda counts: reporter.counted(*counts)})
+'''
+
+#Length prefixing each pickled message
+_HEADER = struct.Struct('!I')
+
+'''
+Keep only the index-th of every count requests of grabbers (a list of
+HttpGrabberPushers), dealt in turn across the grabbers like cards. Batches
+made by pack are largest first so each worker gets about as many bytes as
+requests. Called in a worker, every worker is dealt from the same list
+'''
+def deal(grabbers, index, count):
+    n = 0
+    for grabber in grabbers:
+        appended = []
+        for r in grabber.appended:
+            if n % count == index:
+                appended.append(r)
+            n += 1
+        jobs = asyncfetchpush.JobList()
+        for url, filepath in grabber.jobs:
+            if n % count == index:
+                jobs.append(url, filepath)
+            n += 1
+        grabber.appended = appended
+        grabber.jobs = jobs
+    return grabbers
+
+'''
+The writing end of a worker's pipe to the coordinator, send is safe to call
+from any thread or greenlet of the worker
+'''
+class Channel(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._lock = threading.Lock()
+
+    def send(self, kind, *args):
+        message = cPickle.dumps((kind,) + args, cPickle.HIGHEST_PROTOCOL)
+        message = _HEADER.pack(len(message)) + message
+        with self._lock:
+            while message:
+                message = message[os.write(self.fd, message):]
+
+    def close(self):
+        os.close(self.fd)
+
+'''
+Stands in for an object of the coordinator (eg. the Journal) in a worker,
+calling any method sends a ('call', name, method, args, kwargs) message for
+the coordinator to make the call instead. Its return value is lost so only
+methods whose result isn't needed should be called. Attributes and methods
+the worker still needs (eg. the journal's run, or a lookup in its own copy
+of the object) are given as keyword arguments
+'''
+class Forwarder(object):
+
+    def __init__(self, channel, name, **attributes):
+        self._channel = channel
+        self._name = name
+        self.__dict__.update(attributes)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            self._channel.send('call', self._name, method, args, kwargs)
+        return call
+
+'''
+A Reporter for a worker, which draws by sending the counts which changed
+since it last drew as a ('progress', (total, requests, failed, bytes,
+retried)) message, for the coordinator's Reporter.counted. The total the
+worker starts with isn't sent, the coordinator counts it for every worker
+at once
+'''
+class ChannelReporter(asyncfetchpush.Reporter):
+
+    def __init__(self, channel, refresh=0.2):
+        asyncfetchpush.Reporter.__init__(self, refresh)
+        self.channel = channel
+        self._sent = (0, 0, 0, 0, 0)
+
+    def start(self, total):
+        self._sent = (total, 0, 0, 0, 0)
+        asyncfetchpush.Reporter.start(self, total)
+
+    def draw(self, final):
+        counts = (self.total, self.requests, self.failed, self.bytes, self.retried)
+        changed = tuple(now - sent for now, sent in zip(counts, self._sent))
+        if any(changed):
+            self.channel.send('progress', changed)
+            self._sent = counts
+
+'''
+count forked worker processes and the coordinator's end of their pipes
+
+Args:
+    count - The number of workers
+'''
+class Workers(object):
+
+    def __init__(self, count):
+        self.count = count
+        self.pids = []
+        #Read end of each worker's pipe : bytes of a message not yet whole
+        self._pending = {}
+
+    '''
+    Fork the workers, each calls work(index, count, channel) then exits, with
+    a status of 1 if work raised. stdout is flushed first so nothing printed
+    before is printed again by the workers
+    '''
+    def start(self, work):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for index in xrange(self.count):
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(rfd)
+                for fd in self._pending:
+                    os.close(fd)
+                #Retries shouldn't back off in step
+                random.seed()
+                status = 0
+                try:
+                    work(index, self.count, Channel(wfd))
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+                #Skip the coordinator's atexit handlers and buffered files
+                os._exit(status)
+            os.close(wfd)
+            self.pids.append(pid)
+            self._pending[rfd] = ''
+
+    '''
+    Hand each message from the workers to handlers[kind](*args) until every
+    worker has finished. Returns the number of workers which failed
+    '''
+    def run(self, handlers):
+        while self._pending:
+            try:
+                ready = select.select(list(self._pending), [], [])[0]
+            except select.error as e:
+                #Interrupted by a signal, eg. SIGUSR1 for the rate limits
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    os.close(fd)
+                    del self._pending[fd]
+                    continue
+                data = self._pending[fd] + data
+                start = 0
+                while len(data) - start >= _HEADER.size:
+                    size = _HEADER.unpack_from(data, start)[0]
+                    end = start + _HEADER.size + size
+                    if len(data) < end:
+                        break
+                    message = cPickle.loads(data[start + _HEADER.size:end])
+                    start = end
+                    handlers[message[0]](*message[1:])
+                self._pending[fd] = data[start:]
+        failed = 0
+        for index, pid in enumerate(self.pids):
+            status = os.waitpid(pid, 0)[1]
+            if status:
+                print "Error: worker {0} failed (exit status {1})".format(index, status >> 8 or status)
+                failed += 1
+        self.pids = []
+        return failed
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+'''
+Side by side throughput of the transfer engines against the stand-in server
+
+Each engine is run in its own process, the gevent engine monkey patches the
+process it runs in, for a PUT pass then a GET pass over the same files.
+
+Example:
+
+    ./bench_engines.py --files 2000 --size 16 --limit 50
+'''
+
+def run_engine(engine, baseurl, workdir, options):
+    put = {}
+    get = {}
+    for i in xrange(options.files):
+        put[baseurl + 'f{}'.format(i)] = os.path.join(workdir, 'src', 'f{}'.format(i))
+        get[baseurl + 'f{}'.format(i)] = os.path.join(workdir, 'dst', 'f{}'.format(i))
+
+    for method, files in (('PUT', put), ('GET', get)):
+        hgp = asyncfetchpush.HttpGrabberPusher(method, files, limit=options.limit,
+                timeout=60, retries=0, engine=engine)
+        start = time.time()
+        hgp.make_requests()
+        elapsed = time.time() - start
+        print "RESULT {} {} {:.3f} {}".format(engine, method, elapsed, len(hgp.failedrequests))
+
+def main():
+    op = optparse.OptionParser(description="Compare the transfer engines")
+    op.add_option('', "--files", type="int", default=1000, help=("Number of files"))
+    op.add_option('', "--size", type="int", default=16, help=("Size of each file in KiB"))
+    op.add_option('', "--limit", type="int", default=50, help=("Concurrent requests"))
+    op.add_option('', "--engines", default=",".join(asyncfetchpush.ENGINES),
+            help=("Comma separated engines to compare"))
+    #Internal, runs a single engine in this process
+    op.add_option('', "--child", nargs=3)
+    (options, args) = op.parse_args()
+
+    if options.child:
+        engine, baseurl, workdir = options.child
+        run_engine(engine, baseurl, workdir, options)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='bench_engines')
+    proc, baseurl = standin_server.serve_in_subprocess()
+    try:
+        os.mkdir(os.path.join(workdir, 'src'))
+        os.mkdir(os.path.join(workdir, 'dst'))
+        block = os.urandom(options.size * 1024)
+        for i in xrange(options.files):
+            fh = open(os.path.join(workdir, 'src', 'f{}'.format(i)), 'wb')
+            fh.write(block)
+            fh.close()
+
+        print "{} files of {} KiB, {} concurrent requests\n".format(options.files,
+                options.size, options.limit)
+        print "engine\t\tmethod\ttime\treq/s\tMiB/s\tfailed"
+        for engine in options.engines.split(','):
+            out = subprocess.check_output([sys.executable, os.path.realpath(__file__),
+                '--files', str(options.files), '--size', str(options.size),
+                '--limit', str(options.limit), '--child', engine, baseurl, workdir],
+                stderr=open(os.devnull, 'w'))
+            for line in out.splitlines():
+                if not line.startswith('RESULT '):
+                    continue
+                engine, method, elapsed, failed = line.split()[1:]
+                elapsed = float(elapsed)
+                print "{}\t\t{}\t{:.2f}s\t{:.0f}\t{:.1f}\t{}".format(engine, method,
+                        elapsed, options.files / elapsed,
+                        options.files * options.size / 1024.0 / elapsed, failed)
+    finally:
+        proc.terminate()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+import standin_h2_server
+'''
+HTTP/2 (ConnectionPool http2) against HTTP/1.1 keep-alive
+
+The same requests over each transport, HTTP/1.1 against standin_server.py
+and HTTP/2 against standin_h2_server.py, both discarding uploads and adding
+--latency ms before every response. Each transport gets --maxconns
+connections per host, HTTP/1.1 has one request in flight on each and HTTP/2
+up to 100 streams. The scenarios:
+
+    small PUT   --files PUTs of --size KiB
+    small GET   GETs of the same files
+    mixed PUT   the small PUTs again alongside --large PUTs of --largesize
+                MiB, with the p50 and p99 of the small ones, which shows
+                whether they are held up behind the large bodies
+
+and reports the wall time, requests per second and connections opened of
+each. The fastest of --rounds is taken.
+
+Example:
+
+    ./bench_http2.py --files 2000 --size 4 --latency 20 --maxconns 6 --engine asyncio
+'''
+
+MiB = 1048576
+
+def make_files(directory, prefix, count, size):
+    os.mkdir(directory)
+    block = os.urandom(min(size, MiB))
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(directory, '{0}{1}'.format(prefix, i))
+        fh = open(path, 'wb')
+        for written in xrange(0, size, len(block)):
+            fh.write(block[:size - written])
+        fh.close()
+        paths.append(path)
+    return paths
+
+#Make the requests, returns (seconds, failed, connections, latencies of the
+#requests to urls in small)
+def run(method, files, baseurl, http2, options, small=()):
+    connections = asyncfetchpush.ConnectionPool(options.maxconns, http2=http2)
+    hgp = asyncfetchpush.HttpGrabberPusher(method, dict((baseurl + url, path)
+        for url, path in files.iteritems()), limit=options.limit, timeout=120,
+        retries=0, engine=options.engine, connections=connections,
+        reporter=asyncfetchpush.Reporter())
+    start = time.time()
+    hgp.make_requests()
+    elapsed = time.time() - start
+    latencies = sorted(r.finished - r.started for r in hgp.requestlist
+            if r.url[len(baseurl):] in small and r.finished)
+    return elapsed, len(hgp.failedrequests), connections.stats()[1], latencies
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    op = optparse.OptionParser(description="Compare HTTP/2 with HTTP/1.1 keep-alive")
+    op.add_option('', "--files", type="int", default=1000, help=("Number of small files"))
+    op.add_option('', "--size", type="int", default=4, help=("Size of each small file in KiB"))
+    op.add_option('', "--large", type="int", default=4, help=("Number of large files"))
+    op.add_option('', "--largesize", type="int", default=64,
+            help=("Size of each large file in MiB"))
+    op.add_option('', "--latency", type="float", default=20,
+            help=("Milliseconds the servers wait before every response"))
+    op.add_option('', "--maxconns", type="int", default=6,
+            help=("Connections per host of each transport"))
+    op.add_option('', "--limit", type="int", default=200, help=("Concurrent requests"))
+    op.add_option('', "--engine", default="asyncio", choices=asyncfetchpush.ENGINES)
+    op.add_option('', "--rounds", type="int", default=3, help=("Runs of each scenario"))
+    (options, args) = op.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_http2')
+    latency = str(options.latency)
+    servers = ((False, standin_server.serve_in_subprocess('--latency', latency)),
+            (True, standin_h2_server.serve_in_subprocess('--latency', latency)))
+    try:
+        small = dict(('f{0}'.format(i), path) for i, path in enumerate(
+            make_files(os.path.join(workdir, 'src'), 'f', options.files, options.size * 1024)))
+        large = dict(('big{0}'.format(i), path) for i, path in enumerate(
+            make_files(os.path.join(workdir, 'big'), 'big', options.large,
+                options.largesize * MiB)))
+        mixed = dict(small)
+        mixed.update(large)
+        gets = dict((url, os.path.join(workdir, 'dst', url)) for url in small)
+        scenarios = (('small PUT', 'PUT', small), ('small GET', 'GET', gets),
+                ('mixed PUT', 'PUT', mixed))
+
+        print "{} files of {} KiB, {} of {} MiB, {}ms latency, {} connections, {} engine\n".format(
+                options.files, options.size, options.large, options.largesize,
+                options.latency, options.maxconns, options.engine)
+        print "scenario\ttransport\tseconds\treq/s\tconns\tsmall p50\tsmall p99"
+        for name, method, files in scenarios:
+            for http2, (proc, baseurl) in servers:
+                best = None
+                for i in xrange(options.rounds):
+                    shutil.rmtree(os.path.join(workdir, 'dst'), True)
+                    os.mkdir(os.path.join(workdir, 'dst'))
+                    result = run(method, files, baseurl, http2, options, small)
+                    if best is None or result[0] < best[0]:
+                        best = result
+                elapsed, failed, conns, latencies = best
+                print "{}\t{}\t{:.2f}\t{:.0f}\t{}\t{:.0f}ms\t\t{:.0f}ms{}".format(name,
+                        'HTTP/2  ' if http2 else 'HTTP/1.1', elapsed, len(files) / elapsed,
+                        conns, percentile(latencies, 0.5) * 1000,
+                        percentile(latencies, 0.99) * 1000,
+                        "\t{} FAILED".format(failed) if failed else "")
+    finally:
+        for http2, (proc, baseurl) in servers:
+            proc.terminate()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import gc
+import optparse
+import os
+import sys
+import time
+from collections import OrderedDict
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import asyncfetchpush_cmd
+'''
+Memory per million jobs of each way of holding a list of requests
+
+Each representation is built in its own forked process from the same
+synthetic maven-like list of urls and filepaths (--perdir files per
+directory) and the growth in RSS reported per job and per million jobs:
+
+    dict - the url : filepath dictionary itself, for reference
+    request_objects - asyncfetchpush_cmd's OrderedDict of HTTPRequestHelper
+    JobList - what HttpGrabberPusher.append keeps until a request is made
+    AsyncGetPush - a request object per job, what append used to make and
+                   what now only exists for the requests in flight
+
+RSS is read from /proc so this is linux only.
+
+Example:
+
+    ./bench_job_memory.py --jobs 1000000
+'''
+
+def rss():
+    fh = open('/proc/self/statm')
+    try:
+        return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        fh.close()
+
+def jobs(count, perdir):
+    for i in xrange(count):
+        name = 'com/example/group{}/artifact{}/1.0.{}/artifact-{}.jar'.format(
+                i // (perdir * 10), i // perdir, i // perdir % 10, i)
+        yield 'https://repo.example.com/releases/' + name, '/srv/build/repo/' + name
+
+def build_dict(options):
+    return dict(jobs(options.jobs, options.perdir))
+
+def build_request_objects(options):
+    request_objects = OrderedDict()
+    for url, filepath in jobs(options.jobs, options.perdir):
+        request_objects[url] = asyncfetchpush_cmd.HTTPRequestHelper('GET', filepath)
+    return request_objects
+
+def build_joblist(options):
+    hgp = asyncfetchpush.HttpGrabberPusher('GET', reporter=asyncfetchpush.Reporter())
+    for url, filepath in jobs(options.jobs, options.perdir):
+        hgp.jobs.append(url, filepath)
+    return hgp
+
+def build_requests(options):
+    return [asyncfetchpush.AsyncGetPush('GET', url, filepath, timeout=90)
+            for url, filepath in jobs(options.jobs, options.perdir)]
+
+#Build in a forked child so each starts from the same heap, returns (bytes, seconds)
+def measure(build, options):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        gc.collect()
+        before = rss()
+        start = time.time()
+        held = build(options)
+        elapsed = time.time() - start
+        gc.collect()
+        os.write(wfd, "{} {}".format(rss() - before, elapsed))
+        os._exit(0)
+    os.close(wfd)
+    result = os.read(rfd, 128)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    grown, elapsed = result.split()
+    return int(grown), float(elapsed)
+
+def main():
+    op = optparse.OptionParser(description="Measure the memory of a list of jobs")
+    op.add_option('', "--jobs", type="int", default=1000000, help=("Number of jobs"))
+    op.add_option('', "--perdir", type="int", default=100,
+            help=("Files per directory, how much the prefixes are shared"))
+    (options, args) = op.parse_args()
+
+    print "{} jobs, {} per directory\n".format(options.jobs, options.perdir)
+    print "representation\t\tbytes/job\tMiB/million\tbuild"
+    for name, build in (("dict", build_dict),
+            ("request_objects", build_request_objects),
+            ("JobList", build_joblist),
+            ("AsyncGetPush", build_requests)):
+        grown, elapsed = measure(build, options)
+        print "{}\t{:.0f}\t\t{:.0f}\t\t{:.1f}s".format(name.ljust(16),
+                grown / float(options.jobs), grown / float(options.jobs) * 1e6 / 1048576,
+                elapsed)
+
+if __name__ == "__main__":
+    main()
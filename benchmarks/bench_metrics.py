@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+'''
+Cost of recording Metrics for every request
+
+Times the same GETs of small files from the stand-in server with and without
+metrics (a json line per request and a Prometheus file), the case where the
+instrumentation is the biggest share of the work, and reports the time
+Metrics counted in record() itself. The runs alternate for --rounds and the
+fastest of each is taken, the stand-in server slows down a little as a run
+goes on. Then times record() on its own.
+
+Example:
+
+    ./bench_metrics.py --files 5000 --engine asyncio
+'''
+
+def run(files, options, metrics):
+    hgp = asyncfetchpush.HttpGrabberPusher('GET', files, limit=options.limit,
+            timeout=60, retries=0, engine=options.engine, metrics=metrics)
+    start = time.time()
+    hgp.make_requests()
+    return time.time() - start
+
+def main():
+    op = optparse.OptionParser(description="Measure the overhead of Metrics")
+    op.add_option('', "--files", type="int", default=2000, help=("Number of files"))
+    op.add_option('', "--size", type="int", default=1, help=("Size of each file in KiB"))
+    op.add_option('', "--limit", type="int", default=50, help=("Concurrent requests"))
+    op.add_option('', "--engine", default="asyncio", choices=asyncfetchpush.ENGINES)
+    op.add_option('', "--rounds", type="int", default=3,
+            help=("Runs with and without metrics"))
+    op.add_option('', "--records", type="int", default=100000,
+            help=("Calls of record() to time on their own"))
+    (options, args) = op.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_metrics')
+    proc, baseurl = standin_server.serve_in_subprocess(
+            '--store', os.path.join(workdir, 'store'))
+    try:
+        os.makedirs(os.path.join(workdir, 'store'))
+        os.mkdir(os.path.join(workdir, 'dst'))
+        block = os.urandom(options.size * 1024)
+        files = {}
+        for i in xrange(options.files):
+            fh = open(os.path.join(workdir, 'store', 'f{}'.format(i)), 'wb')
+            fh.write(block)
+            fh.close()
+            files[baseurl + 'f{}'.format(i)] = os.path.join(workdir, 'dst', 'f{}'.format(i))
+
+        #Warm up the server and the page cache
+        run(files, options, None)
+        plain = timed = None
+        for i in xrange(options.rounds):
+            elapsed = run(files, options, None)
+            plain = min(plain or elapsed, elapsed)
+            metrics = asyncfetchpush.Metrics(os.path.join(workdir, 'metrics.ndjson'),
+                    os.path.join(workdir, 'metrics.prom'), interval=1.0)
+            elapsed = run(files, options, metrics)
+            metrics.close()
+            if timed is None or elapsed < timed:
+                timed = elapsed
+                overhead = metrics.overhead
+
+        print "{} GETs of {} KiB, {} engine, {} concurrent\n".format(options.files,
+                options.size, options.engine, options.limit)
+        print "without metrics:\t{:.2f}s ({:.0f} req/s)".format(plain, options.files / plain)
+        print "with metrics:\t\t{:.2f}s ({:.0f} req/s)".format(timed, options.files / timed)
+        print "in record():\t\t{:.3f}s ({:.2f}% of the run, {:.1f}us per request)".format(
+                overhead, overhead / timed * 100, overhead / options.files * 1e6)
+
+        #record() alone, with a json line per call
+        r = asyncfetchpush.AsyncGetPush('GET', baseurl + 'f0',
+                os.path.join(workdir, 'dst', 'f0'))
+        r.started = r.dispatched = r.headers_at = r.finished = time.time()
+        r.status = 200
+        r.response = True
+        metrics = asyncfetchpush.Metrics(os.path.join(workdir, 'record.ndjson'),
+                interval=3600)
+        start = time.time()
+        for i in xrange(options.records):
+            metrics.record(r)
+        elapsed = time.time() - start
+        metrics.close()
+        print "record() alone:\t\t{:.1f}us per call".format(elapsed / options.records * 1e6)
+    finally:
+        proc.terminate()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
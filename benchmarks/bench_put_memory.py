@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+'''
+Peak RSS while uploading large files to the stand-in server
+
+The files are sparse so the benchmark doesn't need the disk space, the
+stand-in server runs in its own process and discards what it receives.
+With streamed PUT bodies the peak should stay near the baseline plus
+roughly limit * chunk_size, whatever the size of the files.
+
+Example:
+
+    ./bench_put_memory.py --files 8 --size 1024 --limit 4
+'''
+
+def peak_rss():
+    #ru_maxrss is KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def main():
+    op = optparse.OptionParser(description="Measure peak RSS of streamed PUTs")
+    op.add_option('', "--files", type="int", default=8, help=("Number of files"))
+    op.add_option('', "--size", type="int", default=512, help=("Size of each file in MiB"))
+    op.add_option('', "--limit", type="int", default=4, help=("Pool size"))
+    op.add_option('', "--chunk", type="int", default=asyncfetchpush.CHUNK_SIZE,
+            help=("Chunk size in bytes"))
+    (options, args) = op.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='bench_put_memory')
+    proc, baseurl = standin_server.serve_in_subprocess()
+    try:
+        files = {}
+        for i in xrange(options.files):
+            path = os.path.join(tmpdir, 'artifact{}.bin'.format(i))
+            fh = open(path, 'wb')
+            fh.truncate(options.size * 1048576)
+            fh.close()
+            files[baseurl + 'artifact{}.bin'.format(i)] = path
+
+        baseline = peak_rss()
+        hgp = asyncfetchpush.HttpGrabberPusher('PUT', files, limit=options.limit,
+                timeout=600, retries=0, chunk_size=options.chunk)
+        start = time.time()
+        hgp.make_requests()
+        elapsed = time.time() - start
+
+        total = options.files * options.size * 1048576
+        print "uploaded:\t{} x {} MiB in {:.2f}s ({:.1f} MiB/s)".format(options.files,
+                options.size, elapsed, total / 1048576.0 / elapsed)
+        print "failed:\t\t{}".format(len(hgp.failedrequests))
+        print "baseline rss:\t{:.1f} MiB".format(baseline / 1048576.0)
+        print "peak rss:\t{:.1f} MiB".format(peak_rss() / 1048576.0)
+        print "growth:\t\t{:.1f} MiB (limit x chunk = {:.1f} MiB)".format(
+                (peak_rss() - baseline) / 1048576.0,
+                options.limit * options.chunk / 1048576.0)
+    finally:
+        proc.terminate()
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush_fs
+'''
+Time building a file list with sizes from a synthetic directory tree
+
+Compares os.walk plus an os.stat per file, the way the request set used to
+be built, against scan_tree with one and with many workers. The tree is
+empty files spread over --fanout directories per level. Building a million
+file tree takes a while so --keep and --root let it be reused between runs,
+drop the page cache (or use a network filesystem) to see the effect of the
+parallel listing.
+
+Example:
+
+    ./bench_scan.py --files 1000000 --root /tmp/scantree --keep
+'''
+
+def build_tree(root, files, fanout, perdir):
+    made = 0
+    d = 0
+    while made < files:
+        #Two levels of fanout directories then up to perdir files in each
+        dirpath = os.path.join(root, 'd{}'.format(d / fanout), 'd{}'.format(d % fanout))
+        os.makedirs(dirpath)
+        for i in xrange(min(perdir, files - made)):
+            open(os.path.join(dirpath, 'f{}'.format(i)), 'w').close()
+        made += min(perdir, files - made)
+        d += 1
+
+def walk_and_stat(root):
+    count = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            size += os.stat(os.path.join(dirpath, name)).st_size
+            count += 1
+    return count, size
+
+def scan(root, workers):
+    count = 0
+    size = 0
+    for path, st in asyncfetchpush_fs.scan_tree(root, workers):
+        size += st.st_size
+        count += 1
+    return count, size
+
+def main():
+    op = optparse.OptionParser(description="Compare directory walking for --basedir")
+    op.add_option('', "--files", type="int", default=1000000, help=("Number of files"))
+    op.add_option('', "--fanout", type="int", default=100, help=("Directories per level"))
+    op.add_option('', "--perdir", type="int", default=1000, help=("Files per directory"))
+    op.add_option('', "--workers", type="int", default=asyncfetchpush_fs.SCAN_WORKERS,
+            help=("Workers for the parallel scan"))
+    op.add_option('', "--root", help=("Build the tree here, or reuse it if it exists"))
+    op.add_option('', "--keep", action="store_true", default=False,
+            help=("Don't remove the tree built by this run afterwards"))
+    (options, args) = op.parse_args()
+
+    #Only what this run made is removed, never a tree which was already there
+    made = options.root is None or not os.path.isdir(options.root)
+    root = options.root or tempfile.mkdtemp(prefix='bench_scan')
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    built = False
+    try:
+        if not os.listdir(root):
+            built = True
+            start = time.time()
+            build_tree(root, options.files, options.fanout, options.perdir)
+            print "built {} files in {:.1f}s\n".format(options.files, time.time() - start)
+
+        print "method\t\t\tfiles\ttime\tfiles/s"
+        for name, func in (("os.walk + os.stat", lambda: walk_and_stat(root)),
+                ("scan_tree 1 worker", lambda: scan(root, 1)),
+                ("scan_tree {} workers".format(options.workers),
+                    lambda: scan(root, options.workers))):
+            start = time.time()
+            count, size = func()
+            elapsed = time.time() - start
+            print "{}\t{}\t{:.2f}s\t{:.0f}".format(name.ljust(16), count, elapsed,
+                    count / elapsed)
+    finally:
+        if options.keep:
+            pass
+        elif made:
+            shutil.rmtree(root, True)
+        elif built:
+            for name in os.listdir(root):
+                shutil.rmtree(os.path.join(root, name), True)
+
+if __name__ == "__main__":
+    main()
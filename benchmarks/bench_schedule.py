@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+import optparse
+import os
+import random
+import sys
+import itertools
+from collections import deque
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+'''
+Simulated makespan of a push with different ways of batching and ordering it
+
+No server is involved, a pool of --limit connections is simulated: each
+request waits --latency seconds then transfers at up to --perconn MiB/s,
+with every transfer in progress sharing --link MiB/s. The same randomly
+ordered set of files is run
+
++ greedy, joined - --size batches filled in input order, each batch waiting
+  for the slowest request before the next starts (the original behaviour)
++ greedy, queued - the same batches through one queue
++ packed - asyncfetchpush.pack batches, taken in turn by one queue
+
+Example:
+
+    ./bench_schedule.py --files 20000 --size 512 --limit 50
+'''
+
+KiB = 1024
+MiB = 1048576
+
+#Mostly poms/checksums/metadata, then jars, then a few distributions
+def maven(rng):
+    r = rng.random()
+    if r < 0.7:
+        return rng.randint(200, 10 * KiB)
+    elif r < 0.97:
+        return int(rng.lognormvariate(12, 1.2))
+    return rng.randint(20 * MiB, 800 * MiB)
+
+def lognormal(rng):
+    return int(rng.lognormvariate(13, 2))
+
+def pareto(rng):
+    return int(min(64 * KiB * rng.paretovariate(1.1), 4096 * MiB))
+
+DISTRIBUTIONS = (('maven', maven), ('lognormal', lognormal), ('pareto', pareto))
+
+#The batching _build_async_req used to do, in input order
+def greedy(items, maxbytes):
+    batches = [[]]
+    total = 0
+    for item in items:
+        if total + item[1] > maxbytes and maxbytes > 0 and batches[-1]:
+            batches.append([])
+            total = 0
+        batches[-1].append(item)
+        total += item[1]
+    return batches
+
+#Seconds to make every request of sizes through the simulated pool
+def simulate(sizes, options):
+    link = options.link * MiB
+    perconn = options.perconn * MiB
+    queue = deque(sizes)
+    #[seconds of latency left, bytes left]
+    active = []
+    now = 0.0
+    while queue or active:
+        while queue and len(active) < options.limit:
+            active.append([options.latency, queue.popleft()])
+        transferring = sum(1 for a in active if a[0] <= 0)
+        rate = min(perconn, link / transferring) if transferring else 0
+        dt = min(a[0] if a[0] > 0 else a[1] / rate for a in active)
+        for a in active:
+            if a[0] > 0:
+                a[0] -= dt
+            else:
+                a[1] -= rate * dt
+        now += dt
+        active = [a for a in active if a[0] > 1e-9 or a[1] > 1e-3]
+    return now
+
+def main():
+    op = optparse.OptionParser(description="Simulate the makespan of batching strategies")
+    op.add_option('', "--files", type="int", default=10000, help=("Number of files"))
+    op.add_option('', "--size", type="int", default=512, help=("Batch size in MiB (--size)"))
+    op.add_option('', "--count", type="int", default=0, help=("Requests per batch (--chunkcount)"))
+    op.add_option('', "--limit", type="int", default=50, help=("Concurrent requests"))
+    op.add_option('', "--latency", type="float", default=0.05, help=("Seconds per request before data flows"))
+    op.add_option('', "--link", type="float", default=120.0, help=("Total bandwidth in MiB/s"))
+    op.add_option('', "--perconn", type="float", default=20.0, help=("Bandwidth of one connection in MiB/s"))
+    op.add_option('', "--seed", type="int", default=1)
+    (options, args) = op.parse_args()
+
+    print "{0} files, {1} connections, {2}s latency, {3} MiB/s link, {4} MiB/s per connection\n".format(
+            options.files, options.limit, options.latency, options.link, options.perconn)
+    print "distribution\tGiB\tbound\tgreedy,joined\tgreedy,queued\tpacked"
+    for name, distribution in DISTRIBUTIONS:
+        rng = random.Random(options.seed)
+        items = [(i, distribution(rng)) for i in xrange(options.files)]
+        total = sum(size for i, size in items)
+        #Nothing beats the link, the biggest file or the latency of every request
+        bound = max(total / (options.link * MiB),
+                options.latency + max(size for i, size in items) / (options.perconn * MiB),
+                options.files * options.latency / options.limit)
+
+        batches = greedy(items, options.size * MiB)
+        joined = sum(simulate([size for i, size in batch], options) for batch in batches)
+        queued = simulate([size for i, size in itertools.chain.from_iterable(batches)], options)
+        packed = asyncfetchpush.pack(items, options.size * MiB, options.count)
+        balanced = simulate([size for i, size in asyncfetchpush.roundrobin(packed)], options)
+        print "{0}\t{1:.1f}\t{2:.1f}s\t{3:.1f}s\t\t{4:.1f}s\t\t{5:.1f}s ({6:+.0%})".format(
+                name.ljust(12), total / float(1024 * MiB), bound, joined, queued,
+                balanced, balanced / queued - 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+import json
+import math
+import optparse
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+'''
+End to end benchmarks of uploading and downloading against the stand-in
+server, with the results written to a json file to compare runs by
+
+Each scenario starts its own stand-in server (discarding uploads, so GETs are
+served as zeros of the size that was PUT) then PUTs and GETs its files with
+each driver, every run in a child process:
+
+    library - an HttpGrabberPusher of all the files
+    cmd - asyncfetchpush_cmd.py with an input json, as it would be run
+
+Scenarios:
+
+    small - many small files, latency bound
+    huge - a few very large files, bandwidth bound
+    mixed - lognormal sizes, mostly small with a long tail
+    flaky - a slow server which answers 5% of requests with a 503 and cuts
+            off 5% of the GETs, everything should still arrive by retrying
+    resume - a bandwidth limited download killed part way through then
+             finished with --resume, only the rest should be fetched
+
+Every run records its wall time, throughput, p50/p99 latency (the total
+time of each request from --metrics), failures, the child's peak RSS and cpu
+time. With --baseline the results are compared against an earlier file and
+the exit status is 1 if any run's throughput dropped or p99 grew by more
+than --tolerance. The source files are sparse so the disk isn't what's
+measured, --scale shrinks or grows every scenario.
+
+Example:
+
+    ./bench_suite.py --output results.json
+    ./bench_suite.py --scale 0.1 --scenarios small,flaky --baseline results.json
+'''
+
+KiB = 1024
+MiB = 1048576
+
+#name : (sizes(scale, rng), stand-in server arguments)
+SCENARIOS = OrderedDict([
+    ('small', (lambda scale, rng: [4 * KiB] * int(2000 * scale), [])),
+    ('huge', (lambda scale, rng: [int(64 * MiB * scale)] * 4, [])),
+    ('mixed', (lambda scale, rng: [min(int(rng.lognormvariate(math.log(64 * KiB), 2)),
+        int(256 * MiB * scale)) for i in xrange(int(500 * scale))], [])),
+    ('flaky', (lambda scale, rng: [64 * KiB] * int(500 * scale),
+        ['--latency', '20', '--jitter', '20', '--errorrate', '0.05', '--droprate', '0.05'])),
+    ('resume', (lambda scale, rng: [int(32 * MiB * scale)] * 4,
+        ['--bandwidth', '8M'])),
+])
+
+DRIVERS = ('library', 'cmd')
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p * (len(values) - 1)))]
+
+def make_files(workdir, sizes):
+    src = os.path.join(workdir, 'src')
+    os.mkdir(src)
+    paths = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(src, 'f{}'.format(i))
+        fh = open(path, 'wb')
+        fh.truncate(size)
+        fh.close()
+        paths.append(path)
+    return paths
+
+def write_input(workdir, method, files):
+    path = os.path.join(workdir, 'input-{}.json'.format(method))
+    fh = open(path, 'w')
+    json.dump({'HTTPAsyncData': {method: files}}, fh)
+    fh.close()
+    return path
+
+'''
+Run a child, returns (wall seconds, exit status, peak rss bytes, cpu seconds)
+
+With killwhen the child is killed as soon as killwhen() is true, checked
+every 50ms, or when it has run for killafter seconds
+'''
+def run_child(argv, cwd, killwhen=None, killafter=60):
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    proc = subprocess.Popen(argv, cwd=cwd, stdout=devnull, stderr=devnull)
+    if killwhen is not None:
+        while (proc.poll() is None and not killwhen()
+                and time.time() - start < killafter):
+            time.sleep(0.05)
+        if proc.returncode is None:
+            os.kill(proc.pid, signal.SIGKILL)
+        proc.wait()
+        return (time.time() - start, proc.returncode, None, None)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    devnull.close()
+    #ru_maxrss is KiB on linux
+    return (time.time() - start, status, usage.ru_maxrss * 1024,
+            usage.ru_utime + usage.ru_stime)
+
+'''
+Latency and failures of a run from its metrics file, the last attempt of
+each url decides whether it failed
+'''
+def read_metrics(path):
+    latencies = []
+    last = {}
+    transfer = None
+    byteses = 0
+    attempts = 0
+    try:
+        fh = open(path, 'r')
+    except IOError:
+        return {'requests': 0, 'attempts': 0, 'failed': 0, 'bytes': 0,
+                'p50': None, 'p99': None, 'transfer': None}
+    for line in fh:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            #Cut off by a kill
+            continue
+        if record['type'] == 'snapshot':
+            transfer = record['stages'].get('transfer', transfer)
+            continue
+        attempts += 1
+        byteses += record['bytes']
+        last[record['url']] = record['error']
+        if record['error'] is None:
+            latencies.append(record['total'])
+    fh.close()
+    return {'requests': len(last), 'attempts': attempts, 'bytes': byteses,
+            'failed': len([url for url, error in last.iteritems() if error]),
+            'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+            'transfer': transfer}
+
+def child_argv(driver, method, workdir, files, options, metrics, resume=False):
+    if driver == 'library':
+        filelist = os.path.join(workdir, 'files-{}.json'.format(method))
+        fh = open(filelist, 'w')
+        json.dump(files, fh)
+        fh.close()
+        return [sys.executable, os.path.realpath(__file__), '--engine', options.engine,
+                '--limit', str(options.limit), '--child', method, filelist, metrics]
+    argv = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))), 'asyncfetchpush_cmd.py'),
+        '--engine', options.engine, '--limit', str(options.limit),
+        '--metrics', metrics, '--journal', os.path.join(workdir, 'journal.ndjson')]
+    if resume:
+        return argv + ['--resume']
+    return argv + ['-i', write_input(workdir, method, files)]
+
+def run_one(scenario, driver, method, workdir, files, options):
+    metrics = os.path.join(workdir, 'metrics-{}-{}.ndjson'.format(driver, method))
+    if os.path.exists(metrics):
+        os.unlink(metrics)
+    argv = child_argv(driver, method, workdir, files, options, metrics)
+    elapsed, status, rss, cpu = run_child(argv, workdir)
+    result = OrderedDict([('scenario', scenario), ('driver', driver), ('method', method),
+        ('files', len(files)), ('elapsed', elapsed), ('peak_rss', rss), ('cpu', cpu)])
+    result.update(read_metrics(metrics))
+    seconds = result['transfer'] or elapsed
+    result['mib_per_second'] = result['bytes'] / float(MiB) / seconds
+    result['requests_per_second'] = len(files) / seconds
+    result['complete'] = complete(method, files) and not result['failed']
+    return result
+
+#Whether every GET arrived whole, PUTs are checked by their metrics
+def complete(method, files):
+    if method != 'GET':
+        return True
+    for url, path in files.iteritems():
+        if not os.path.exists(path) or os.path.getsize(path) != files.sizes[url]:
+            return False
+    return True
+
+class FileMap(dict):
+    #url : path, with the size each file should have
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.sizes = {}
+
+def run_resume(workdir, baseurl, sizes, paths, options):
+    '''
+    Download through asyncfetchpush_cmd.py, killed once --killat of the
+    bytes are on disk, then --resume it. The partial downloads should carry
+    on from their .part files
+    '''
+    puts = FileMap()
+    gets = FileMap()
+    for path, size in zip(paths, sizes):
+        url = baseurl + 'resume/' + os.path.basename(path)
+        puts[url] = path
+        gets[url] = os.path.join(workdir, 'dst', os.path.basename(path))
+        gets.sizes[url] = size
+    run_one('resume', 'library', 'PUT', workdir, puts, options)
+    os.mkdir(os.path.join(workdir, 'dst'))
+
+    first = os.path.join(workdir, 'metrics-killed.ndjson')
+    def downloaded():
+        return sum(os.path.getsize(path + '.part') for path in gets.itervalues()
+                if os.path.exists(path + '.part'))
+    killed = run_child(child_argv('cmd', 'GET', workdir, gets, options, first),
+            workdir, lambda: downloaded() >= sum(sizes) * options.killat)
+    metrics = os.path.join(workdir, 'metrics-resumed.ndjson')
+    elapsed, status, rss, cpu = run_child(child_argv('cmd', 'GET', workdir, gets,
+        options, metrics, resume=True), workdir)
+    result = OrderedDict([('scenario', 'resume'), ('driver', 'cmd'), ('method', 'GET'),
+        ('files', len(gets)), ('killed_after', killed[0]), ('elapsed', elapsed),
+        ('peak_rss', rss), ('cpu', cpu)])
+    result.update(read_metrics(metrics))
+    seconds = result['transfer'] or elapsed
+    result['mib_per_second'] = result['bytes'] / float(MiB) / seconds
+    result['requests_per_second'] = len(gets) / seconds
+    #Fraction of the files fetched again after the kill, 1.0 would mean
+    #nothing was resumed
+    result['refetched'] = result['bytes'] / float(max(sum(sizes), 1))
+    result['complete'] = complete('GET', gets) and not result['failed']
+    return [result]
+
+def run_scenario(name, options):
+    sizes_for, server_args = SCENARIOS[name]
+    sizes = sizes_for(options.scale, random.Random(options.seed))
+    workdir = tempfile.mkdtemp(prefix='bench_suite')
+    proc, baseurl = standin_server.serve_in_subprocess(*server_args)
+    try:
+        paths = make_files(workdir, sizes)
+        if name == 'resume':
+            return run_resume(workdir, baseurl, sizes, paths, options)
+        results = []
+        for driver in options.drivers.split(','):
+            puts = FileMap()
+            gets = FileMap()
+            for path, size in zip(paths, sizes):
+                url = baseurl + driver + '/' + os.path.basename(path)
+                puts[url] = path
+                gets[url] = os.path.join(workdir, 'dst', os.path.basename(path))
+                gets.sizes[url] = size
+            os.mkdir(os.path.join(workdir, 'dst'))
+            for method, files in (('PUT', puts), ('GET', gets)):
+                results.append(run_one(name, driver, method, workdir, files, options))
+            shutil.rmtree(os.path.join(workdir, 'dst'))
+        return results
+    finally:
+        proc.terminate()
+        shutil.rmtree(workdir)
+
+'''
+Runs which got slower than the baseline by more than tolerance, as a list
+of messages
+'''
+def compare(results, baseline, tolerance):
+    before = dict(((r['scenario'], r['driver'], r['method']), r)
+            for r in baseline.get('results', []))
+    regressions = []
+    for r in results:
+        old = before.get((r['scenario'], r['driver'], r['method']))
+        if old is None:
+            continue
+        name = "{} {} {}".format(r['scenario'], r['driver'], r['method'])
+        if r['mib_per_second'] < old['mib_per_second'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} MiB/s, was {:.1f}".format(name,
+                r['mib_per_second'], old['mib_per_second']))
+        if r['p99'] and old['p99'] and r['p99'] > old['p99'] * (1 + tolerance):
+            regressions.append("{}: p99 {:.1f}ms, was {:.1f}ms".format(name,
+                r['p99'] * 1000, old['p99'] * 1000))
+        if old['complete'] and not r['complete']:
+            regressions.append("{}: incomplete".format(name))
+    return regressions
+
+def child(method, filelist, metricspath, options):
+    fh = open(filelist, 'r')
+    files = json.load(fh)
+    fh.close()
+    metrics = asyncfetchpush.Metrics(metricspath)
+    hgp = asyncfetchpush.HttpGrabberPusher(method, files, limit=options.limit,
+            timeout=60, retries=3, engine=options.engine, metrics=metrics)
+    hgp.make_requests()
+    metrics.close()
+
+def main():
+    op = optparse.OptionParser(description="Run the benchmark scenarios")
+    op.add_option('', "--scenarios", default=",".join(SCENARIOS),
+            help=("Comma separated scenarios to run, of " + ", ".join(SCENARIOS)))
+    op.add_option('', "--drivers", default=",".join(DRIVERS),
+            help=("Comma separated ways of making the requests, of " + ", ".join(DRIVERS)))
+    op.add_option('', "--engine", default="gevent", choices=asyncfetchpush.ENGINES)
+    op.add_option('', "--limit", type="int", default=50, help=("Concurrent requests"))
+    op.add_option('', "--scale", type="float", default=1.0,
+            help=("Multiply the number and size of the files by this"))
+    op.add_option('', "--seed", type="int", default=1, help=("Seed for the mixed sizes"))
+    op.add_option('', "--killat", type="float", default=0.5,
+            help=("Fraction of the resume scenario's download done before"
+                " the first run is killed"))
+    op.add_option('', "--output", default="bench_results.json", help=("Results file"))
+    op.add_option('', "--baseline", help=("Results file of an earlier run to compare with"))
+    op.add_option('', "--tolerance", type="float", default=0.2,
+            help=("Fraction throughput may drop or p99 grow before it's a regression"))
+    #Internal, runs an HttpGrabberPusher in this process
+    op.add_option('', "--child", nargs=3)
+    (options, args) = op.parse_args()
+
+    if options.child:
+        child(options.child[0], options.child[1], options.child[2], options)
+        return
+
+    results = []
+    print "scenario\tdriver\tmethod\tfiles\ttime\tMiB/s\treq/s\tp50ms\tp99ms\tfailed\trss MiB\tcpu s"
+    for name in options.scenarios.split(','):
+        for r in run_scenario(name, options):
+            results.append(r)
+            print "{}\t\t{}\t{}\t{}\t{:.2f}\t{:.1f}\t{:.0f}\t{}\t{}\t{}\t{:.0f}\t{:.2f}{}".format(
+                    r['scenario'], r['driver'], r['method'], r['files'], r['elapsed'],
+                    r['mib_per_second'], r['requests_per_second'],
+                    "{:.1f}".format(r['p50'] * 1000) if r['p50'] else '-',
+                    "{:.1f}".format(r['p99'] * 1000) if r['p99'] else '-',
+                    r['failed'], r['peak_rss'] / float(MiB), r['cpu'],
+                    '' if r['complete'] else '\tINCOMPLETE')
+
+    fh = open(options.output, 'w')
+    json.dump({'timestamp': time.time(), 'python': platform.python_version(),
+        'engine': options.engine, 'limit': options.limit, 'scale': options.scale,
+        'results': results}, fh, indent=1)
+    fh.close()
+    print "\nResults written to " + options.output
+
+    if options.baseline:
+        fh = open(options.baseline, 'r')
+        baseline = json.load(fh)
+        fh.close()
+        regressions = compare(results, baseline, options.tolerance)
+        for regression in regressions:
+            print "Regression: " + regression
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
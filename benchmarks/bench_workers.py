@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+import asyncfetchpush
+import standin_server
+'''
+How asyncfetchpush_cmd.py scales with --workers
+
+PUTs then GETs the same files with --workers 1, 2, 4... up to --maxworkers,
+each run a fresh asyncfetchpush_cmd.py, and reports the wall time, requests
+and MiB per second, the cpu time of the run (all its workers) and the
+speedup over a single process. The files are spread across --servers
+stand-in servers, each its own process discarding uploads (GETs are served
+as zeros), so the server isn't what runs out of cpu first. --compress gzip
+makes the client do more work per byte, the case where one core is the
+limit. Every GET is checked to have arrived whole.
+
+The client and the servers share the machine, with fewer cores than
+workers plus servers the speedup flattens out early.
+
+Example:
+
+    ./bench_workers.py --files 4000 --size 64 --maxworkers 8 --servers 8 --compress gzip
+'''
+
+MiB = 1048576
+
+def make_files(workdir, count, size):
+    src = os.path.join(workdir, 'src')
+    os.mkdir(src)
+    #Text which compresses about as well as source or xml
+    rng = random.Random(0)
+    words = ['artifact', 'version', 'dependency', 'groupId', 'scope', 'compile',
+            '<project>', '</project>', 'org.example', 'release', '1.0.0', 'test']
+    block = ' '.join(rng.choice(words) + str(rng.randint(0, 999)) for i in xrange(size * 1024 // 8))
+    block = (block * 2)[:size * 1024]
+    paths = []
+    for i in xrange(count):
+        path = os.path.join(src, 'f{}.txt'.format(i))
+        fh = open(path, 'w')
+        fh.write(block)
+        fh.close()
+        paths.append(path)
+    return paths
+
+def write_input(workdir, method, files):
+    path = os.path.join(workdir, 'input-{}.json'.format(method))
+    fh = open(path, 'w')
+    json.dump({'HTTPAsyncData': {method: files}}, fh)
+    fh.close()
+    return path
+
+#Run asyncfetchpush_cmd.py, returns (wall seconds, exit status, cpu seconds)
+def run_cmd(workdir, inputpath, workers, options):
+    argv = [sys.executable, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.realpath(__file__))), 'asyncfetchpush_cmd.py'),
+        '-i', inputpath, '--engine', options.engine, '--limit', str(options.limit),
+        '--workers', str(workers), '--progress', 'none',
+        '--journal', os.path.join(workdir, 'journal.ndjson')]
+    if options.compress:
+        argv += ['--compress', options.compress]
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    proc = subprocess.Popen(argv, cwd=workdir, stdout=devnull, stderr=devnull)
+    #The usage of the run includes the workers it waited for
+    pid, status, usage = os.wait4(proc.pid, 0)
+    devnull.close()
+    return time.time() - start, status, usage.ru_utime + usage.ru_stime
+
+def counts(maxworkers):
+    n = 1
+    while n < maxworkers:
+        yield n
+        n *= 2
+    yield maxworkers
+
+def main():
+    op = optparse.OptionParser(description="Measure the scaling of --workers")
+    op.add_option('', "--files", type="int", default=2000, help=("Number of files"))
+    op.add_option('', "--size", type="int", default=64, help=("Size of each file in KiB"))
+    op.add_option('', "--maxworkers", type="int", default=4,
+            help=("The most workers, runs double from 1 up to this"))
+    op.add_option('', "--servers", type="int", default=4,
+            help=("Stand-in servers the files are spread across"))
+    op.add_option('', "--limit", type="int", default=100, help=("--limit of every run"))
+    op.add_option('', "--engine", default="gevent", choices=asyncfetchpush.ENGINES)
+    op.add_option('', "--compress", choices=asyncfetchpush.ENCODINGS,
+            help=("--compress the PUTs, eg. gzip"))
+    (options, args) = op.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_workers')
+    servers = [standin_server.serve_in_subprocess() for i in xrange(options.servers)]
+    try:
+        paths = make_files(workdir, options.files, options.size)
+        puts = {}
+        gets = {}
+        for i, path in enumerate(paths):
+            url = servers[i % len(servers)][1] + os.path.basename(path)
+            puts[url] = path
+            gets[url] = os.path.join(workdir, 'dst', os.path.basename(path))
+        inputs = (('PUT', write_input(workdir, 'PUT', puts)),
+                ('GET', write_input(workdir, 'GET', gets)))
+        total = options.files * options.size * 1024
+
+        print "{} files of {} KiB, {} servers, {} engine, --limit {}{}\n".format(
+                options.files, options.size, options.servers, options.engine,
+                options.limit, ", --compress " + options.compress if options.compress else "")
+        print "method\tworkers\tseconds\treq/s\tMiB/s\tcpu\tspeedup"
+        for method, inputpath in inputs:
+            single = None
+            for workers in counts(options.maxworkers):
+                if method == 'GET':
+                    shutil.rmtree(os.path.join(workdir, 'dst'), True)
+                    os.mkdir(os.path.join(workdir, 'dst'))
+                elapsed, status, cpu = run_cmd(workdir, inputpath, workers, options)
+                single = single or elapsed
+                complete = status == 0 and (method != 'GET' or all(
+                    os.path.exists(path) and os.path.getsize(path) == options.size * 1024
+                    for path in gets.itervalues()))
+                print "{}\t{}\t{:.2f}\t{:.0f}\t{:.1f}\t{:.2f}\t{:.2f}x{}".format(method,
+                        workers, elapsed, options.files / elapsed, total / float(MiB) / elapsed,
+                        cpu, single / elapsed, "" if complete else "\tINCOMPLETE")
+    finally:
+        for proc, baseurl in servers:
+            proc.terminate()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+import SocketServer
+import heapq
+import optparse
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+import urllib
+import urlparse
+import zlib
+import standin_server
+'''
+A local stand-in for an artifact server speaking HTTP/2, used by the
+benchmarks to compare asyncfetchpush_cmd.py --http2 with HTTP/1.1
+
+The same store as standin_server.py: PUT bodies are streamed to --store
+(keyed by the url path) or read and thrown away with only their size
+remembered, GET serves the stored file (or that many zeros without a store)
+and HEAD answers with its size. gzip PUT bodies are decoded as they are
+stored and --gzip compresses whole GET responses for clients which accept
+it. No Range, resumable uploads or archives.
+
+Plain http only, with prior knowledge (the client starts with the HTTP/2
+preface, no Upgrade or TLS), a thread per connection and any number of
+streams on each. Responses are sent as the flow control windows allow, each
+stream's DATA frames interleaved with the others'. --latency ms is added
+before every response without holding up the rest of the connection, as a
+server waiting on its storage would. Needs h2 2.x.
+
+Example:
+
+    ./standin_h2_server.py --port 8443 --store /tmp/standin --latency 20
+'''
+
+CHUNK_SIZE = 65536
+
+#A stream being answered, its response body comes from fh or is size zeros
+class Stream(object):
+
+    def __init__(self, method, path, headers):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.fh = None
+        self.decoder = None
+        self.received = 0
+        self.pending = ''
+        self.remaining = 0
+
+class H2Handler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        import h2.connection
+        import h2.events
+        import h2.settings
+        self.events = h2.events
+        self.sock = self.request
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = h2.connection.H2Connection(client_side=False)
+        self.conn.initiate_connection()
+        #A bigger window so uploads aren't held to 64 KiB a round trip
+        self.conn.update_settings({h2.settings.INITIAL_WINDOW_SIZE: 1 << 20})
+        self.conn.increment_flow_control_window((1 << 24) - 65535)
+        self.sock.sendall(self.conn.data_to_send())
+        self.streams = {}
+        #(due, stream id) of responses waiting out the latency
+        self.due = []
+        #Stream ids whose body is being sent, in turn
+        self.sending = []
+        try:
+            while True:
+                timeout = None
+                if self.sending:
+                    timeout = 0
+                elif self.due:
+                    timeout = max(0, self.due[0][0] - time.time())
+                if select.select([self.sock], [], [], timeout)[0]:
+                    data = self.sock.recv(CHUNK_SIZE)
+                    if not data:
+                        break
+                    for event in self.conn.receive_data(data):
+                        self._event(event)
+                now = time.time()
+                while self.due and self.due[0][0] <= now:
+                    self._respond(heapq.heappop(self.due)[1])
+                self._send_data()
+                out = self.conn.data_to_send()
+                if out:
+                    self.sock.sendall(out)
+        except socket.error:
+            pass
+        finally:
+            for stream in self.streams.itervalues():
+                if stream.fh:
+                    stream.fh.close()
+
+    def _store_path(self, path):
+        return os.path.join(self.server.store, *path.split('/'))
+
+    def _event(self, event):
+        events = self.events
+        if isinstance(event, events.RequestReceived):
+            headers = dict(event.headers)
+            path = urllib.unquote(urlparse.urlparse(headers[':path']).path).lstrip('/')
+            stream = self.streams[event.stream_id] = Stream(headers[':method'], path, headers)
+            if stream.method == 'PUT':
+                encoding = headers.get('content-encoding', 'identity')
+                if encoding != 'identity':
+                    stream.decoder = standin_server.decoder(encoding)
+                if self.server.store:
+                    filepath = self._store_path(path)
+                    if not os.path.isdir(os.path.dirname(filepath)):
+                        os.makedirs(os.path.dirname(filepath))
+                    stream.fh = open(filepath + '.part', 'wb')
+        elif isinstance(event, events.DataReceived):
+            stream = self.streams.get(event.stream_id)
+            data = event.data
+            if stream is not None:
+                if stream.decoder is not None:
+                    data = stream.decoder.decompress(data)
+                stream.received += len(data)
+                if stream.fh:
+                    stream.fh.write(data)
+            #Open the windows again as soon as the body is taken
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, events.StreamEnded):
+            heapq.heappush(self.due, (time.time() + self.server.latency, event.stream_id))
+        elif isinstance(event, events.StreamReset):
+            stream = self.streams.pop(event.stream_id, None)
+            if stream is not None and stream.fh:
+                stream.fh.close()
+            if event.stream_id in self.sending:
+                self.sending.remove(event.stream_id)
+        elif isinstance(event, events.ConnectionTerminated):
+            raise socket.error('Connection terminated')
+
+    def _respond(self, stream_id):
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        if stream.method == 'PUT':
+            if stream.decoder is None and stream.headers.get('content-encoding',
+                    'identity') != 'identity':
+                self._reply(stream_id, 415)
+                return
+            if stream.decoder is not None:
+                tail = stream.decoder.flush()
+                stream.received += len(tail)
+                if stream.fh:
+                    stream.fh.write(tail)
+            if stream.fh:
+                stream.fh.close()
+                stream.fh = None
+                os.rename(self._store_path(stream.path) + '.part', self._store_path(stream.path))
+            self.server.sizes[stream.path] = stream.received
+            self._reply(stream_id, 201)
+            return
+        size = self.server.sizes.get(stream.path)
+        if self.server.store and os.path.isfile(self._store_path(stream.path)):
+            size = os.path.getsize(self._store_path(stream.path))
+        if size is None or stream.method not in ('GET', 'HEAD'):
+            self._reply(stream_id, 404 if size is None else 405)
+            return
+        headers = []
+        if stream.method == 'GET' and self.server.gzip and self.server.store and \
+                'gzip' in stream.headers.get('accept-encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            fh = open(self._store_path(stream.path), 'rb')
+            stream.pending = compressor.compress(fh.read()) + compressor.flush()
+            fh.close()
+            size = len(stream.pending)
+            headers.append(('content-encoding', 'gzip'))
+        elif stream.method == 'GET':
+            stream.remaining = size
+            if self.server.store:
+                stream.fh = open(self._store_path(stream.path), 'rb')
+        self._reply(stream_id, 200, size, headers, stream.method == 'HEAD')
+        if stream.method == 'GET' and size:
+            self.sending.append(stream_id)
+
+    def _reply(self, stream_id, code, length=0, headers=(), headonly=True):
+        self.conn.send_headers(stream_id, [(':status', str(code)),
+            ('content-length', str(length))] + list(headers),
+            end_stream=headonly or not length)
+        if headonly or not length:
+            self.streams.pop(stream_id, None)
+
+    #A frame from each stream being sent in turn, while the windows are open
+    def _send_data(self):
+        sent = True
+        while sent and self.sending:
+            sent = False
+            for stream_id in list(self.sending):
+                stream = self.streams[stream_id]
+                window = min(self.conn.local_flow_control_window(stream_id),
+                        self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    continue
+                if not stream.pending and stream.remaining:
+                    want = min(stream.remaining, CHUNK_SIZE)
+                    stream.pending = stream.fh.read(want) if stream.fh else '\0' * want
+                    stream.remaining -= len(stream.pending)
+                    if not stream.pending:
+                        stream.remaining = 0
+                data, stream.pending = stream.pending[:window], stream.pending[window:]
+                done = not stream.pending and not stream.remaining
+                self.conn.send_data(stream_id, data, end_stream=done)
+                sent = True
+                if done:
+                    self.sending.remove(stream_id)
+                    if stream.fh:
+                        stream.fh.close()
+                    del self.streams[stream_id]
+            out = self.conn.data_to_send()
+            if out:
+                self.sock.sendall(out)
+
+class StandinH2Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, store=None, latency=0, gzip=False):
+        SocketServer.TCPServer.__init__(self, address, H2Handler)
+        self.store = store
+        self.latency = latency
+        self.gzip = gzip
+        #Url path : size of uploads, of the ones discarded without a store
+        self.sizes = {}
+
+'''
+Run the server in a child process so it doesn't count towards the memory
+or cpu of the benchmark, returns the process and the base url
+'''
+def serve_in_subprocess(*args):
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+        '--port', '0'] + list(args), stdout=subprocess.PIPE)
+    return proc, proc.stdout.readline().strip()
+
+def main():
+    op = optparse.OptionParser(description="Local stand-in HTTP/2 artifact server")
+    op.add_option('', "--port", type="int", default=8443)
+    op.add_option('', "--store", help=("Directory to store uploads in,"
+            " uploads are discarded if not set"))
+    op.add_option('', "--latency", type="float", default=0,
+            help=("Milliseconds before every response"))
+    op.add_option('', "--gzip", action="store_true", default=False,
+            help=("gzip whole GET responses when the client accepts it (needs --store)"))
+    (options, args) = op.parse_args()
+
+    server = StandinH2Server(('127.0.0.1', options.port), options.store,
+            options.latency / 1000.0, options.gzip)
+    print 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
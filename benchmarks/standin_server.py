@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import itertools
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+'''
+A local stand-in for an artifact server, used by the benchmarks
+
+Handles PUT, GET and HEAD. Uploaded bodies are streamed to --store (keyed by
+the url path) or, without a store, read and thrown away with only their size
+remembered so HEAD can still answer with a content-length.
+
+GETs honour Range (and If-Range against the ETag), HEADs and GETs answer
+with Accept-Ranges: bytes, and PUTs with a
+Content-Range are a resumable upload: "bytes */total" answers 308 with the
+Range received so far, each "bytes first-last/total" piece is appended and
+answered 308 until the last one gets a 201. A PUT with "X-Explode-Archive:
+true" is a tar archive unpacked into the directory of its url.
+
+PUT bodies with a Content-Encoding of gzip (or zstd, if zstandard is
+installed) are decoded as they are stored, any other encoding gets a 415.
+With --storeencoded they are stored as sent instead and HEAD and GET answer
+with the Content-Encoding they came with, as servers which keep the
+compressed body do. --gzip compresses whole GET responses for clients which
+accept gzip.
+
+Content can be deployed without sending it again: a COPY of a url with a
+Destination header copies it there (204 if something was there already),
+and a PUT with "X-Checksum-Deploy: true" and an X-Checksum-Sha256 of a body
+it has been sent before (uncompressed, or decoded) is stored from that, or
+gets a 404 if it hasn't, as Artifactory's checksum deploy.
+
+To stand in for a slow or unreliable server it can add --latency ms (plus up
+to --jitter ms) before every response, hold each transfer to --bandwidth
+bytes per second, answer --errorrate of the requests with a 503 and cut off
+--droprate of the GETs half way through the body.
+
+Example:
+
+    ./standin_server.py --port 8080 --store /tmp/standin
+    ./standin_server.py --port 8080 --latency 50 --bandwidth 10M --errorrate 0.05
+'''
+
+CHUNK_SIZE = 65536
+
+#A decoder for a Content-Encoding, with decompress() and flush(), None if
+#it isn't one the server can decode
+def decoder(encoding):
+    if encoding == 'gzip':
+        return zlib.decompressobj(31)
+    if encoding == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            return None
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        decompressor.flush = lambda: ''
+        return decompressor
+    return None
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    #Latency and errors, True if the request has been answered already
+    def _inject(self):
+        self._started = time.time()
+        self._paced = 0
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        if self.server.errorrate and random.random() < self.server.errorrate:
+            #Read the body so the connection can carry on
+            for chunk in self._body():
+                pass
+            self._reply(503)
+            return True
+        return False
+
+    #Hold the transfer to the bandwidth after another n bytes
+    def _pace(self, n):
+        if not self.server.bandwidth:
+            return
+        self._paced += n
+        ahead = self._paced / float(self.server.bandwidth) - (time.time() - self._started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _path(self):
+        return urllib.unquote(urlparse.urlparse(self.path).path).lstrip("/")
+
+    def _store_path(self):
+        return os.path.join(self.server.store, self._path())
+
+    def _size(self):
+        if self._path() in self.server.partial:
+            #Unfinished resumable upload
+            return None
+        if self.server.store:
+            try:
+                return os.stat(self._store_path()).st_size
+            except OSError:
+                return None
+        return self.server.sizes.get(self._path())
+
+    def _reply(self, code, length=0, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        for header, value in (headers or {}).iteritems():
+            self.send_header(header, value)
+        self.end_headers()
+
+    def _etag(self, size):
+        if self.server.store:
+            return '"{0}-{1!r}"'.format(size, os.stat(self._store_path()).st_mtime)
+        return '"{0}"'.format(size)
+
+    #(first, last) asked for by a "bytes=first-[last]" Range, None for the
+    #whole file
+    def _range(self, size):
+        value = self.headers.get('Range')
+        if not value or not value.startswith('bytes='):
+            return None
+        if self.headers.get('If-Range') not in (None, self._etag(size)):
+            return None
+        first, last = value[len('bytes='):].split('-')
+        return int(first), min(int(last), size - 1) if last else size - 1
+
+    def _resumable_put(self, value):
+        path = self._path()
+        span, total = value[len('bytes '):].split('/')
+        have = self.server.partial.get(path, 0)
+        if span != '*':
+            first = int(span.split('-')[0])
+            fh = None
+            if self.server.store and first == have:
+                fh = open(self._store_path(), 'r+b' if have else 'wb')
+                fh.seek(have)
+            for chunk in self._body():
+                if first == have:
+                    if fh:
+                        fh.write(chunk)
+                    self.server.partial[path] = self.server.partial.get(path, 0) + len(chunk)
+            if fh:
+                fh.close()
+            have = self.server.partial.get(path, 0)
+        if have >= int(total):
+            self.server.partial.pop(path, None)
+            self.server.sizes[path] = have
+            self._reply(201)
+        elif have:
+            self._reply(308, headers={'Range': 'bytes=0-{0}'.format(have - 1)})
+        else:
+            self._reply(308)
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                remaining = size
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                    remaining -= len(chunk)
+                    self._pace(len(chunk))
+                    yield chunk
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining:
+                chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self._pace(len(chunk))
+                yield chunk
+
+    def _explode(self):
+        base = os.path.dirname(self._path())
+        body = BodyReader(self._body())
+        archive = tarfile.open(fileobj=body, mode='r|')
+        for member in archive:
+            if not member.isfile():
+                continue
+            path = os.path.normpath(os.path.join(base, member.name))
+            if path.startswith('..'):
+                continue
+            src = archive.extractfile(member)
+            if self.server.store:
+                dest = os.path.join(self.server.store, path)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    try:
+                        os.makedirs(os.path.dirname(dest))
+                    except OSError:
+                        pass
+                fh = open(dest, 'wb')
+                chunk = src.read(CHUNK_SIZE)
+                while chunk:
+                    fh.write(chunk)
+                    chunk = src.read(CHUNK_SIZE)
+                fh.close()
+            else:
+                while src.read(CHUNK_SIZE):
+                    pass
+                self.server.sizes[path] = member.size
+        #Drain whatever is after the end of the archive
+        while body.read(CHUNK_SIZE):
+            pass
+        self._reply(201)
+
+    def do_PUT(self):
+        if self._inject():
+            return
+        if self.headers.get('X-Explode-Archive', '').lower() == 'true':
+            return self._explode()
+        if self.headers.get('Content-Range'):
+            return self._resumable_put(self.headers.get('Content-Range'))
+        if self.headers.get('X-Checksum-Deploy', '').lower() == 'true':
+            return self._checksum_deploy()
+        self.server.partial.pop(self._path(), None)
+        encoding = self.headers.get('Content-Encoding', 'identity').lower()
+        decoding = None
+        if encoding != 'identity' and not self.server.storeencoded:
+            decoding = decoder(encoding)
+            if decoding is None:
+                for chunk in self._body():
+                    pass
+                self._reply(415)
+                return
+        size = 0
+        fh = None
+        if self.server.store:
+            path = self._store_path()
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            fh = open(path, 'wb')
+        chunks = self._body()
+        if decoding is not None:
+            chunks = itertools.chain((decoding.decompress(c) for c in chunks),
+                    [decoding.flush()])
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            size += len(chunk)
+            digest.update(chunk)
+            if fh:
+                fh.write(chunk)
+        if fh:
+            fh.close()
+        else:
+            self.server.sizes[self._path()] = size
+        if decoding is not None or encoding == 'identity':
+            self.server.digests[digest.hexdigest()] = self._path()
+        if decoding is None and encoding != 'identity':
+            self.server.encodings[self._path()] = encoding
+        else:
+            self.server.encodings.pop(self._path(), None)
+        self._reply(201)
+
+    #Copy what the server has at path to the url of the request
+    def _copy_from(self, path):
+        if self.server.store:
+            dest = self._store_path()
+            if not os.path.isdir(os.path.dirname(dest)):
+                try:
+                    os.makedirs(os.path.dirname(dest))
+                except OSError:
+                    pass
+            shutil.copyfile(os.path.join(self.server.store, path), dest)
+        else:
+            self.server.sizes[self._path()] = self.server.sizes[path]
+        if path in self.server.encodings:
+            self.server.encodings[self._path()] = self.server.encodings[path]
+        else:
+            self.server.encodings.pop(self._path(), None)
+
+    def _checksum_deploy(self):
+        for chunk in self._body():
+            pass
+        path = self.server.digests.get(self.headers.get('X-Checksum-Sha256', '').lower())
+        if path is None or (self.server.store and not os.path.isfile(
+                os.path.join(self.server.store, path))):
+            self._reply(404)
+            return
+        if path != self._path():
+            self._copy_from(path)
+        self._reply(201)
+
+    def do_COPY(self):
+        if self._inject():
+            return
+        size = self._size()
+        destination = urlparse.urlparse(self.headers.get('Destination', ''))
+        if size is None or not destination.path:
+            self._reply(404 if size is None else 400)
+            return
+        source = self._path()
+        self.path = destination.path
+        existed = self._size() is not None
+        if self._path() != source:
+            self._copy_from(source)
+        self._reply(204 if existed else 201)
+
+    def _headers(self, size):
+        headers = {'ETag': self._etag(size), 'Accept-Ranges': 'bytes'}
+        if self._path() in self.server.encodings:
+            headers['Content-Encoding'] = self.server.encodings[self._path()]
+        return headers
+
+    #Whether to gzip the whole of a GET response
+    def _gzipping(self):
+        return (self.server.gzip and self.server.store
+                and self._path() not in self.server.encodings
+                and 'gzip' in self.headers.get('Accept-Encoding', ''))
+
+    def _gzipped(self, size):
+        fh = open(self._store_path(), 'rb')
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        body = [compressor.compress(fh.read(CHUNK_SIZE)) for i in xrange(0, size, CHUNK_SIZE)]
+        fh.close()
+        body.append(compressor.flush())
+        body = ''.join(body)
+        headers = self._headers(size)
+        headers['Content-Encoding'] = 'gzip'
+        self._reply(200, len(body), headers)
+        for i in xrange(0, len(body), CHUNK_SIZE):
+            self.wfile.write(body[i:i + CHUNK_SIZE])
+            self._pace(min(CHUNK_SIZE, len(body) - i))
+
+    def do_HEAD(self):
+        if self._inject():
+            return
+        size = self._size()
+        if size is None:
+            self._reply(404)
+        else:
+            self._reply(200, size, self._headers(size))
+
+    def do_GET(self):
+        if self._inject():
+            return
+        size = self._size()
+        if size is None:
+            self._reply(404)
+            return
+        span = self._range(size)
+        if span is None and self._gzipping():
+            return self._gzipped(size)
+        if span is not None and span[0] >= size:
+            self._reply(416, headers={'Content-Range': 'bytes */{0}'.format(size)})
+            return
+        elif span is not None:
+            start, length = span[0], span[1] - span[0] + 1
+            headers = self._headers(size)
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(span[0], span[1], size)
+            self._reply(206, length, headers)
+        else:
+            start, length = 0, size
+            self._reply(200, size, self._headers(size))
+        #Cut off half way, as if the connection dropped
+        stop = length // 2 if self.server.droprate and random.random() < self.server.droprate else 0
+        fh = None
+        if self.server.store:
+            fh = open(self._store_path(), 'rb')
+            fh.seek(start)
+        block = '\0' * CHUNK_SIZE
+        remaining = length
+        while remaining:
+            if stop and remaining <= length - stop:
+                self.close_connection = True
+                break
+            if fh:
+                chunk = fh.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+            else:
+                chunk = block[:min(remaining, CHUNK_SIZE)]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+            self._pace(len(chunk))
+        if fh:
+            fh.close()
+
+#A file-like view of a body generator, for tarfile
+class BodyReader(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, store=None, latency=0, jitter=0, bandwidth=0,
+            errorrate=0, droprate=0, storeencoded=False, gzip=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+        self.store = store
+        self.sizes = {}
+        #Bytes received so far of resumable uploads
+        self.partial = {}
+        #Seconds, bytes per second and fractions of requests
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.errorrate = errorrate
+        self.droprate = droprate
+        #Keep compressed uploads as they are, and the encoding of each
+        self.storeencoded = storeencoded
+        self.encodings = {}
+        self.gzip = gzip
+        #sha256 of uploaded bodies : the url path of the last one, for
+        #checksum deploys
+        self.digests = {}
+
+    def handle_error(self, request, client_address):
+        #Clients hanging up mid transfer (eg. a killed benchmark) are expected
+        if not issubclass(sys.exc_info()[0], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+#Bytes from eg. "512K" or "10M"
+def parse_rate(value):
+    units = {'K': 1024, 'M': 1048576, 'G': 1073741824}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+def serve_in_thread(store=None):
+    server = StandinServer(('127.0.0.1', 0), store)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+'''
+Run the server in a child process so it doesn't count towards the memory
+or cpu of the benchmark, returns the process and the base url
+'''
+def serve_in_subprocess(*args):
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__),
+        '--port', '0'] + list(args), stdout=subprocess.PIPE)
+    return proc, proc.stdout.readline().strip()
+
+def main():
+    op = optparse.OptionParser(description="Local stand-in artifact server")
+    op.add_option('', "--port", type="int", default=8080)
+    op.add_option('', "--store", help=("Directory to store uploads in,"
+            " uploads are discarded if not set"))
+    op.add_option('', "--latency", type="float", default=0,
+            help=("Milliseconds before every response"))
+    op.add_option('', "--jitter", type="float", default=0,
+            help=("Up to this many more milliseconds, at random"))
+    op.add_option('', "--bandwidth", default="0",
+            help=("Bytes per second per transfer, eg. 512K or 10M"))
+    op.add_option('', "--errorrate", type="float", default=0,
+            help=("Fraction (0-1) of requests answered with a 503"))
+    op.add_option('', "--droprate", type="float", default=0,
+            help=("Fraction (0-1) of GETs cut off half way through the body"))
+    op.add_option('', "--storeencoded", action="store_true", default=False,
+            help=("Store compressed uploads as they are sent rather than decoded"))
+    op.add_option('', "--gzip", action="store_true", default=False,
+            help=("gzip whole GET responses when the client accepts it (needs --store)"))
+    (options, args) = op.parse_args()
+
+    server = StandinServer(('127.0.0.1', options.port), options.store,
+            options.latency / 1000.0, options.jitter / 1000.0,
+            parse_rate(options.bandwidth), options.errorrate, options.droprate,
+            options.storeencoded, options.gzip)
+    print 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()